@@ -0,0 +1,94 @@
+"""
+Compares writing and reading back many small files one command at a
+time, waiting for each reply, with sending them as batch commands of
+--batch commands each. With --delay-ms the client talks to the server
+through the proxy of bench_client.py, delaying every byte by that many
+milliseconds each way, as a distant server.
+
+Usage: python bench/bench_batch.py [--files 2000] [--file-bytes 200] [--batch 100] [--delay-ms 0]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+from bench_client import start_proxy, wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+
+
+async def bench(port, args):
+    """Prints the rate of writing and reading the files both ways."""
+    await wait_for_server(port)
+    if args.delay_ms:
+        proxy = await start_proxy(port, args.delay_ms / 1000)
+        port = proxy.sockets[0].getsockname()[1]
+    content = "x" * args.file_bytes
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        await connection.register("bench", PASSWORD)
+        await connection.login("bench", PASSWORD)
+        await connection.create_folder("single")
+        await connection.create_folder("batched")
+
+        start = time.perf_counter()
+        for number in range(args.files):
+            await connection.write_file(f"single/f{number}.txt", content)
+        write_rate = args.files / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for number in range(args.files):
+            await connection.read_file(f"single/f{number}.txt", 0, args.file_bytes)
+        print(f"one at a time    write {write_rate:8.0f} files/s  "
+              f"read {args.files / (time.perf_counter() - start):8.0f} files/s")
+
+        start = time.perf_counter()
+        for first in range(0, args.files, args.batch):
+            await connection.batch([(f"write_file batched/f{number}.txt", content) for number
+                                    in range(first, min(first + args.batch, args.files))])
+        write_rate = args.files / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for first in range(0, args.files, args.batch):
+            results = await connection.batch([f"read_file batched/f{number}.txt 0 {args.file_bytes}"
+                                              for number in range(first, min(first + args.batch,
+                                                                                 args.files))])
+            assert all("reply" in result for result in results)
+        print(f"batches of {args.batch:<5} write {write_rate:8.0f} files/s  "
+              f"read {args.files / (time.perf_counter() - start):8.0f} files/s")
+        await connection.quit()
+
+
+def main():
+    """Starts the server and runs the benchmark against it."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--file-bytes", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--delay-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-batch-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port)], cwd=workdir, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(bench(port, args))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
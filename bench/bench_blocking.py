@@ -0,0 +1,133 @@
+"""
+Measures the latency of small commands while other clients keep
+reading large files, with the filesystem calls on the thread pool
+and with them running inline on the event loop (--io-threads 0).
+
+Usage: python bench/bench_blocking.py [--streamers 8] [--size-mb 64] [--probes 500] [--cold]
+
+With --cold the big file is dropped from the page cache before every
+window, so the reads go to the disk.
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+import server  # pylint: disable=wrong-import-position
+from fileio import FileIO  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+WINDOW = 4 * 1024 * 1024
+
+
+async def request(reader, writer, message):
+    """Sends one framed command and returns the reply payload."""
+    protocol.write_frame(writer, protocol.COMMAND, message.encode())
+    await writer.drain()
+    return (await protocol.read_frame(reader))[1]
+
+
+async def connect(port, user):
+    """Opens a framed connection logged in as user."""
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    await request(reader, writer, f"login {user} {PASSWORD}")
+    return reader, writer
+
+
+async def close(reader, writer):
+    """Closes a connection once the server has seen the end of it."""
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+
+
+def drop_cache(path):
+    """Asks the kernel to drop the cached pages of the file."""
+    descriptor = os.open(path, os.O_RDONLY)
+    os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(descriptor)
+
+
+async def streamer(port, user, size, stop, cold):
+    """Pages through the big file in large windows until stopped."""
+    reader, writer = await connect(port, user)
+    offset = 0
+    while not stop.is_set():
+        if cold:
+            drop_cache("Root/bench/big.txt")
+        await request(reader, writer, f"read_file big.txt {offset} {WINDOW}")
+        offset = (offset + WINDOW) % size
+    await close(reader, writer)
+
+
+async def run(threads, streamers, size, probes, cold):
+    """Runs the probes against a server using the given pool size."""
+    FileIO.configure(threads)
+    tcp_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(streamer(port, "bench", size, stop, cold))
+             for _ in range(streamers)]
+    await asyncio.sleep(0.2)
+
+    reader, writer = await connect(port, "bench")
+    latencies = []
+    for _ in range(probes):
+        start = time.perf_counter()
+        await request(reader, writer, "read_file small.txt 0 10")
+        latencies.append((time.perf_counter() - start) * 1000)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await close(reader, writer)
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    """Runs the benchmark inline and on the pool and prints p50/p99."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streamers", type=int, default=8)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--probes", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--cold", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    os.chdir(workdir)
+    os.makedirs("Root/bench")
+    os.makedirs("AccessSession")
+    with open("AccessSession/registered_users.csv", "w") as file:
+        file.write(f"username,password\nbench,{PASSWORD}\n")
+    with open("Root/bench/small.txt", "w") as file:
+        file.write("0123456789")
+    with open("Root/bench/big.txt", "wb") as file:
+        file.write(b"0123456789abcde\n" * (args.size_mb * 65536))
+
+    sys.stdout = open(os.devnull, "w")
+    try:
+        results = [(threads, asyncio.run(run(threads, args.streamers,
+                                              args.size_mb * 1024 * 1024, args.probes,
+                                              args.cold)))
+                   for threads in [0, args.threads]]
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(workdir)
+    for threads, (p50, p99) in results:
+        name = "inline" if not threads else f"{threads} threads"
+        print(f"{name}: small command p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures the shared block cache: many clients read random windows of
+the same few hot files, with the cache disabled and enabled, for plain
+and zlib compressed files. Prints the reads per second and the hit
+ratio of the cache.
+
+Usage: python bench/bench_cache.py [--clients 200] [--reads 20000] [--files 4] [--file-mb 8]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from blockcache import BlockCache  # pylint: disable=wrong-import-position
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+from compression import Compression  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+WINDOW = 4096
+
+
+def run(clients, reads, files, size):
+    """Returns the reads per second of the clients."""
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(reads):
+        client = clients[rng.randrange(len(clients))]
+        client.read_file(f"hot{rng.randrange(files)}.txt", rng.randrange(size - WINDOW), WINDOW)
+    return reads / (time.perf_counter() - start)
+
+
+def main():
+    """Prints reads per second with and without the cache."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=20000)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--file-mb", type=int, default=8)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-cache-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    size = args.file_mb * 1024 * 1024
+    line = b"The quick brown fox jumps over the lazy dog 0123456789\n"
+    content = (line * (size // len(line) + 1))[:size]
+    try:
+        for codec in [None, "zlib"]:
+            Compression.configure(codec)
+            user = "bench" + (codec or "plain")
+            owner = CommandHandler()
+            owner.register(user, PASSWORD)
+            owner.login(user, PASSWORD)
+            for number in range(args.files):
+                owner.write_file(f"hot{number}.txt", content)
+            for label, cache_bytes in [("off", 0), ("on", 2 * args.files * size)]:
+                # Handlers take the shared cache when created, as the
+                # connections of the server do after it is configured
+                cache = BlockCache.configure(cache_bytes)
+                clients = []
+                for _ in range(args.clients):
+                    client = CommandHandler()
+                    client.login(user, PASSWORD)
+                    clients.append(client)
+                rate = run(clients, args.reads, args.files, size)
+                ratio = cache.counters()["block_cache_hit_ratio"]
+                print(f"{codec or 'plain':5} cache {label:3} {rate:9.0f} reads/s  hit ratio {ratio:.3f}")
+    finally:
+        Compression.configure()
+        BlockCache.configure()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Compares the ways a script can drive the server through the client
+library: one command at a time waiting for each reply, as the
+interactive client does, every command pipelined on one connection,
+and the transfers spread over a pool of connections. Runs small
+read_file commands, then uploads and downloads a set of files. With
+--delay-ms the client talks to the server through a proxy delaying
+every byte by that many milliseconds each way, as a distant server,
+and with --flow-mbps the proxy carries at most that many megabytes per
+second on every connection, as a path limited per TCP flow.
+
+Usage: python bench/bench_client.py [--commands 5000] [--files 64] [--file-kb 256] [--pool 4]
+                                    [--delay-ms 0] [--flow-mbps 0]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+
+
+async def wait_for_server(port):
+    """Returns once the server accepts connections."""
+    for _ in range(50):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+
+
+async def delayed_pipe(reader, writer, delay, rate=None):
+    """Copies reader to writer, every chunk delay seconds after it was
+    read, at most rate bytes per second if rate is given."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    free = loop.time()
+
+    async def send():
+        while True:
+            when, chunk = await queue.get()
+            await asyncio.sleep(when - loop.time())
+            if not chunk:
+                writer.close()
+                return
+            writer.write(chunk)
+            await writer.drain()
+
+    sender = asyncio.ensure_future(send())
+    while True:
+        chunk = await reader.read(64 * 1024)
+        when = loop.time() + delay
+        if rate:
+            free = max(free, loop.time()) + len(chunk) / rate
+            when = max(when, free)
+            # Stops reading while the link is busy, as TCP would
+            await asyncio.sleep(free - loop.time() - 0.01)
+        queue.put_nowait((when, chunk))
+        if not chunk:
+            break
+    await sender
+
+
+async def start_proxy(port, delay, rate=None):
+    """Returns a server forwarding its connections to port with a delay,
+    and at most rate bytes per second per connection and direction."""
+    async def forward(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            await asyncio.gather(delayed_pipe(reader, upstream_writer, delay, rate),
+                                 delayed_pipe(upstream_reader, writer, delay, rate),
+                                 return_exceptions=True)
+        except asyncio.CancelledError:
+            # Still open when the benchmark ends
+            pass
+    return await asyncio.start_server(forward, "127.0.0.1", 0)
+
+
+async def bench(port, args, workdir):
+    """Prints the rate of every way of sending the commands and files."""
+    await wait_for_server(port)
+    if args.delay_ms or args.flow_mbps:
+        proxy = await start_proxy(port, args.delay_ms / 1000, args.flow_mbps * 2**20)
+        port = proxy.sockets[0].getsockname()[1]
+    connection = await fmsclient.connect("127.0.0.1", port)
+    await connection.register("bench", PASSWORD)
+    await connection.login("bench", PASSWORD)
+    await connection.write_file("small.txt", b"x" * 4096)
+
+    start = time.perf_counter()
+    for _ in range(args.commands):
+        await connection.read_file("small.txt", 0, 64)
+    print(f"read_file one at a time  {args.commands / (time.perf_counter() - start):9.0f} commands/s")
+    start = time.perf_counter()
+    await asyncio.gather(*[connection.read_file("small.txt", 0, 64) for _ in range(args.commands)])
+    print(f"read_file pipelined      {args.commands / (time.perf_counter() - start):9.0f} commands/s")
+
+    paths = []
+    for number in range(args.files):
+        paths.append(os.path.join(workdir, f"file{number}.bin"))
+        with open(paths[-1], "wb") as file:
+            file.write(os.urandom(args.file_kb * 1024))
+    total = args.files * args.file_kb / 1024
+    names = [os.path.basename(path) for path in paths]
+    target = os.path.join(workdir, "back")
+    os.mkdir(target)
+
+    start = time.perf_counter()
+    for path in paths:
+        await connection.upload(path, "serial_" + os.path.basename(path))
+    upload_rate = total / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for name in names:
+        await connection.download("serial_" + name, os.path.join(target, name))
+    print(f"one at a time            upload {upload_rate:7.1f} MB/s  "
+          f"download {total / (time.perf_counter() - start):7.1f} MB/s")
+    await connection.quit()
+    await connection.close()
+
+    async with fmsclient.Pool("127.0.0.1", port, "bench", PASSWORD, size=args.pool) as pool:
+        await pool.connection()
+        start = time.perf_counter()
+        await pool.upload_many(paths)
+        upload_rate = total / (time.perf_counter() - start)
+        start = time.perf_counter()
+        await pool.download_many(names, target)
+        print(f"pool of {args.pool:<3}              upload {upload_rate:7.1f} MB/s  "
+              f"download {total / (time.perf_counter() - start):7.1f} MB/s")
+
+
+def main():
+    """Starts the server and runs the benchmark against it."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--file-kb", type=int, default=256)
+    parser.add_argument("--pool", type=int, default=4)
+    parser.add_argument("--delay-ms", type=float, default=0)
+    parser.add_argument("--flow-mbps", type=float, default=0)
+    args = parser.parse_args()
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-client-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port)], cwd=workdir, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(bench(port, args, workdir))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Compares storing a large text file plain, zlib and lzma compressed:
+bytes on disk, write throughput through write_file appends, random
+read_file windows per second, and bytes sent on the wire to stream the
+file over loopback to a framed client decompressing the codec.
+
+Usage: python bench/bench_compression.py [--size-mb 64] [--reads 2000]
+                                        [--append-kb 1024]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+import server  # pylint: disable=wrong-import-position
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+from compression import Compression  # pylint: disable=wrong-import-position
+from metrics import Metrics  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+WINDOW = 4096
+
+
+def make_text(size):
+    """Returns size bytes of log-like text."""
+    words = [b"GET", b"POST", b"/index.html", b"/api/v1/items", b"200", b"404", b"user",
+             b"session", b"latency_ms", b"bytes", b"cache", b"hit", b"miss"]
+    rng = random.Random(1)
+    lines, total = [], 0
+    while total < size:
+        line = b" ".join(rng.choice(words) for _ in range(12)) + b" %d\n" % rng.randrange(10**6)
+        lines.append(line)
+        total += len(line)
+    return b"".join(lines)[:size]
+
+
+async def stream_bytes(port, user, codecs):
+    """Streams the file over loopback, returns the bytes the server sent."""
+    metrics = Metrics.shared()
+    metrics.add_bytes()
+    before = metrics.bytes_out
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port, codecs)
+    for message in [f"login {user} {PASSWORD}", "stream_file text.log"]:
+        protocol.write_frame(writer, protocol.COMMAND, message.encode())
+        await protocol.read_frame(reader)
+    opcode = None
+    while opcode != protocol.END:
+        opcode, _ = await protocol.read_frame(reader)
+    protocol.write_frame(writer, protocol.COMMAND, b"quit")
+    await protocol.read_frame(reader)
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+    await asyncio.sleep(0.05)
+    return metrics.bytes_out - before
+
+
+async def bench_wire(users):
+    """Returns the wire bytes of every codec."""
+    tcp_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    results = {}
+    for codec, user in users.items():
+        results[codec] = await stream_bytes(port, user, protocol.SUPPORTED_CODECS)
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    return results
+
+
+def main():
+    """Prints the comparison table."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--append-kb", type=float, default=1024,
+                        help="size of every write_file append, small ones leave a short "
+                             "block each in the compressed files")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-compression-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        text = make_text(args.size_mb * 1024 * 1024)
+        users = {}
+        rows = []
+        for codec in [None, "zlib", "lzma"]:
+            Compression.configure(codec)
+            user = "bench" + (codec or "plain")
+            handler = CommandHandler()
+            handler.register(user, PASSWORD)
+            handler.login(user, PASSWORD)
+            start = time.perf_counter()
+            append_size = int(args.append_kb * 1024)
+            for offset in range(0, len(text), append_size):
+                handler.write_file("text.log", text[offset:offset + append_size])
+            write_seconds = time.perf_counter() - start
+            disk = os.path.getsize(os.path.join(handler.current_dir, "text.log"))
+
+            rng = random.Random(2)
+            start = time.perf_counter()
+            for _ in range(args.reads):
+                handler.read_file("text.log", rng.randrange(len(text) - WINDOW), WINDOW)
+            read_seconds = time.perf_counter() - start
+            users[codec or "plain"] = user
+            rows.append((codec or "plain", disk, len(text) / write_seconds, args.reads / read_seconds))
+
+        wire = asyncio.run(bench_wire(users))
+        print("codec  disk MB  write MB/s  reads/s  wire MB")
+        for codec, disk, write_rate, read_rate in rows:
+            print(f"{codec:6} {disk / 2**20:7.1f} {write_rate / 2**20:11.1f} "
+                  f"{read_rate:8.0f} {wire[codec] / 2**20:8.1f}")
+    finally:
+        Compression.configure()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Measures the chunk store behind the commands: several users upload
+the same set of files plus a few files of their own, first to plain
+files then to the chunk store. Prints the write throughput of both,
+the throughput of uploading content the store already holds, the
+read throughput and the dedup ratio, the logical size of the files
+over the bytes actually used on disk.
+
+Usage: python bench/bench_dedup.py [--users 8] [--shared-mb 16] [--unique-mb 2]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chunkstore import ChunkStore  # pylint: disable=wrong-import-position
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+FILE_MB = 4
+UPLOAD_CHUNK = 256 * 1024
+
+
+def disk_usage(path):
+    """Returns the bytes allocated to the files under path."""
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(folder, name)).st_blocks * 512
+    return total
+
+
+def upload(handler, name, content):
+    """Uploads content the way the server does, chunk by chunk."""
+    _, file_upload = handler.upload(name, len(content))
+    view = memoryview(content)
+    for offset in range(0, len(content), UPLOAD_CHUNK):
+        file_upload.write(view[offset:offset + UPLOAD_CHUNK])
+    file_upload.close()
+
+
+def run_round(prefix, users, shared, unique_mb):
+    """Uploads the files of every user, returns the seconds and the bytes."""
+    handlers = []
+    for index in range(users):
+        handler = CommandHandler()
+        handler.register(f"{prefix}{index}", PASSWORD)
+        handler.login(f"{prefix}{index}", PASSWORD)
+        handlers.append(handler)
+    written = 0
+    start = time.perf_counter()
+    for handler in handlers:
+        for number, content in enumerate(shared):
+            upload(handler, f"shared{number}.bin", content)
+            written += len(content)
+        for number in range(unique_mb // FILE_MB or 1):
+            content = os.urandom(FILE_MB * 1024 * 1024)
+            upload(handler, f"own{number}.bin", content)
+            written += len(content)
+    return time.perf_counter() - start, written, handlers
+
+
+def read_all(handlers, shared):
+    """Streams every shared file of every user, returns the seconds and the bytes."""
+    read = 0
+    start = time.perf_counter()
+    for handler in handlers:
+        for number in range(len(shared)):
+            _, chunks = handler.stream_file(f"shared{number}.bin")
+            for chunk in chunks:
+                read += len(chunk)
+    return time.perf_counter() - start, read
+
+
+def main():
+    """Prints the throughput and the dedup ratio."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--shared-mb", type=int, default=16)
+    parser.add_argument("--unique-mb", type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-dedup-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shared = [os.urandom(FILE_MB * 1024 * 1024) for _ in range(max(1, args.shared_mb // FILE_MB))]
+        seconds, written, _ = run_round("plain", args.users, shared, args.unique_mb)
+        print(f"plain write      {written / seconds / 2**20:8.1f} MB/s")
+
+        store = ChunkStore.configure(os.path.join(workdir, "ChunkStore"))
+        before = disk_usage(CommandHandler.ROOT_DIR)
+        seconds, written, handlers = run_round("dedup", args.users, shared, args.unique_mb)
+        print(f"dedup write      {written / seconds / 2**20:8.1f} MB/s")
+        physical = disk_usage(CommandHandler.ROOT_DIR) - before + disk_usage(store.directory)
+        print(f"dedup ratio      {written / physical:8.2f} x "
+              f"({written / 2**20:.0f} MB in {physical / 2**20:.1f} MB)")
+
+        start = time.perf_counter()
+        for handler in handlers:
+            for number, content in enumerate(shared):
+                upload(handler, f"again{number}.bin", content)
+        seconds = time.perf_counter() - start
+        print(f"re-upload        {args.users * len(shared) * FILE_MB / seconds:8.1f} MB/s")
+
+        seconds, read = read_all(handlers, shared)
+        print(f"dedup read       {read / seconds / 2**20:8.1f} MB/s")
+    finally:
+        ChunkStore.configure(None)
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures the overhead of dispatching a command line, without the work
+of the command itself: parsing plus handler lookup, and the whole
+Dispatcher.run path with a handler returning at once and a channel
+discarding the reply. The old chain of if command == ... checks,
+splitting the message once per check, is timed on the same messages
+as a baseline.
+
+Usage: python bench/bench_dispatch.py [--iterations 200000]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dispatcher import Dispatcher  # pylint: disable=wrong-import-position
+from fileio import FileIO  # pylint: disable=wrong-import-position
+
+MESSAGES = ["commands", "register bench benchpassword", "login bench benchpassword", "quit",
+            "create_folder docs", "change_folder docs", "write_file a.txt hello world",
+            "read_file a.txt 0 10", "list", "no_such_command x"]
+CHAIN = ["commands", "register", "login", "quit", "create_folder", "change_folder",
+         "write_file", "read_file", "list"]
+
+
+def chained_lookup(message):
+    """The lookup done by the old client_request."""
+    command = message.rstrip("\n").rstrip(" ").lstrip(" ").split(" ")[0]
+    for name in CHAIN:
+        if command == name:
+            return len(message.split(" ")), message.split(" ")[1:]
+    return None
+
+
+class NullChannel:
+    """Channel dropping every reply."""
+
+    async def send(self, reply):
+        """Drops the reply."""
+        del reply
+
+    async def send_stream(self, header, chunks):
+        """Drops the header."""
+        del header, chunks
+
+
+def build_dispatcher():
+    """Returns a dispatcher whose handlers return at once."""
+    dispatcher = Dispatcher()
+    for name in CHAIN:
+        dispatcher.register(name, lambda commandhandler, args, payload: "", 0, None)
+    return dispatcher
+
+
+def time_per_call(function, iterations):
+    """Returns the mean time of function(message) in nanoseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations // len(MESSAGES)):
+        for message in MESSAGES:
+            function(message)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+async def time_run(dispatcher, iterations):
+    """Returns the mean time of Dispatcher.dispatch in nanoseconds."""
+    channel = NullChannel()
+    start = time.perf_counter()
+    for _ in range(iterations // len(MESSAGES)):
+        for message in MESSAGES:
+            await dispatcher.dispatch(None, message, None, channel)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def main():
+    """Prints the dispatch overhead per command."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    FileIO.configure(0)
+    dispatcher = build_dispatcher()
+    print(f"if-chain lookup       {time_per_call(chained_lookup, args.iterations):8.0f} ns")
+    print(f"table parse + lookup  {time_per_call(dispatcher.parse, args.iterations):8.0f} ns")
+    print(f"table dispatch        {asyncio.run(time_run(dispatcher, args.iterations)):8.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
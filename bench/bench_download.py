@@ -0,0 +1,116 @@
+"""
+Compares download (sendfile/mmap) with stream_file and with paging
+through read_file windows, over a framed loopback connection. Every
+mode runs in a fresh interpreter holding both the server and the
+client so the peak RSS of each mode can be told apart.
+
+Usage: python bench/bench_download.py [--size-mb 1024] [--window-kb 1024]
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+import server  # pylint: disable=wrong-import-position
+
+USER = "benchdownload"
+PASSWORD = "benchpassword"
+FILENAME = "big.bin"
+MODES = ["download", "stream_file", "read_file"]
+
+
+async def request(reader, writer, message):
+    """Sends one framed command and returns the reply payload."""
+    protocol.write_frame(writer, protocol.COMMAND, message.encode())
+    await writer.drain()
+    return (await protocol.read_frame(reader))[1]
+
+
+async def drain_bytes(reader, remaining):
+    """Reads and drops remaining raw bytes."""
+    while remaining:
+        remaining -= len(await reader.read(min(remaining, 1024 * 1024)))
+
+
+async def run_mode(mode, size, window):
+    """Transfers the whole file once with the given mode."""
+    tcp_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    await request(reader, writer, f"login {USER} {PASSWORD}")
+
+    start = time.perf_counter()
+    if mode == "download":
+        await request(reader, writer, "download " + FILENAME)
+        await drain_bytes(reader, size)
+    elif mode == "stream_file":
+        await request(reader, writer, "stream_file " + FILENAME)
+        while (await protocol.read_frame(reader))[0] == protocol.DATA:
+            pass
+    else:
+        for offset in range(0, size, window):
+            await request(reader, writer, f"read_file {FILENAME} {offset} {window}")
+    elapsed = time.perf_counter() - start
+
+    await request(reader, writer, "quit")
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    return elapsed
+
+
+def child(mode, size_mb, window_kb):
+    """Runs one mode inside the benchmark directory and prints the result."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    elapsed = asyncio.run(run_mode(mode, size_mb * 1024 * 1024, window_kb * 1024))
+    sys.stdout.close()
+    sys.stdout = stdout
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode}: {size_mb / elapsed:.1f} MB/s, peak RSS {rss_mb:.1f} MB")
+
+
+def main():
+    """Creates the file and runs every mode in its own interpreter."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--window-kb", type=int, default=1024)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        child(args.mode, args.size_mb, args.window_kb)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    try:
+        user_dir = os.path.join(workdir, "Root", USER)
+        os.makedirs(user_dir)
+        os.makedirs(os.path.join(workdir, "AccessSession"))
+        with open(os.path.join(workdir, "AccessSession", "registered_users.csv"), "w") as file:
+            file.write(f"username,password\n{USER},{PASSWORD}\n")
+        line = b"The quick brown fox jumps over the lazy dog 0123456789\n"
+        block = (line * (1024 * 1024 // len(line) + 1))[:1024 * 1024]
+        with open(os.path.join(user_dir, FILENAME), "wb") as file:
+            for _ in range(args.size_mb):
+                file.write(block)
+        for mode in MODES:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--mode", mode,
+                            "--size-mb", str(args.size_mb), "--window-kb", str(args.window_kb)],
+                           cwd=workdir, check=True)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
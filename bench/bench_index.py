@@ -0,0 +1,110 @@
+"""
+Compares answering find, du and quota from the metadata index with
+walking the folders, as the commands would have to without it. Writes
+a tree of small files through write_file, timing what keeping the index
+up to date adds to every write, then times each command both ways, a
+reconcile scan rebuilding a lost index and one finding nothing to fix.
+
+Usage: python bench/bench_index.py [--folders 100] [--files 20000] [--repeat 20]
+"""
+
+import argparse
+import fnmatch
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+from metaindex import MetadataIndex  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+
+
+def walk_find(folder, pattern):
+    """Returns the paths below folder whose name matches pattern, by walking it."""
+    found = []
+    for parent, folders, files in os.walk(folder):
+        found += [os.path.join(parent, name) for name in folders + files
+                  if fnmatch.fnmatchcase(name, pattern)]
+    return found
+
+
+def walk_du(folder):
+    """Returns the bytes, files and folders below folder, by walking it."""
+    size = files = folders = 0
+    for parent, names, filenames in os.walk(folder):
+        folders += len(names)
+        files += len(filenames)
+        size += sum(os.stat(os.path.join(parent, name)).st_size for name in filenames)
+    return size, files, folders
+
+
+def timed(repeat, function, *args):
+    """Returns the milliseconds one call of function takes, on average."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    """Builds the tree and prints the time of every command both ways."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folders", type=int, default=100)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-index-")
+    os.chdir(workdir)
+    try:
+        index = MetadataIndex.configure(os.path.join(workdir, "index.sqlite3"))
+        handler = CommandHandler()
+        handler.register("bench", PASSWORD)
+        handler.login("bench", PASSWORD)
+        root = handler.current_dir
+        for folder in range(args.folders):
+            handler.create_folder(f"d{folder}")
+
+        record_time = 0.0
+        start = time.perf_counter()
+        for number in range(args.files):
+            filename = f"d{number % args.folders}/report{number}.txt"
+            handler.write_file(filename, "x" * 100)
+            path = os.path.join(root, filename)
+            before = time.perf_counter()
+            index.record("bench", filename, path)
+            record_time += time.perf_counter() - before
+        elapsed = time.perf_counter() - start - record_time
+        print(f"write_file {args.files / elapsed:8.0f} writes/s, "
+              f"keeping the index up to date {record_time / args.files * 1e6:5.1f} us each")
+
+        print("                         walking    index")
+        rows = [("find report123*", lambda: walk_find(root, "report123*"),
+                 lambda: handler.find("report123*")),
+                ("find *.txt (first 100)", lambda: walk_find(root, "*.txt"),
+                 lambda: handler.find("*.txt")),
+                ("du", lambda: walk_du(root), handler.du),
+                ("du d7", lambda: walk_du(os.path.join(root, "d7")), lambda: handler.du("d7")),
+                ("quota", lambda: walk_du(root), handler.quota)]
+        for name, walk, indexed in rows:
+            print(f"{name:24} {timed(args.repeat, walk):7.2f} ms {timed(args.repeat, indexed):7.3f} ms")
+
+        rebuilt = MetadataIndex(os.path.join(workdir, "rebuilt.sqlite3"))
+        start = time.perf_counter()
+        changes = rebuilt.reconcile(CommandHandler.ROOT_DIR)
+        print(f"reconcile, lost index    {time.perf_counter() - start:7.2f} s  ({changes} entries)")
+        start = time.perf_counter()
+        changes = rebuilt.reconcile(CommandHandler.ROOT_DIR)
+        print(f"reconcile, up to date    {time.perf_counter() - start:7.2f} s  ({changes} entries)")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmarks login and logout through the journals of the user store, as
+the filesystem threads of the server run them, for a growing number of
+registered users and of threads making changes at once. Every change is
+on the disk when it returns; the commits per fsync show how many
+concurrent changes group commit lets share one flush.
+
+Usage: python bench/bench_journal.py [--sizes 1000 100000] [--threads 1 4 16] [--seconds 2]
+                                     [--directory DIR]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from userstore import UserStore  # pylint: disable=wrong-import-position
+
+
+def populate(directory, size):
+    """Registers size users, half of them logged in, through one store."""
+    store = UserStore(directory, sync=False)
+    for number in range(size):
+        store.add_user(f"user{number}", f"password{number}")
+        if number % 2:
+            store.start_session(f"user{number}")
+
+
+def run(directory, threads, seconds):
+    """
+    Logs users in and out from every thread for the given time.
+
+    Returns
+    -------
+    tuple
+        Changes per second, and changes per fsync
+    """
+    store = UserStore(directory)
+    store.load()
+    stop = time.perf_counter() + seconds
+    done = [0] * threads
+
+    def work(number):
+        user_id = f"user{number * 2}"
+        while time.perf_counter() < stop:
+            store.start_session(user_id)
+            store.end_session(user_id)
+            done[number] += 2
+
+    workers = [threading.Thread(target=work, args=(number,)) for number in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    counters = store.counters()
+    return sum(done) / elapsed, counters["user_store_commits"] / max(1, counters["user_store_fsyncs"])
+
+
+def main():
+    """Runs the benchmark for every size and number of threads."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument("--directory", default=None,
+                        help="where to keep the files, by default a temporary folder; "
+                             "fsync costs depend on the file system")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-journal-", dir=args.directory)
+    print("users    threads  changes/s  commits per fsync")
+    try:
+        for size in args.sizes:
+            directory = os.path.join(workdir, str(size))
+            populate(directory, size)
+            for threads in args.threads:
+                rate, per_fsync = run(directory, threads, args.seconds)
+                print(f"{size:<8} {threads:7} {rate:10.0f} {per_fsync:18.1f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
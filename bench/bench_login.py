@@ -0,0 +1,132 @@
+"""
+Measures login throughput against the cost of the password hash: for
+every cost in --costs, starts a server hashing with --scheme at that
+cost, registers --users users, then has --clients connections log in
+and out --logins times in all. Every login is hashed once with the
+cache of verified logins disabled, and once more with it enabled after
+every user logged in a first time. While the uncached logins run, a
+separate connection sends stats, answered on the event loop, and its
+latency shows whether the hashing holds up the other clients.
+
+Usage: python bench/bench_login.py [--scheme scrypt] [--costs 10 12 14]
+                                   [--users 50] [--logins 400] [--clients 16]
+                                   [--hash-processes N]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+from bench_client import wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+
+
+async def register(port, args):
+    """Registers the users of the bench, over --clients connections."""
+    async def client(first):
+        async with await fmsclient.connect("127.0.0.1", port) as connection:
+            for user in range(first, args.users, args.clients):
+                await connection.register(f"bench{user}", PASSWORD)
+            await connection.quit()
+
+    await asyncio.gather(*[client(first) for first in range(args.clients)])
+
+
+async def log_in(port, args):
+    """Logs the users in and out --logins times over --clients connections,
+    returns how long it took."""
+    async def client(first):
+        async with await fmsclient.connect("127.0.0.1", port) as connection:
+            for login in range(first, args.logins, args.clients):
+                reply = await connection.login(f"bench{login % args.users}", PASSWORD)
+                if not fmsclient.logged_in(reply):
+                    raise RuntimeError(reply)
+                await connection.quit()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(first) for first in range(args.clients)])
+    return time.perf_counter() - start
+
+
+async def probe(port, done, latencies):
+    """Sends stats until done is set, noting how long every reply took."""
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        while not done.is_set():
+            start = time.perf_counter()
+            await connection.stats()
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.01)
+
+
+async def bench(port, args, cached):
+    """Returns the logins per second, and the stats latencies while they ran."""
+    await wait_for_server(port)
+    await register(port, args)
+    if cached:
+        await log_in(port, argparse.Namespace(**{**vars(args), "logins": args.users}))
+    done, latencies = asyncio.Event(), []
+    prober = asyncio.ensure_future(probe(port, done, latencies))
+    elapsed = await log_in(port, args)
+    done.set()
+    await prober
+    return args.logins / elapsed, latencies
+
+
+def run_server(args, cost, cached):
+    """Starts a server hashing at cost and runs the benchmark against it."""
+    with socket.socket() as probe_socket:
+        probe_socket.bind(("127.0.0.1", 0))
+        port = probe_socket.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-login-")
+    options = ["--password-hash", args.scheme, "--hash-cost", str(cost)]
+    if args.hash_processes is not None:
+        options += ["--hash-processes", str(args.hash_processes)]
+    if not cached:
+        options += ["--verified-logins", "0"]
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port), "--no-fsync", *options], cwd=workdir,
+                               stdout=subprocess.DEVNULL)
+    try:
+        return asyncio.run(bench(port, args, cached))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+def main():
+    """Runs the benchmark for every cost."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scheme", choices=("scrypt", "pbkdf2"), default="scrypt")
+    parser.add_argument("--costs", type=int, nargs="+", default=[10, 12, 14],
+                        help="log2 of scrypt's N, or of the PBKDF2 iterations")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=400)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--hash-processes", type=int, default=None,
+                        help="processes hashing on the server, by default one per core")
+    args = parser.parse_args()
+
+    print(f"{args.scheme:8} logins/s uncached  stats median/max ms  logins/s cached")
+    for cost in args.costs:
+        uncached, latencies = run_server(args, cost, cached=False)
+        cached, _ = run_server(args, cost, cached=True)
+        print(f"cost {cost:3} {uncached:17.0f} {statistics.median(latencies) * 1000:11.1f} / "
+              f"{max(latencies) * 1000:5.1f} {cached:16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measures the memory the server holds per idle connection: opens
+--connections connections, logs every one of them in and moves it to a
+folder, then prints how much the resident set size of the server grew,
+in total and per 10k connections. --framed opens them with the framed
+protocol, --watch has each of them watch its folder as well.
+
+Usage: python bench/bench_memory.py [--connections 10000] [--framed] [--watch]
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+from bench_client import wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+OPEN_AT_ONCE = 100
+
+
+def rss(pid):
+    """Returns the resident set size of a process, in bytes."""
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise ValueError("No VmRSS for process " + str(pid))
+
+
+def raise_file_limit():
+    """Lets this process open as many files as the hard limit allows."""
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def open_session(port, args):
+    """Opens one connection, logged in and in the folder of the bench."""
+    if args.framed:
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    else:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    commands = [f"login bench {PASSWORD}", "change_folder sync"] + (["watch"] if args.watch else [])
+    for command in commands:
+        if args.framed:
+            protocol.write_frame(writer, protocol.COMMAND, command.encode())
+            await protocol.read_frame(reader)
+        else:
+            writer.write(command.encode())
+            await writer.drain()
+            await reader.read(4096)
+    return writer
+
+
+async def bench(port, pid, args):
+    """Prints the growth of the server's memory with the connections."""
+    await wait_for_server(port)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for command in [f"register bench {PASSWORD}", f"login bench {PASSWORD}", "create_folder sync"]:
+        writer.write(command.encode())
+        await writer.drain()
+        await reader.read(4096)
+    # One connection opened and closed first, so the allocations every
+    # server makes once do not count
+    writer.close()
+    await (await open_session(port, args)).drain()
+    await asyncio.sleep(0.5)
+    before = rss(pid)
+    writers = []
+    while len(writers) < args.connections:
+        count = min(OPEN_AT_ONCE, args.connections - len(writers))
+        writers += await asyncio.gather(*[open_session(port, args) for _ in range(count)])
+    await asyncio.sleep(0.5)
+    grown = rss(pid) - before
+    print(f"{len(writers)} idle connections: server RSS grew {grown / 2**20:.1f} MB, "
+          f"{grown / len(writers) * 10000 / 2**20:.1f} MB per 10k connections, "
+          f"{grown / len(writers) / 1024:.2f} KB each")
+    for writer in writers:
+        writer.transport.abort()
+
+
+def main():
+    """Starts the server and runs the benchmark against it."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--framed", action="store_true")
+    parser.add_argument("--watch", action="store_true")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-memory-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port), "--no-fsync",
+                                "--max-connections", str(args.connections + 10)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, preexec_fn=raise_file_limit)
+    try:
+        asyncio.run(bench(port, process.pid, args))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
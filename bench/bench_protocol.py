@@ -0,0 +1,132 @@
+"""
+Compares the text and the framed protocol over a loopback connection:
+small commands per second (one round trip each for text, pipelined
+for framed) and write_file upload throughput (4 KB messages for text,
+1 MiB frames for framed).
+
+Usage: python bench/bench_protocol.py [--commands 5000] [--upload-mb 64]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+import server  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+COMMAND = b"read_file small.txt 0 10"
+PIPELINE_DEPTH = 64
+TEXT_CHUNK = 4000
+FRAMED_CHUNK = 1024 * 1024
+
+
+async def text_request(reader, writer, message):
+    """Sends one text command and waits for the reply."""
+    writer.write(message)
+    await writer.drain()
+    return await reader.read(protocol.TEXT_READ_SIZE)
+
+
+async def framed_request(reader, writer, message):
+    """Sends one framed command and waits for the reply."""
+    protocol.write_frame(writer, protocol.COMMAND, message)
+    await writer.drain()
+    return (await protocol.read_frame(reader))[1]
+
+
+async def bench_text(port, user, commands, upload_mb):
+    """Runs the text protocol benchmark."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for message in ["register", "login"]:
+        await text_request(reader, writer, f"{message} {user} {PASSWORD}".encode())
+    await text_request(reader, writer, b"write_file small.txt 0123456789")
+
+    start = time.perf_counter()
+    for _ in range(commands):
+        await text_request(reader, writer, COMMAND)
+    command_time = time.perf_counter() - start
+
+    body = b"x" * (TEXT_CHUNK - len("write_file upload.txt "))
+    start = time.perf_counter()
+    for _ in range(upload_mb * 1024 * 1024 // len(body)):
+        await text_request(reader, writer, b"write_file upload.txt " + body)
+    upload_time = time.perf_counter() - start
+
+    await text_request(reader, writer, b"quit")
+    writer.write(b"exit")
+    await reader.read()
+    writer.close()
+    return command_time, upload_time
+
+
+async def bench_framed(port, user, commands, upload_mb):
+    """Runs the framed protocol benchmark."""
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    for message in ["register", "login"]:
+        await framed_request(reader, writer, f"{message} {user} {PASSWORD}".encode())
+    await framed_request(reader, writer, b"write_file small.txt 0123456789")
+
+    start = time.perf_counter()
+    for sent in range(0, commands, PIPELINE_DEPTH):
+        batch = min(PIPELINE_DEPTH, commands - sent)
+        for _ in range(batch):
+            protocol.write_frame(writer, protocol.COMMAND, COMMAND)
+        await writer.drain()
+        for _ in range(batch):
+            await protocol.read_frame(reader)
+    command_time = time.perf_counter() - start
+
+    body = b"\n" + b"x" * FRAMED_CHUNK
+    start = time.perf_counter()
+    for _ in range(upload_mb * 1024 * 1024 // FRAMED_CHUNK):
+        await framed_request(reader, writer, b"write_file upload.txt" + body)
+    upload_time = time.perf_counter() - start
+
+    await framed_request(reader, writer, b"quit")
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+    return command_time, upload_time
+
+
+async def run(commands, upload_mb):
+    """Starts the server and runs both protocols against it."""
+    tcp_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    results = {"text": await bench_text(port, "benchtext", commands, upload_mb),
+               "framed": await bench_framed(port, "benchframed", commands, upload_mb)}
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    return results
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commands", type=int, default=5000)
+    parser.add_argument("--upload-mb", type=int, default=64)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")
+    try:
+        results = asyncio.run(run(args.commands, args.upload_mb))
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(workdir)
+    for name, (command_time, upload_time) in results.items():
+        print(f"{name}: {args.commands / command_time:.0f} commands/s, "
+              f"{args.upload_mb / upload_time:.1f} MB/s upload")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares moving one large file with the single stream upload and
+download commands against ranged transfers spread over a pool of
+connections, then times resuming a ranged upload interrupted halfway.
+With --delay-ms and --flow-mbps the client talks to the server through
+the proxy of bench_client.py, delaying every byte and limiting the
+throughput of every connection.
+
+Usage: python bench/bench_ranged.py [--size-mb 256] [--range-mb 8] [--pool 4] [--delay-ms 0]
+                                    [--flow-mbps 0]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+from bench_client import start_proxy, wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+
+
+async def bench(port, args, workdir):
+    """Prints the throughput of every way of moving the file."""
+    await wait_for_server(port)
+    if args.delay_ms or args.flow_mbps:
+        proxy = await start_proxy(port, args.delay_ms / 1000, args.flow_mbps * 2**20)
+        port = proxy.sockets[0].getsockname()[1]
+    path = os.path.join(workdir, "big.bin")
+    with open(path, "wb") as file:
+        for _ in range(args.size_mb):
+            file.write(os.urandom(1024 * 1024))
+    copy = os.path.join(workdir, "copy.bin")
+    range_size = args.range_mb * 1024 * 1024
+
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        await connection.register("bench", PASSWORD)
+        await connection.login("bench", PASSWORD)
+        start = time.perf_counter()
+        await connection.upload(path, "single.bin")
+        upload_rate = args.size_mb / (time.perf_counter() - start)
+        start = time.perf_counter()
+        await connection.download("single.bin", copy)
+        print(f"single stream      upload {upload_rate:7.1f} MB/s  "
+              f"download {args.size_mb / (time.perf_counter() - start):7.1f} MB/s")
+
+    async with fmsclient.Pool("127.0.0.1", port, "bench", PASSWORD, size=args.pool) as pool:
+        start = time.perf_counter()
+        await pool.upload_parallel(path, "ranged.bin", range_size)
+        upload_rate = args.size_mb / (time.perf_counter() - start)
+        os.remove(copy)
+        start = time.perf_counter()
+        await pool.download_parallel("ranged.bin", copy, range_size)
+        print(f"ranged, pool of {args.pool:<2} upload {upload_rate:7.1f} MB/s  "
+              f"download {args.size_mb / (time.perf_counter() - start):7.1f} MB/s")
+
+        size = os.path.getsize(path)
+        connection = await pool.connection()
+        await connection.upload_begin("resumed.bin", size)
+        for offset in range(0, size // 2, range_size):
+            await connection.upload_range(path, "resumed.bin", offset, min(range_size, size - offset))
+        start = time.perf_counter()
+        await pool.upload_parallel(path, "resumed.bin", range_size)
+        print(f"resume half-done upload {time.perf_counter() - start:6.2f} s")
+
+
+def main():
+    """Starts the server and runs the benchmark against it."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--range-mb", type=int, default=8)
+    parser.add_argument("--pool", type=int, default=4)
+    parser.add_argument("--delay-ms", type=float, default=0)
+    parser.add_argument("--flow-mbps", type=float, default=0)
+    args = parser.parse_args()
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-ranged-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port)], cwd=workdir, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(bench(port, args, workdir))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
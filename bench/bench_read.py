@@ -0,0 +1,109 @@
+"""
+Measures read throughput on large files: windowed read_file calls
+with an offset and a length, stream_file chunks read locally and
+stream_file over a loopback connection to the server.
+
+Usage: python bench/bench_read.py [--size-mb 2048] [--window-kb 1024]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server  # pylint: disable=wrong-import-position
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+
+USER = "benchreader"
+PASSWORD = "benchpassword"
+FILENAME = "big.bin"
+
+
+def create_file(path, size_mb):
+    """Writes a text file of size_mb MiB."""
+    line = b"The quick brown fox jumps over the lazy dog 0123456789\n"
+    block = (line * (1024 * 1024 // len(line) + 1))[:1024 * 1024]
+    with open(path, "wb") as file:
+        for _ in range(size_mb):
+            file.write(block)
+
+
+def bench_windows(handler, size, window):
+    """Reads the whole file through read_file windows."""
+    start = time.perf_counter()
+    for offset in range(0, size, window):
+        handler.read_file(FILENAME, offset, window)
+    return time.perf_counter() - start
+
+
+def bench_stream(handler):
+    """Reads the whole file through the stream_file chunks."""
+    start = time.perf_counter()
+    _, chunks = handler.stream_file(FILENAME)
+    for _ in chunks:
+        pass
+    return time.perf_counter() - start
+
+
+async def bench_loopback(size):
+    """Streams the whole file from the server over loopback."""
+    tcp_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for message in ["login " + USER + " " + PASSWORD]:
+        writer.write(message.encode())
+        await writer.drain()
+        await reader.read(4096)
+
+    start = time.perf_counter()
+    writer.write(("stream_file " + FILENAME).encode())
+    await reader.readline()
+    await reader.readline()
+    remaining = size
+    while remaining:
+        remaining -= len(await reader.read(1024 * 1024))
+    elapsed = time.perf_counter() - start
+
+    writer.write(b"quit")
+    await reader.read(4096)
+    writer.write(b"exit")
+    await reader.read()
+    writer.close()
+    tcp_server.close()
+    await tcp_server.wait_closed()
+    return elapsed
+
+
+def main():
+    """Runs every benchmark and prints MB/s."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--window-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    os.chdir(workdir)
+    try:
+        handler = CommandHandler()
+        handler.register(USER, PASSWORD)
+        handler.login(USER, PASSWORD)
+        create_file(os.path.join(handler.current_dir, FILENAME), args.size_mb)
+        size = args.size_mb * 1024 * 1024
+
+        results = [("read_file windows", bench_windows(handler, size, args.window_kb * 1024)),
+                   ("stream_file local", bench_stream(handler)),
+                   ("stream_file loopback", asyncio.run(bench_loopback(size)))]
+        handler.quit()
+        for name, elapsed in results:
+            print(f"{name}: {args.size_mb / elapsed:.1f} MB/s ({elapsed:.2f} s)")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
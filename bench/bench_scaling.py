@@ -0,0 +1,143 @@
+"""
+Measures how connections/sec and commands/sec scale with the number
+of server worker processes. For every worker count the server is
+started with --workers on loopback and driven by several client
+processes.
+
+Usage: python bench/bench_scaling.py [--max-workers N] [--clients N] [--duration 5]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import protocol  # pylint: disable=wrong-import-position
+
+PASSWORD = "benchpassword"
+CONNECTIONS_PER_CLIENT = 16
+PIPELINE_DEPTH = 16
+
+
+async def connection_loop(port, deadline):
+    """Opens and closes framed connections until the deadline."""
+    count = 0
+    while time.monotonic() < deadline:
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+        count += 1
+    return count
+
+
+async def command_loop(port, deadline):
+    """Sends pipelined small commands on one connection until the deadline."""
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    protocol.write_frame(writer, protocol.COMMAND, f"login bench {PASSWORD}".encode())
+    await protocol.read_frame(reader)
+    count = 0
+    while time.monotonic() < deadline:
+        for _ in range(PIPELINE_DEPTH):
+            protocol.write_frame(writer, protocol.COMMAND, b"read_file small.txt 0 10")
+        await writer.drain()
+        for _ in range(PIPELINE_DEPTH):
+            await protocol.read_frame(reader)
+        count += PIPELINE_DEPTH
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+    return count
+
+
+def client(port, mode, duration, results):
+    """Runs CONNECTIONS_PER_CLIENT loops of one mode in this process."""
+    async def run():
+        deadline = time.monotonic() + duration
+        loop = connection_loop if mode == "connections" else command_loop
+        counts = await asyncio.gather(*[loop(port, deadline)
+                                        for _ in range(CONNECTIONS_PER_CLIENT)])
+        return sum(counts)
+    results.put(asyncio.run(run()))
+
+
+def measure(port, mode, clients, duration):
+    """Runs the client processes and returns operations per second."""
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client, args=(port, mode, duration, results))
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total / duration
+
+
+def wait_for_port(port):
+    """Waits until the server accepts connections."""
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The server did not start")
+
+
+def main():
+    """Runs the benchmark for 1, 2, 4, ... workers and prints a table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--clients", type=int, default=os.cpu_count())
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--port", type=int, default=9088)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    os.makedirs(os.path.join(workdir, "Root", "bench"))
+    os.makedirs(os.path.join(workdir, "AccessSession"))
+    with open(os.path.join(workdir, "AccessSession", "registered_users.csv"), "w") as file:
+        file.write(f"username,password\nbench,{PASSWORD}\n")
+    with open(os.path.join(workdir, "Root", "bench", "small.txt"), "w") as file:
+        file.write("0123456789")
+
+    counts = []
+    workers = 1
+    while workers <= args.max_workers:
+        counts.append(workers)
+        workers *= 2
+    if counts[-1] != args.max_workers:
+        counts.append(args.max_workers)
+
+    print("workers | connections/s | commands/s")
+    try:
+        for workers in counts:
+            server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "server.py"),
+                                       "--host", "127.0.0.1", "--port", str(args.port),
+                                       "--workers", str(workers)],
+                                      cwd=workdir, stdout=subprocess.DEVNULL)
+            try:
+                wait_for_port(args.port)
+                connections = measure(args.port, "connections", args.clients, args.duration)
+                commands = measure(args.port, "commands", args.clients, args.duration)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+            print(f"{workers} | {connections:.0f} | {commands:.0f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
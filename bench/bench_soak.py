@@ -0,0 +1,126 @@
+"""
+Soak test of the connection handling: churns many connections through
+a server process, in batches running at once. Every connection runs a
+few commands then leaves in one of four ways: sending exit,
+disconnecting without exit, disconnecting in the middle of a frame, or
+going idle until the server times it out. Prints the resident memory
+and the open descriptors of the server as the connections go by, which
+should level off rather than grow with the number of connections.
+
+Usage: python bench/bench_soak.py [--connections 10000] [--batch 200]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import protocol  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+IDLE_TIMEOUT = 0.5
+
+
+def server_usage(pid):
+    """Returns the resident memory in bytes and the open descriptors of a process."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+    return rss, len(os.listdir(f"/proc/{pid}/fd"))
+
+
+async def request(reader, writer, message):
+    """Sends one framed command and returns the reply."""
+    protocol.write_frame(writer, protocol.COMMAND, message.encode())
+    return (await protocol.read_frame(reader))[1]
+
+
+async def churn(port, number):
+    """Runs one connection, leaving in the way picked by its number."""
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    try:
+        await request(reader, writer, f"login soak {PASSWORD}")
+        await request(reader, writer, "write_file soak.txt\n" + "x" * 1024)
+        await request(reader, writer, "read_file soak.txt 0 512")
+        way = number % 4
+        if way == 0:
+            protocol.write_frame(writer, protocol.COMMAND, b"exit")
+            await reader.read()
+        elif way == 2:
+            # Announces a 1 KB command and sends 10 bytes of it
+            writer.write(protocol.HEADER.pack(protocol.COMMAND, 1024) + b"read_file ")
+            await writer.drain()
+        elif way == 3:
+            await asyncio.wait_for(reader.read(), IDLE_TIMEOUT * 10)
+    finally:
+        writer.close()
+
+
+async def soak(port, pid, connections, batch):
+    """Churns the connections, printing the usage of the server."""
+    for _ in range(50):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+    await request(reader, writer, f"register soak {PASSWORD}")
+    writer.close()
+
+    print("connections  seconds  RSS MB  open fds")
+    start = time.perf_counter()
+    rss, fds = server_usage(pid)
+    print(f"{0:11} {0:8.1f} {rss / 2**20:7.1f} {fds:9}")
+    failures = 0
+    report = max(batch, connections // 10)
+    for first in range(0, connections, batch):
+        results = await asyncio.gather(*[churn(port, number) for number
+                                         in range(first, min(first + batch, connections))],
+                                       return_exceptions=True)
+        failures += sum(isinstance(result, Exception) for result in results)
+        done = min(first + batch, connections)
+        if done % report == 0 or done == connections:
+            # Leaves the server time to close the abandoned connections
+            await asyncio.sleep(IDLE_TIMEOUT * 2)
+            rss, fds = server_usage(pid)
+            print(f"{done:11} {time.perf_counter() - start:8.1f} {rss / 2**20:7.1f} {fds:9}")
+    print(f"client errors {failures}")
+
+
+def main():
+    """Starts the server and churns the connections through it."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=200)
+    args = parser.parse_args()
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-soak-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port), "--idle-timeout", str(IDLE_TIMEOUT),
+                                "--read-timeout", str(IDLE_TIMEOUT)],
+                               cwd=workdir, stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(soak(port, process.pid, args.connections, args.batch))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
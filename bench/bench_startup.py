@@ -0,0 +1,73 @@
+"""
+Measures the cold start cost of the server: the time taken to import
+server.py and the peak RSS of the importing process. Every sample runs
+in a fresh interpreter.
+
+Usage: python bench/bench_startup.py [--runs 10] [--max-ms 200] [--max-rss-mb 40]
+
+Exits with a non-zero status if the median import time or the peak RSS
+goes over the given limits, so regressions can be caught in CI.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import server
+elapsed = time.perf_counter() - start
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = sorted(name for name in ("pandas", "numpy") if name in sys.modules)
+print(elapsed, rss_kb, ",".join(heavy))
+"""
+
+
+def sample():
+    """
+    Imports server.py in a new interpreter.
+
+    Returns
+    -------
+    tuple
+        Import time in ms, peak RSS in MB and heavy modules loaded
+    """
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=REPO_DIR, check=True, timeout=60,
+                            capture_output=True, text=True).stdout.split()
+    heavy = output[2] if len(output) > 2 else ""
+    return float(output[0]) * 1000, int(output[1]) / 1024, heavy
+
+
+def main():
+    """Collects the samples and prints the summary."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=None)
+    parser.add_argument("--max-rss-mb", type=float, default=None)
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.runs)]
+    import_ms = statistics.median(ms for ms, _, _ in samples)
+    rss_mb = max(rss for _, rss, _ in samples)
+    heavy = samples[-1][2]
+    print(f"import server: median {import_ms:.1f} ms, peak RSS {rss_mb:.1f} MB")
+    if heavy:
+        print(f"heavy modules imported: {heavy}")
+
+    failed = False
+    if args.max_ms is not None and import_ms > args.max_ms:
+        print(f"import time over the {args.max_ms} ms limit")
+        failed = True
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        print(f"RSS over the {args.max_rss_mb} MB limit")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Compares copying a folder of --files files of --size bytes spread over
+--folders sub-folders by a client, which streams every file and writes
+it back, with the copy command of the server, once per number of tree
+threads in --threads. Prints how long each copy took, and how long
+delete -r took to remove it again.
+
+Usage: python bench/bench_tree.py [--files 2000] [--size 16384] [--folders 20]
+                                  [--threads 0 1 8]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+from bench_client import wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+BATCH_FILES = 200
+
+
+def file_names(args):
+    """Returns the paths of the files of the bench, from the copied folder."""
+    return [f"f{number % args.folders}/{number}.bin" for number in range(args.files)]
+
+
+async def fill(connection, args):
+    """Creates the folder copied by the bench."""
+    await connection.create_folder("src")
+    await connection.batch([f"create_folder src/f{folder}" for folder in range(args.folders)])
+    content = "x" * args.size
+    names = file_names(args)
+    for first in range(0, len(names), BATCH_FILES):
+        await connection.batch([(f"write_file src/{name}", content)
+                                for name in names[first:first + BATCH_FILES]])
+
+
+async def copy_by_client(connection, args):
+    """Copies the folder through the client, file by file."""
+    await connection.create_folder("dst")
+    await connection.batch([f"create_folder dst/f{folder}" for folder in range(args.folders)])
+
+    async def copy(name):
+        content = await connection.stream_file(f"src/{name}")
+        await connection.write_file(f"dst/{name}", content)
+
+    await asyncio.gather(*[copy(name) for name in file_names(args)])
+
+
+async def copy_by_server(connection, args):
+    """Copies the folder with the copy command."""
+    del args
+    await connection.copy("src", "dst")
+
+
+async def bench(port, args, ways):
+    """Prints how long the given ways took to copy the folder."""
+    await wait_for_server(port)
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        await connection.register("bench", PASSWORD)
+        await connection.login("bench", PASSWORD)
+        await fill(connection, args)
+        for name, way in ways:
+            start = time.perf_counter()
+            await way(connection, args)
+            copied = time.perf_counter() - start
+            start = time.perf_counter()
+            await connection.delete("dst", recursive=True)
+            deleted = time.perf_counter() - start
+            print(f"{name:22} {copied:8.2f} s {args.files / copied:10.0f} {deleted:10.2f} s")
+        await connection.quit()
+
+
+def run_server(args, ways, options=()):
+    """Starts a server with the options and runs the benchmark against it."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-tree-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port), "--no-fsync", *options], cwd=workdir,
+                               stdout=subprocess.DEVNULL)
+    try:
+        asyncio.run(bench(port, args, ways))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+def main():
+    """Runs the benchmark every way."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=16384, help="bytes of every file")
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, 1, 8],
+                        help="numbers of tree threads the copy command is run with")
+    args = parser.parse_args()
+
+    print("                           copy    files/s    delete -r")
+    run_server(args, [("client, file by file", copy_by_client)])
+    for threads in args.threads:
+        run_server(args, [(f"copy, {threads} threads", copy_by_server)],
+                   ["--tree-threads", str(threads)])
+
+
+if __name__ == "__main__":
+    main()
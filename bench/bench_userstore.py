@@ -0,0 +1,85 @@
+"""
+Benchmarks the per command latency of the user store for a growing
+number of registered users.
+
+Usage: python bench/bench_userstore.py [--sizes 10 1000 100000 1000000]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from commandhandler import CommandHandler  # pylint: disable=wrong-import-position
+from userstore import UserStore  # pylint: disable=wrong-import-position
+
+
+def populate(directory, size):
+    """Writes a registered users file holding size users."""
+    os.makedirs(directory)
+    with open(os.path.join(directory, UserStore.REGISTERED_USERS_CSV_FILE), "w") as writer:
+        writer.write(UserStore.CSV_HEADING)
+        writer.writelines("user%d,password%d\n" % (i, i) for i in range(size))
+
+
+def run(size, rounds):
+    """
+    Loads a store of the given size and times register, login,
+    list and quit through CommandHandler.
+
+    Returns
+    -------
+    dict
+        Load time and mean microseconds per command
+    """
+    directory = os.path.join("AccessSession")
+    populate(directory, size)
+    store = UserStore(directory)
+    start = time.perf_counter()
+    store.load()
+    load_time = time.perf_counter() - start
+
+    timings = {"register": 0.0, "login": 0.0, "list": 0.0, "quit": 0.0}
+    for i in range(rounds):
+        handler = CommandHandler(user_store=store)
+        user_id = "bench%d" % i
+        steps = [("register", lambda: handler.register(user_id, "benchpassword")),
+                 ("login", lambda: handler.login(user_id, "benchpassword")),
+                 ("list", handler.list),
+                 ("quit", handler.quit)]
+        for name, step in steps:
+            start = time.perf_counter()
+            step()
+            timings[name] += time.perf_counter() - start
+    shutil.rmtree(directory)
+    shutil.rmtree(CommandHandler.ROOT_DIR)
+    result = {"users": size, "load_s": round(load_time, 3)}
+    result.update({name: round(total / rounds * 1e6, 1) for name, total in timings.items()})
+    return result
+
+
+def main():
+    """Runs the benchmark for every size and prints a table."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000, 1000000])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fms-bench-")
+    os.chdir(workdir)
+    print("users | load (s) | register (us) | login (us) | list (us) | quit (us)")
+    try:
+        for size in args.sizes:
+            result = run(size, args.rounds)
+            print(" | ".join(str(result[key]) for key in
+                             ["users", "load_s", "register", "login", "list", "quit"]))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
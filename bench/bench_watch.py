@@ -0,0 +1,152 @@
+"""
+Compares a client noticing the files written by another client by
+polling list every --poll-interval seconds with the same client being
+sent the changes after watch, once with inotify and once with the
+server's polling fallback. Prints how long after the write the client
+learned of it, and the requests and server CPU time it cost.
+
+Usage: python bench/bench_watch.py [--files 50] [--gap 0.3] [--poll-interval 1]
+                                   [--folder-files 1000]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fmsclient  # pylint: disable=wrong-import-position
+from bench_client import wait_for_server  # pylint: disable=wrong-import-position
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+PASSWORD = "benchpassword"
+
+
+def server_cpu(pid):
+    """Returns the CPU seconds the server process used so far."""
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def write_files(connection, args, written):
+    """Writes one new file every gap seconds, noting when each was written."""
+    for number in range(args.files):
+        await asyncio.sleep(args.gap)
+        written[f"new{number}.txt"] = time.perf_counter()
+        await connection.write_file(f"sync/new{number}.txt", "x")
+
+
+async def by_listing(port, args, writer):
+    """Polls list until every file showed up, returns the delays and the requests."""
+    written, delays, requests = {}, [], 0
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        await connection.login("bench", PASSWORD)
+        await connection.change_folder("sync")
+        task = asyncio.ensure_future(write_files(writer, args, written))
+        seen = set()
+        while len(seen) < args.files:
+            await asyncio.sleep(args.poll_interval)
+            cursor = None
+            while True:
+                requests += 1
+                reply = await connection.list(cursor, 1000)
+                for line in reply.splitlines():
+                    name = line.split(" | ")[0]
+                    if name in written and name not in seen:
+                        seen.add(name)
+                        delays.append(time.perf_counter() - written[name])
+                if "Next page: list " not in reply:
+                    break
+                cursor = reply.rsplit("Next page: list ", 1)[1].split()[0]
+        await task
+        await connection.quit()
+    return delays, requests
+
+
+async def by_watching(port, args, writer):
+    """Waits for the change of every file, returns the delays and the requests."""
+    written, delays = {}, []
+    async with await fmsclient.connect("127.0.0.1", port) as connection:
+        await connection.login("bench", PASSWORD)
+        await connection.watch("sync")
+        task = asyncio.ensure_future(write_files(writer, args, written))
+        while len(delays) < args.files:
+            _, path = await connection.events.get()
+            delays.append(time.perf_counter() - written[path.rsplit("/", 1)[1]])
+        await task
+        await connection.unwatch("sync")
+        await connection.quit()
+    return delays, 2
+
+
+async def bench(port, pid, args, ways):
+    """Prints the delays and costs of the given ways of noticing the files."""
+    await wait_for_server(port)
+    async with await fmsclient.connect("127.0.0.1", port) as writer:
+        await writer.register("bench", PASSWORD)
+        await writer.login("bench", PASSWORD)
+        await writer.create_folder("sync")
+        for first in range(0, args.folder_files, 1000):
+            await writer.batch([(f"write_file sync/old{number}.txt", "x") for number
+                                in range(first, min(first + 1000, args.folder_files))])
+        for name, way in ways:
+            cpu = server_cpu(pid)
+            delays, requests = await way(port, args, writer)
+            cpu = server_cpu(pid) - cpu
+            print(f"{name:22} {statistics.median(delays) * 1000:8.0f} ms {max(delays) * 1000:8.0f} ms "
+                  f"{requests:9} {cpu:10.2f} s")
+            for number in range(args.files):
+                os.remove(os.path.join("Root", "bench", "sync", f"new{number}.txt"))
+        await writer.quit()
+
+
+def run_server(args, ways, options=()):
+    """Starts a server with the options and runs the benchmark against it."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    workdir = tempfile.mkdtemp(prefix="fms-watch-")
+    process = subprocess.Popen([sys.executable, os.path.abspath(SERVER), "--host", "127.0.0.1",
+                                "--port", str(port), *options], cwd=workdir,
+                               stdout=subprocess.DEVNULL)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        asyncio.run(bench(port, process.pid, args, ways))
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir)
+
+
+def main():
+    """Runs the benchmark every way."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--gap", type=float, default=0.3,
+                        help="seconds between two files written")
+    parser.add_argument("--poll-interval", type=float, default=1,
+                        help="seconds between two lists, and between two listings of the "
+                             "server's polling fallback")
+    parser.add_argument("--folder-files", type=int, default=1000,
+                        help="files already in the folder, which every list sends again")
+    args = parser.parse_args()
+
+    print("                       median      max  requests  server CPU")
+    run_server(args, [("list polling", by_listing), ("watch, inotify", by_watching)])
+    run_server(args, [("watch, polling", by_watching)],
+               ["--watch-polling", "--watch-interval", str(args.poll_interval)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Load generator for the file server. Starts server.py on loopback in a
+scratch folder, drives many concurrent asyncio clients through a mix
+of register, login, write_file, read_file and list commands, and
+prints a JSON report with the throughput, the p50/p95/p99 latency of
+every command and the RSS of the server, so runs can be compared
+across commits.
+
+Usage: python bench/loadgen.py [--clients 1000] [--duration 10]
+                               [--mix read_file=40,write_file=20,list=20,login=10,register=10]
+                               [--procs 1] [--output report.json] [-- server options]
+
+Every client registers and logs in its own user, then picks commands
+at random following the weights of --mix: login logs out and in again,
+register registers a new user over a short-lived connection, the
+other commands run on the client's own connection.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import protocol  # pylint: disable=wrong-import-position
+
+PASSWORD = "loadgenpassword"
+DEFAULT_MIX = "read_file=40,write_file=20,list=20,login=10,register=10"
+COMMANDS = ["register", "login", "write_file", "read_file", "list"]
+
+
+def parse_mix(mix):
+    """
+    Returns
+    -------
+    dict
+        Maps every command of the mix to its weight
+    """
+    weights = {}
+    for item in mix.split(","):
+        command, _, weight = item.partition("=")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError("Unknown command " + command)
+        weights[command] = float(weight)
+    return weights
+
+
+class Client:
+    """
+
+    One simulated user with its own framed connection.
+
+    Attributes
+    ----------
+    self.user_id : str
+        Username registered by the client
+    self.latencies : dict
+        Maps a command to the latencies of its calls, in seconds
+    self.errors : dict
+        Maps a command to the number of failed calls
+    """
+
+    def __init__(self, port, user_id, payload, latencies, errors):
+        self.port = port
+        self.user_id = user_id
+        self.payload = payload
+        self.latencies = latencies
+        self.errors = errors
+        self.reader = None
+        self.writer = None
+        self.registered = 0
+
+    async def request(self, message, body=None):
+        """Sends one command and returns the reply."""
+        data = message.encode() if body is None else message.encode() + b"\n" + body
+        protocol.write_frame(self.writer, protocol.COMMAND, data)
+        await self.writer.drain()
+        return (await protocol.read_frame(self.reader))[1].decode(errors="replace")
+
+    async def timed(self, command, coroutine, expected):
+        """Awaits one call and records its latency and outcome."""
+        start = time.perf_counter()
+        try:
+            reply = await coroutine
+        except (OSError, asyncio.IncompleteReadError, protocol.ProtocolError):
+            reply = ""
+        self.latencies[command].append(time.perf_counter() - start)
+        if expected not in reply:
+            self.errors[command] += 1
+
+    async def register_new_user(self):
+        """Registers a new user over its own connection."""
+        self.registered += 1
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", self.port)
+        message = f"register {self.user_id}.{self.registered} {PASSWORD}"
+        protocol.write_frame(writer, protocol.COMMAND, message.encode())
+        reply = (await protocol.read_frame(reader))[1].decode()
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+        return reply
+
+    async def relogin(self):
+        """Logs out and logs in again."""
+        await self.request("quit")
+        return await self.request(f"login {self.user_id} {PASSWORD}")
+
+    async def run(self, deadline, weights):
+        """Sends commands following the weights until the deadline."""
+        self.reader, self.writer = await protocol.open_framed_connection("127.0.0.1", self.port)
+        await self.request(f"register {self.user_id} {PASSWORD}")
+        await self.request(f"login {self.user_id} {PASSWORD}")
+        await self.request("write_file data.txt", self.payload)
+        commands, cumulative = list(weights), list(weights.values())
+        while time.monotonic() < deadline:
+            command = random.choices(commands, cumulative)[0]
+            if command == "register":
+                await self.timed(command, self.register_new_user(), "Registered")
+            elif command == "login":
+                await self.timed(command, self.relogin(), "Logged into")
+            elif command == "write_file":
+                await self.timed(command, self.request("write_file data.txt", self.payload),
+                                 "data to file")
+            elif command == "read_file":
+                size = len(self.payload)
+                await self.timed(command, self.request(f"read_file data.txt 0 {size}"), "Reading")
+            else:
+                await self.timed(command, self.request("list"), "File | Size")
+        await self.request("quit")
+        self.writer.write_eof()
+        await self.reader.read()
+        self.writer.close()
+
+
+def run_clients(port, first, count, duration, weights, payload_bytes, results):
+    """Runs count clients in this process and puts their latencies on results."""
+    latencies = {command: [] for command in COMMANDS}
+    errors = {command: 0 for command in COMMANDS}
+    payload = b"x" * payload_bytes
+    tag = f"{os.getpid()}.{int(time.time())}"
+
+    async def main():
+        deadline = time.monotonic() + duration
+        clients = [Client(port, f"load{tag}.{first + i}", payload, latencies, errors)
+                   for i in range(count)]
+        outcomes = await asyncio.gather(*[client.run(deadline, weights) for client in clients],
+                                        return_exceptions=True)
+        return sum(1 for outcome in outcomes if isinstance(outcome, BaseException))
+
+    failed_clients = asyncio.run(main())
+    results.put((latencies, errors, failed_clients))
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of values lie."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def process_tree_rss(pid):
+    """Returns the summed RSS in MB of a process and its children."""
+    total = 0
+    pids = [str(pid)]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids += file.read().split()
+    except OSError:
+        pass
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def wait_for_port(port):
+    """Waits until the server accepts connections."""
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The server did not start")
+
+
+def git_commit():
+    """Returns the commit being benchmarked, if known."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Starts the server, runs the load and prints the JSON report."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--payload-bytes", type=int, default=1024)
+    parser.add_argument("--procs", type=int, default=1, help="client processes")
+    parser.add_argument("--port", type=int, default=9089)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="options passed to server.py after --")
+    args = parser.parse_args()
+    server_args = [arg for arg in args.server_args if arg != "--"]
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, 4 * args.clients + 256)), hard))
+
+    workdir = tempfile.mkdtemp(prefix="fms-loadgen-")
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "server.py"), "--host",
+                               "127.0.0.1", "--port", str(args.port)] + server_args,
+                              cwd=workdir, stdout=subprocess.DEVNULL)
+    rss_samples = []
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(0.2):
+            rss_samples.append(process_tree_rss(server.pid))
+
+    try:
+        wait_for_port(args.port)
+        rss_idle = process_tree_rss(server.pid)
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        results = multiprocessing.Queue()
+        per_proc = [args.clients // args.procs + (i < args.clients % args.procs)
+                    for i in range(args.procs)]
+        processes = [multiprocessing.Process(target=run_clients, args=(
+            args.port, sum(per_proc[:i]), count, args.duration, args.mix,
+            args.payload_bytes, results)) for i, count in enumerate(per_proc)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        outputs = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+        stop_sampling.set()
+        sampler.join()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir)
+
+    report = {"commit": git_commit(), "clients": args.clients, "duration_s": round(elapsed, 2),
+              "mix": args.mix, "server_args": server_args, "commands": {}}
+    total = 0
+    for command in args.mix:
+        latencies = sorted(value for output in outputs for value in output[0][command])
+        total += len(latencies)
+        report["commands"][command] = {
+            "count": len(latencies),
+            "errors": sum(output[1][command] for output in outputs),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        }
+    report["throughput_ops"] = round(total / elapsed, 1)
+    report["failed_clients"] = sum(output[2] for output in outputs)
+    report["server_rss_mb"] = {"idle": round(rss_idle, 1),
+                               "peak": round(max(rss_samples, default=rss_idle), 1)}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
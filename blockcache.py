@@ -0,0 +1,206 @@
+"""
+This program caches the blocks of the files read by read_file, shared
+by all the client connections of the server.
+"""
+
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_BLOCK_SIZE = 64 * 1024
+_SIZE = -1
+_SIZE_ENTRY_BYTES = 128
+
+
+class BlockCache:
+    """
+
+    Process-wide LRU cache of file blocks. A block is keyed by the path,
+    the modification time and the size of its file and its number, so a
+    file changed by any process, even another worker, is read again;
+    write_file also drops the blocks of the files it writes right away.
+    Blocks hold the content as read_file returns it, i.e. decompressed
+    or reassembled from the chunk store. The least recently used blocks
+    are dropped beyond max_bytes.
+
+    Attributes
+    ----------
+    self.max_bytes : int
+        Bytes of blocks kept, 0 disables the cache
+    self.block_size : int
+        Size of the blocks
+    self.blocks : OrderedDict
+        Maps (path, mtime, size, block number) to the block, or with
+        the block number -1 to the size of the content of the file
+    self.hits, self.misses, self.evictions : int
+        Blocks found in the cache, read from the file, and dropped
+
+    Returns
+    -------
+    Object
+        BlockCache Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_bytes=CACHE_BYTES, block_size=CACHE_BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = OrderedDict()
+        self.paths = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        BlockCache
+            The cache shared by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, max_bytes=CACHE_BYTES, block_size=CACHE_BLOCK_SIZE):
+        """
+        Replaces the shared cache, e.g. with the size given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(max_bytes, block_size)
+            return cls._shared
+
+    def read(self, path, offset, length, open_file):
+        """
+        Reads a window of a file through the cache.
+
+        Parameters
+        ----------
+        path : str
+            File to read
+        offset : int
+            Position of the first byte
+        length : int
+            Number of bytes to read
+        open_file : callable
+            Called with the path on a miss, returns the open file and
+            the size of its content
+
+        Returns
+        -------
+        tuple
+            The bytes read, and the size of the content of the file
+
+        Raises
+        ------
+        FileNotFoundError, IsADirectoryError
+            If the path is not a file
+        """
+        if not self.max_bytes:
+            file, size = open_file(path)
+            with file:
+                file.seek(offset)
+                return file.read(length), size
+        stats = os.stat(path)
+        if stat.S_ISDIR(stats.st_mode):
+            raise IsADirectoryError(path)
+        version = (path, stats.st_mtime_ns, stats.st_size)
+        file = None
+        try:
+            size = self._get(version + (_SIZE,))
+            if size is None:
+                file, size = open_file(path)
+                self._put(path, version + (_SIZE,), size)
+            end = min(offset + length, size)
+            first = offset // self.block_size
+            parts = []
+            for number in range(first, (end - 1) // self.block_size + 1 if end > offset else first):
+                block = self._get(version + (number,))
+                if block is None:
+                    if file is None:
+                        file, _ = open_file(path)
+                    file.seek(number * self.block_size)
+                    block = file.read(self.block_size)
+                    self._put(path, version + (number,), block)
+                parts.append(block)
+        finally:
+            if file is not None:
+                file.close()
+        start = offset - first * self.block_size
+        return b"".join(parts)[start:start + end - offset], size
+
+    def _get(self, key):
+        with self._lock:
+            value = self.blocks.get(key)
+            if value is None:
+                self.misses += key[3] != _SIZE
+                return None
+            self.hits += key[3] != _SIZE
+            self.blocks.move_to_end(key)
+            return value
+
+    def _put(self, path, key, value):
+        charge = _charge(key, value)
+        if charge > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = value
+            self.paths.setdefault(path, set()).add(key)
+            self.bytes += charge
+            while self.bytes > self.max_bytes:
+                old_key, old_value = self.blocks.popitem(last=False)
+                keys = self.paths[old_key[0]]
+                keys.discard(old_key)
+                if not keys:
+                    del self.paths[old_key[0]]
+                self.bytes -= _charge(old_key, old_value)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Drops the blocks of a file, after it was written to."""
+        with self._lock:
+            for key in self.paths.pop(path, ()):
+                self.bytes -= _charge(key, self.blocks.pop(key))
+
+    def invalidate_tree(self, path):
+        """Drops the blocks of a file or of every file below a folder, after it was moved or deleted."""
+        prefix = os.path.join(os.path.normpath(path), "")
+        with self._lock:
+            # The files are cached by the path they were read with,
+            # which may not be normalized
+            for cached in [cached for cached in self.paths
+                           if os.path.join(os.path.normpath(cached), "").startswith(prefix)]:
+                for key in self.paths.pop(cached):
+                    self.bytes -= _charge(key, self.blocks.pop(key))
+
+    def counters(self):
+        """
+        Returns
+        -------
+        dict
+            The hits, misses, hit ratio, evictions and size of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"block_cache_hits": self.hits,
+                    "block_cache_misses": self.misses,
+                    "block_cache_hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                    "block_cache_evictions": self.evictions,
+                    "block_cache_bytes": self.bytes}
+
+
+def _charge(key, value):
+    """Returns the bytes a cache entry counts for."""
+    return _SIZE_ENTRY_BYTES if key[3] == _SIZE else len(value)
@@ -0,0 +1,411 @@
+"""
+This program stores the content of the files as chunks named by their
+SHA-256 digest, so content shared by several files or users is kept on
+disk once. A file under Root/ then only holds a small manifest listing
+its chunks.
+"""
+
+import bisect
+import contextlib
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import threading
+import fileformat
+
+CHUNK_STORE_DIR = "ChunkStore"
+CHUNK_SIZE = 256 * 1024
+MANIFEST_MAGIC = b"FMSDEDUP1\n"
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+class ChunkStore:
+    """
+
+    Content-addressed store of file chunks. Chunks are written once,
+    to a temporary name renamed into place, so concurrent writers of
+    the same content, even in other processes, never see a partial
+    chunk. Manifests are marked as such with fileformat, never told
+    apart by their content, and start with MANIFEST_MAGIC, followed by
+    the size of the file and one "<digest> <length>" line per chunk;
+    files without the mark are plain files written before the store was
+    enabled, and keep being read and appended to as they are.
+
+    Attributes
+    ----------
+    self.directory : str
+        Folder holding the chunks, in sub-folders named by the first
+        two hex digits of their digest
+    self.chunk_size : int
+        Largest chunk written
+    self.stored_chunks : int
+        Chunks written to disk by this process
+    self.deduplicated_chunks : int
+        Chunks which were already stored and not written again
+
+    Returns
+    -------
+    Object
+        ChunkStore Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, directory=CHUNK_STORE_DIR, chunk_size=CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.stored_chunks = 0
+        self.deduplicated_chunks = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if not fileformat.supported(directory):
+            raise OSError(errno.ENOTSUP, "The chunk store needs extended attributes", directory)
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        ChunkStore
+            The store used by all the connections of this process, or
+            None if files are stored as plain files
+        """
+        return cls._shared
+
+    @classmethod
+    def configure(cls, directory=CHUNK_STORE_DIR, chunk_size=CHUNK_SIZE):
+        """
+        Enables the shared store, e.g. with the settings given on the
+        server command line. A directory of None disables it.
+        """
+        with cls._shared_lock:
+            cls._shared = None if directory is None else cls(directory, chunk_size)
+            return cls._shared
+
+    def chunk_path(self, digest):
+        """
+        Returns the path of the chunk with the given digest.
+
+        Raises
+        ------
+        ValueError
+            If the digest is not a SHA-256 digest in lowercase hex
+        """
+        if not DIGEST.fullmatch(digest):
+            raise ValueError("Invalid chunk digest " + repr(digest))
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """
+        Stores one chunk unless the same content is already stored.
+
+        Returns
+        -------
+        str
+            Hex digest naming the chunk
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            with self._lock:
+                self.deduplicated_chunks += 1
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+        with self._lock:
+            self.stored_chunks += 1
+        return digest
+
+    def get(self, digest):
+        """Returns the content of a chunk."""
+        with open(self.chunk_path(digest), "rb") as file:
+            return file.read()
+
+    def read_manifest(self, path):
+        """
+        Returns
+        -------
+        list
+            The (digest, length) of the chunks of the file, or None if
+            it is a plain file
+
+        Raises
+        ------
+        FileNotFoundError, IsADirectoryError
+            If the path is not a file
+        ValueError
+            If the manifest is corrupt
+        """
+        with open(path, "rb") as file:
+            return self._parse_manifest(file)
+
+    @staticmethod
+    def _parse_manifest(file):
+        if fileformat.stored_format(file.fileno()) != fileformat.MANIFEST:
+            return None
+        if file.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            raise ValueError("Corrupt manifest " + file.name)
+        lines = file.read().split(b"\n")
+        entries = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            fields = line.split(b" ")
+            if len(fields) != 2 or not DIGEST.fullmatch(fields[0].decode(errors="replace")) \
+                    or not fields[1].isdigit():
+                raise ValueError("Corrupt manifest " + file.name)
+            entries.append((fields[0].decode(), int(fields[1])))
+        return entries
+
+    def write_manifest(self, path, entries):
+        """Replaces the manifest of a file in one rename."""
+        lines = [MANIFEST_MAGIC, str(sum(length for _, length in entries)).encode() + b"\n"]
+        lines += [digest.encode() + b" " + str(length).encode() + b"\n" for digest, length in entries]
+        temporary = path + ".manifest." + str(os.getpid()) + "." + str(threading.get_ident())
+        with open(temporary, "wb") as file:
+            file.write(b"".join(lines))
+            fileformat.mark(file.fileno(), fileformat.MANIFEST)
+        os.replace(temporary, path)
+
+    def logical_size(self, path, default):
+        """
+        Returns
+        -------
+        int
+            Size of the content of a manifest, or default for a plain file
+        """
+        try:
+            with open(path, "rb") as file:
+                if fileformat.stored_format(file.fileno()) != fileformat.MANIFEST:
+                    return default
+                head = file.read(len(MANIFEST_MAGIC) + 21)
+        except OSError:
+            return default
+        size = head[len(MANIFEST_MAGIC):].split(b"\n")[0]
+        if not head.startswith(MANIFEST_MAGIC) or not size.isdigit():
+            return default
+        return int(size)
+
+    def open_read(self, path):
+        """
+        Opens a file for reading, whether it is a manifest or a plain file.
+
+        Returns
+        -------
+        tuple
+            A ChunkedFile or the plain file opened in binary mode, and
+            the size of the content
+
+        Raises
+        ------
+        FileNotFoundError, IsADirectoryError
+            If the path is not a file
+        ValueError
+            If the manifest is corrupt
+        """
+        file = open(path, "rb")
+        try:
+            entries = self._parse_manifest(file)
+        except ValueError:
+            file.close()
+            raise
+        if entries is None:
+            file.seek(0)
+            return file, os.fstat(file.fileno()).st_size
+        file.close()
+        chunked = ChunkedFile(self, entries)
+        return chunked, chunked.size
+
+    def open_append(self, path):
+        """
+        Opens a file for appending. New files are created as empty
+        manifests, plain files are appended to in place.
+
+        Returns
+        -------
+        tuple
+            A ChunkWriter or the plain file opened for appending, and
+            True if the file did not exist before
+
+        Raises
+        ------
+        IsADirectoryError
+            If the path is a folder
+        """
+        try:
+            descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            with open(path, "rb") as file:
+                if self._parse_manifest(file) is None:
+                    return open(path, "ab"), False
+            return ChunkWriter(self, path), False
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(MANIFEST_MAGIC + b"0\n")
+            fileformat.mark(file.fileno(), fileformat.MANIFEST)
+        return ChunkWriter(self, path), True
+
+    def commit(self, path, entries, tail):
+        """
+        Appends chunks to the manifest of a file, under a lock on its
+        folder so appends from several connections are not lost. A
+        short tail is merged into the last chunk of the file when both
+        fit in one chunk, so many small appends do not make many
+        small chunks.
+
+        Parameters
+        ----------
+        path : str
+            Manifest to append to
+        entries : list
+            (digest, length) of the chunks already stored
+        tail : bytes
+            Remaining content, shorter than a chunk
+        """
+        with self._folder_lock(os.path.dirname(path)):
+            try:
+                existing = self.read_manifest(path) or []
+            except FileNotFoundError:
+                existing = []
+            if tail and not entries and existing and existing[-1][1] + len(tail) <= self.chunk_size:
+                tail = self.get(existing.pop()[0]) + tail
+            if tail:
+                entries = entries + [(self.put(tail), len(tail))]
+            self.write_manifest(path, existing + entries)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _folder_lock(folder):
+        descriptor = os.open(folder or ".", os.O_RDONLY)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(descriptor)
+
+
+class ChunkWriter:
+    """
+
+    File-like object appending to a manifest. Full chunks are stored
+    as soon as they are complete, the manifest is only rewritten on
+    close.
+
+    Attributes
+    ----------
+    self.store : ChunkStore
+        Store receiving the chunks
+    self.path : str
+        Manifest appended to
+    self.entries : list
+        (digest, length) of the chunks stored so far
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.entries = []
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        """Appends data, storing every chunk it completes."""
+        size = self.store.chunk_size
+        view = memoryview(data)
+        if self.buffer:
+            needed = size - len(self.buffer)
+            self.buffer += view[:needed]
+            view = view[needed:]
+            if len(self.buffer) < size:
+                return len(data)
+            self.entries.append((self.store.put(bytes(self.buffer)), size))
+            self.buffer = bytearray()
+        while len(view) >= size:
+            self.entries.append((self.store.put(view[:size]), size))
+            view = view[size:]
+        self.buffer += view
+        return len(data)
+
+    def flush(self):
+        """Nothing to flush, the chunks are written as they fill."""
+
+    def close(self):
+        """Stores the last chunk and appends the chunks to the manifest."""
+        if self.closed:
+            return
+        self.closed = True
+        self.store.commit(self.path, self.entries, bytes(self.buffer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChunkedFile:
+    """
+
+    Read-only file-like view of the content listed by a manifest.
+
+    Attributes
+    ----------
+    self.size : int
+        Size of the content
+    self.position : int
+        Offset of the next read
+    """
+
+    def __init__(self, store, entries):
+        self.store = store
+        self.entries = entries
+        self.starts = []
+        offset = 0
+        for _, length in entries:
+            self.starts.append(offset)
+            offset += length
+        self.size = offset
+        self.position = 0
+
+    def seek(self, offset):
+        """Moves the position of the next read."""
+        self.position = offset
+        return offset
+
+    def read(self, size=-1):
+        """Reads at most size bytes from the position."""
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        parts = []
+        index = bisect.bisect_right(self.starts, self.position) - 1
+        while self.position < end:
+            digest, length = self.entries[index]
+            inner = self.position - self.starts[index]
+            wanted = min(length - inner, end - self.position)
+            with open(self.store.chunk_path(digest), "rb") as chunk:
+                chunk.seek(inner)
+                parts.append(chunk.read(wanted))
+            self.position += wanted
+            index += 1
+        return b"".join(parts)
+
+    def parts(self):
+        """
+        Yields the chunk files making up the content, opened in binary
+        mode, so they can be sent with sendfile one after the other.
+        """
+        for digest, _ in self.entries:
+            yield open(self.store.chunk_path(digest), "rb")
+
+    def close(self):
+        """Nothing to close, chunks are opened for each read."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -5,9 +5,45 @@ After the connection has been established the
 user commands are executed as per the CommandHandler class
 --------
 The connection is closed based on the user request
+--------
+Usage: python client.py <ip>:<port>
+upload <local path> sends a local file to the current folder,
+download <file_name> saves a file in the current local folder
+--------
+The commands are sent through the fmsclient library, which scripts
+should use directly to send many commands or transfers at once
 '''
 import asyncio
+import os
 import sys
+import fmsclient
+
+def print_chunk(chunk):
+    '''
+    This function prints a chunk of a streamed file as it arrives
+    '''
+    sys.stdout.write(chunk.decode(errors="replace"))
+
+async def run_command(connection, message):
+    '''
+    This function sends one command typed by the user and prints its reply
+    '''
+    words = message.split(" ")
+    if words[0] == "upload" and len(words) == 2:
+        if not os.path.isfile(words[1]):
+            return "No such local file " + words[1]
+        return await connection.upload(words[1])
+    if words[0] == "download" and len(words) == 2:
+        size = await connection.download(words[1])
+        return "\nDownloaded " + words[1] + " " + str(size) + " bytes"
+    if words[0] == "stream_file":
+        reply = await connection.request(message, kind=fmsclient.STREAM, sink=print_chunk)
+        print()
+        return reply
+    if words[0] in ("tree", "copy", "move", "delete"):
+        reply = await connection.request(message, kind=fmsclient.PROGRESS, sink=print_chunk)
+        return reply.rstrip("\n")
+    return await connection.request(message)
 
 async def tcp_client():
     '''
@@ -15,22 +51,24 @@ async def tcp_client():
     '''
     ip = sys.argv[1].split(":")[0]
     port = int(sys.argv[1].split(":")[1])
-    
-    reader, writer = await asyncio.open_connection(
-        ip, port)
+
+    connection = await fmsclient.connect(ip, port)
     message = ''
     while True:
         message = input("$")
         if message == "":
             print("$")
             continue
-
-        writer.write(message.encode())
-        data = await reader.read(4096)
-        print(f"{data.decode()}")
+        try:
+            print(await run_command(connection, message))
+        except fmsclient.ClientError as error:
+            print(error)
+            if connection.error is not None:
+                break
         if message.lower() == "quit":
             break
     print('Close the connection')
-    writer.close()
+    await connection.close()
 
-asyncio.run(tcp_client())
+if __name__ == "__main__":
+    asyncio.run(tcp_client())
@@ -4,9 +4,205 @@ passed by the client to server.
 """
 
 
+import functools
 import os
-import time
-import pandas
+import treeops
+from blockcache import BlockCache
+from chunkstore import ChunkStore, ChunkWriter
+from compression import Compression, CODECS, NO_COMPRESSION
+from dircache import DirectoryCache, decode_cursor, encode_cursor
+from metaindex import MetadataIndex, FIND_LIMIT, logical_size
+from metrics import timed
+from transfers import PartialUpload, MAX_RANGE, checksum, file_version, range_digest
+from userstore import UserStore
+
+STREAM_CHUNK_SIZE = 64 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_FSYNC_BYTES = 0
+LIST_PAGE_SIZE = 100
+MAX_READ_CURSORS = 64
+
+
+def _read_chunks(file, chunk_size):
+    """
+    Yields the content of an open file in chunks and closes it
+    once the end of the file is reached.
+    """
+    with file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _in_current_path(nones=0):
+    """
+    Decorator of the commands working in the current path, which
+    another session of the same user may have moved or deleted. The
+    FileNotFoundError of such a command then sends the session back to
+    the folder of the user and is replied to, rather than dropping the
+    connection.
+
+    Parameters
+    ----------
+    nones : int
+        Number of None following the reply in what the command
+        returns, e.g. 1 for the commands replying with a tuple of the
+        reply and a file
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            except FileNotFoundError:
+                if not self.is_login or os.path.isdir(self.current_dir):
+                    raise
+            lost = self.current_dir
+            self.current_dir = CommandHandler.ROOT_DIR + self.user_id
+            self.read_index.clear()
+            reply = "\nThe folder " + lost + " was moved or deleted, moved back to folder " \
+                + self.current_dir
+            return (reply,) + (None,) * nones if nones else reply
+        return wrapper
+    return decorate
+
+
+class FileUpload:
+    """
+
+    Writes an upload to disk chunk by chunk as it arrives from the
+    socket. With fsync_bytes set the file is flushed to the disk every
+    time that many bytes were written, and once more when it is closed.
+
+    Attributes
+    ----------
+    self.file :
+        File opened for appending in binary mode
+    self.filename : str
+        Name of the uploaded file
+    self.size : int
+        Number of bytes announced by the client
+    self.created : bool
+        True if the upload created the file
+    self.written : int
+        Number of bytes written so far
+
+    Returns
+    -------
+    Object
+        FileUpload Object
+    """
+
+    def __init__(self, file, filename, size, created, fsync_bytes=None, on_close=None):
+        self.file = file
+        self.on_close = on_close
+        self.filename = filename
+        self.size = size
+        self.created = created
+        self.written = 0
+        self.fsync_bytes = UPLOAD_FSYNC_BYTES if fsync_bytes is None else fsync_bytes
+        self.unsynced = 0
+
+    def write(self, chunk):
+        """Appends one chunk to the file."""
+        self.file.write(chunk)
+        self.written += len(chunk)
+        self.unsynced += len(chunk)
+        if self.fsync_bytes and self.unsynced >= self.fsync_bytes:
+            self.sync()
+
+    def sync(self):
+        """Flushes the written chunks to the disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        """
+        Closes the file.
+
+        Returns
+        -------
+        str
+            Uploaded <size> bytes to file <filename> successfully
+        """
+        if self.fsync_bytes and self.unsynced:
+            self.sync()
+        self.file.close()
+        if self.on_close is not None:
+            self.on_close()
+        if self.written != self.size:
+            return "\nUpload of " + self.filename + " incomplete, received " + str(self.written) + " of " + str(self.size) + " bytes"
+        if self.created:
+            return "\nCreated and uploaded " + str(self.size) + " bytes to file " + self.filename + " successfully"
+        return "\nSuccess Uploaded " + str(self.size) + " bytes to file " + self.filename + " successfully"
+
+
+class RangeUpload:
+    """
+
+    Writes one range of a ranged upload at its offset in the staged
+    file as it arrives from the socket, and records it as received if
+    it is complete and matches its checksum.
+
+    Attributes
+    ----------
+    self.partial : PartialUpload
+        Staging folder of the upload
+    self.filename : str
+        Name of the uploaded file
+    self.offset : int
+        Offset of the range
+    self.length : int
+        Length of the range
+    self.expected : str
+        Hex digest the client computed for the range
+    self.written : int
+        Number of bytes written so far
+
+    Returns
+    -------
+    Object
+        RangeUpload Object
+    """
+
+    def __init__(self, partial, filename, offset, length, expected):
+        self.partial = partial
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+        self.expected = expected
+        self.written = 0
+        self.digest = checksum()
+        self.descriptor = partial.open_range()
+
+    def write(self, chunk):
+        """Writes one chunk after the previous ones."""
+        chunk = chunk[:self.length - self.written]
+        os.pwrite(self.descriptor, chunk, self.offset + self.written)
+        self.digest.update(chunk)
+        self.written += len(chunk)
+
+    def close(self):
+        """
+        Closes the staged file.
+
+        Returns
+        -------
+        str
+            Received <filename> <offset> <length> if the range is
+            complete and intact
+        """
+        os.close(self.descriptor)
+        where = self.filename + " " + str(self.offset) + " " + str(self.length)
+        if self.written != self.length:
+            return "\nRange " + where + " incomplete, received " + str(self.written) + " bytes"
+        if self.digest.hexdigest() != self.expected:
+            return "\nChecksum mismatch for range " + where
+        self.partial.mark(self.offset, self.length)
+        return "\nReceived " + where
 
 
 class CommandHandler:
@@ -15,16 +211,29 @@ class CommandHandler:
     Handles all the commands received from the client.
     Acts as helper program to the server.
 
+    One is made per connection, so it keeps only the state of the
+    session, in slots: the user, the current path and at most
+    MAX_READ_CURSORS read positions. The stores shared by every
+    connection are referenced, never copied.
+
     Attributes
     ----------
     self.user_id :
         Username of registered user
     self.is_login :
         Login Status of the user
-    self.registered_users :
-        Container which stores usernames of registered users
-    self.logged_in_users : list
-        Container which stores usernames of logged in users
+    self.user_store : UserStore
+        Registered users and logged in sessions shared by all connections
+    self.directory_cache : DirectoryCache
+        Folder listings shared by all connections
+    self.block_cache : BlockCache
+        Blocks of the files read, shared by all connections
+    self.metadata_index : MetadataIndex
+        Index of the files and folders of every user, shared by all
+        connections
+    self.read_index : dict
+        Maps the files last read without an offset to the window read
+        next, least recently read first
 
     Returns
     -------
@@ -33,33 +242,33 @@ class CommandHandler:
     """
 
     ROOT_DIR = "Root/"
-    REGISTERED_USERS_CSV_FILE = "AccessSession/registered_users.csv"
-    LOGGED_IN_USERS_CSV_FILE = "AccessSession/logged_in_users.csv"
-    CSV_HEADING = "username,password\n"
+    __slots__ = ("user_id", "is_login", "user_store", "directory_cache", "block_cache",
+                 "metadata_index", "current_dir", "read_index", "char_count")
 
-    def __init__(self):
+    def __init__(self, user_store=None):
         """
         Parameters
         ----------
+        user_store : UserStore
+            Store of registered users and sessions, by default the
+            store shared by the whole process
         self.user_id : str
             Username of registered user
         self.is_login : bool
             Login status of the user
-        self.registered_users : list
-            Container which stores usernames of registered users
-        self.logged_in_users : list
-            Container which stores usernames of logged in users
         self.current_dir : str
             Current Directory Path of the user, by default this is set
             to Root/
         self.char_count : int
-            Number of characters should be read each time read_file()
-            method is invoked.
+            Number of bytes should be read each time read_file()
+            method is invoked without a length.
         """
         self.user_id = ""
         self.is_login = None
-        self.registered_users = None
-        self.logged_in_users = None
+        self.user_store = user_store if user_store is not None else UserStore.shared()
+        self.directory_cache = DirectoryCache.shared()
+        self.block_cache = BlockCache.shared()
+        self.metadata_index = MetadataIndex.shared()
         self.current_dir = CommandHandler.ROOT_DIR
         self.read_index = {}
         self.char_count = 100
@@ -82,35 +291,66 @@ class CommandHandler:
                     command:quit\n""",
                     """change_folder : To change the current path,
                     command:change_folder <name>\n""",
-                    """list : Lists all files in the current path,
-                    command:list\n""",
+                    """list : Lists the files in the current path, a page at a time,
+                    command:list [cursor] [limit]\n""",
                     """read_file : To read content from the file,
-                    command:read_file <name>\n""",
+                    command:read_file <name> [offset] [length]\n""",
+                    """stream_file : To receive the whole file in chunks,
+                    command:stream_file <name>\n""",
+                    """download : To save the whole file locally,
+                    command:download <name>\n""",
                     """write_file : To write content into the file,
                     command:write_file <name> <content>\n""",
+                    """upload : To send <size> bytes of content into the file,
+                    command:upload <name> <size>\n""",
                     """create_folder : To create new folder,
-                    command:create_folder <name>\n"""
+                    command:create_folder <name>\n""",
+                    """stats : Shows the command counts, latencies and traffic of the server,
+                    command:stats\n""",
+                    """set_compression : To store the new files of the current folder compressed,
+                    command:set_compression <zlib|lzma|none>\n""",
+                    """upload_begin : To start or resume an upload sent in ranges,
+                    command:upload_begin <name> <size>\n""",
+                    """upload_range : To send <length> bytes of an upload from <offset>,
+                    command:upload_range <name> <offset> <length> <sha256>\n""",
+                    """upload_commit : To replace the file with the upload once complete,
+                    command:upload_commit <name>\n""",
+                    """download_range : To save <length> bytes of the file from <offset> locally,
+                    command:download_range <name> <offset> <length>\n""",
+                    """find : Lists the files and folders below the current path whose name matches,
+                    command:find <pattern> [limit]\n""",
+                    """du : Shows the bytes, files and folders below the current path or a folder,
+                    command:du [folder]\n""",
+                    """quota : Shows the bytes stored by the user and the most allowed,
+                    command:quota\n""",
+                    """batch : To run many create_folder, change_folder, write_file, read_file
+                    and list commands at once, replying with a JSON list of their replies,
+                    command:batch <json list of commands>\n""",
+                    """watch : To be sent the files created, modified and deleted in the current
+                    path or a folder as they change, until unwatch or the end of the session,
+                    command:watch [folder]\n""",
+                    """unwatch : To stop watching the current path or a folder,
+                    command:unwatch [folder]\n""",
+                    """tree : Lists the files and folders below the current path or a folder,
+                    command:tree [folder]\n""",
+                    """copy : To copy a file or a folder and everything below it,
+                    command:copy <name> <new name>\n""",
+                    """move : To move or rename a file or a folder,
+                    command:move <name> <new name>\n""",
+                    """delete : To delete a file or an empty folder, with -r a folder and everything below it,
+                    command:delete [-r] <name>\n"""
                 ]
 
         return "".join(commands)
 
     def access_user_info(self):
         """
-        Helper method
+        Helper method, loads the shared user store on first use.
         """
-        if not os.path.exists("AccessSession"):
-            os.mkdir("AccessSession")
-
-        if not os.path.isfile(CommandHandler.REGISTERED_USERS_CSV_FILE):
-            with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "w") as writer:
-                writer.write(CommandHandler.CSV_HEADING)
-        if not os.path.isfile(CommandHandler.LOGGED_IN_USERS_CSV_FILE):
-            with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "w") as writer:
-                writer.write(CommandHandler.CSV_HEADING)
-        self.logged_in_users = pandas.read_csv(CommandHandler.LOGGED_IN_USERS_CSV_FILE)
-        self.registered_users = pandas.read_csv(CommandHandler.REGISTERED_USERS_CSV_FILE)
+        self.user_store.load()
 
 
+    @timed
     def register(self, user_id, password):
         """
         Registers a new user. The password length specified by the 
@@ -129,18 +369,19 @@ class CommandHandler:
             Success! Registered <username>
         """
         self.access_user_info()
-        if user_id in self.registered_users['username'].tolist():
+        if self.user_store.is_registered(user_id):
             return "\nUsername not available"
         if len(password) < 8:
             return "\n Password length should be more than 8 characters."
-        with open(CommandHandler.REGISTERED_USERS_CSV_FILE, "a") as writer:
-            writer.write(user_id+","+password+"\n")
+        if not self.user_store.add_user(user_id, password):
+            return "\nUsername not available"
         if not os.path.exists(self.current_dir):
             os.mkdir(self.current_dir)
         os.mkdir(os.path.join(self.current_dir, user_id))
         self.user_id = user_id
         return "\nSuccess! Registered " + self.user_id
 
+    @timed
     def login(self, user_id, password):
         """
         Allow the user to login to the system
@@ -162,12 +403,11 @@ class CommandHandler:
         self.access_user_info()
         if self.is_login:
             return "\nAlready logged in"
-        if user_id not in self.registered_users['username'].tolist():
-           # print (self.registered_users)
+        if not self.user_store.is_registered(user_id):
             return "\nYou haven't registered! command: register <username> <password>"
-        if password not in self.registered_users['password'].tolist() and user_id in self.registered_users['username'].tolist():
+        if not self.user_store.check_password(user_id, password):
             return "\nSorry, The password you entered is wrong. Please Try Again"
-        if user_id in self.logged_in_users['username'].tolist():
+        if self.user_store.is_logged_in(user_id):
             self.is_login = True
             self.user_id = user_id
             self.current_dir = self.current_dir + self.user_id
@@ -176,10 +416,10 @@ class CommandHandler:
         self.is_login = True
         self.user_id = user_id
         self.current_dir = self.current_dir + self.user_id
-        with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "a") as writer:
-            writer.write(user_id + "," + password + "\n")
+        self.user_store.start_session(user_id)
         return "Success " + self.user_id + " Logged into the system"
 
+    @timed
     def quit(self):
         """
         Quits the client program. 
@@ -189,22 +429,17 @@ class CommandHandler:
         str
             Logged Out     
         """
-        
-        try:
-            self.access_user_info()
-            with open(CommandHandler.LOGGED_IN_USERS_CSV_FILE, "w") as file:
-                file.write(CommandHandler.CSV_HEADING)
-                user_ids = self.logged_in_users['username'].tolist()
-                passwords = self.logged_in_users['password'].tolist()
-                for index, user_id in enumerate(user_ids):
-                    if self.user_id != str(user_id):
-                        file.write(user_id +","+passwords[index])
-            self.is_login = False
-            self.user_id = ""
-            return "\nLogged Out"
-        except KeyError:
-            return "\nForced Logged Out through Keyboard Interruption (CTRL-C)"
 
+        self.access_user_info()
+        self.user_store.end_session(self.user_id)
+        self.is_login = False
+        self.user_id = ""
+        self.current_dir = CommandHandler.ROOT_DIR
+        self.read_index.clear()
+        return "\nLogged Out"
+
+    @timed
+    @_in_current_path()
     def create_folder(self, folder):
         """
         Creates a new folder as specified by the 
@@ -223,14 +458,16 @@ class CommandHandler:
 
         if not self.is_login:
             return "\nLogin to continue"
-        self.access_user_info()
         path = os.path.join(self.current_dir)
         try:
             os.mkdir(os.path.join(path, folder))
         except FileExistsError:
             return "\nThe folder already exists!"
+        self._written(os.path.join(path, folder))
         return "\nSuccessfully created folder " + folder
 
+    @timed
+    @_in_current_path()
     def change_folder(self, folder):
         """
         Change the current path to the path specified by the logged in 
@@ -250,7 +487,6 @@ class CommandHandler:
         if not self.is_login:
             return "\nLogin to continue"
 
-        self.access_user_info()
         if folder == ".." and self.current_dir != CommandHandler.ROOT_DIR + self.user_id:
             self.current_dir = os.path.dirname(os.path.join(self.current_dir))
             return "\nSuccessfully moved to folder " + self.current_dir
@@ -264,6 +500,8 @@ class CommandHandler:
         return "\n No such folder exists"
 
     
+    @timed
+    @_in_current_path()
     def write_file(self, filename, data):
         """
         Creates a new file and write content to the created file by the logged in user. 
@@ -273,8 +511,8 @@ class CommandHandler:
         ----------
         filename : str
             Name of the name to which content to be written
-        data : str
-            Content to be written to a file
+        data : str or bytes
+            Content to be written to a file, bytes are written as they are
 
         Returns
         -------
@@ -282,86 +520,805 @@ class CommandHandler:
             Created and Written data to file <filename> successfully
         """
 
-        self.access_user_info()
         if not self.is_login:
             return "\nLogin to Continue"
-        t_file = []
-        for file in os.listdir(os.path.join(self.current_dir)):
-            if os.path.isfile(os.path.join(self.current_dir, file)):
-                t_file.append(file)
-            
-        writeable_data = ""
-        path = os.path.join(self.current_dir, filename)
-        for i in data:
-            writeable_data += i
-        if filename in t_file:
-            with open(path, "a+") as file:
-                file.write(writeable_data)
+        if not isinstance(data, bytes):
+            data = data.encode()
+        if self.metadata_index.over_quota(self.user_id, len(data)):
+            return self._quota_exceeded(filename)
+        try:
+            file, created = self._open_append(filename)
+        except IsADirectoryError:
+            return "\nCannot write to folder " + filename
+        with file:
+            file.write(data)
+        self._written(os.path.join(self.current_dir, filename))
+        if not created:
             return "\nSuccess Written data to file " + filename + " successfully"
-        with open(path, "w+") as file:
-            file.write(writeable_data)
         return "\nCreated and written data to file " + filename + " successfully"
 
-    def read_file(self, filename):
+    @timed
+    @_in_current_path(nones=1)
+    def upload(self, filename, size):
+        """
+        Opens the file specified by the logged in user to receive an
+        upload of size bytes. As with write_file the content is appended
+        if the file already exists.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be written
+        size : int
+            Number of bytes which will be uploaded
+
+        Returns
+        -------
+        tuple
+            Error message or None, and the FileUpload receiving the
+            content or None if the file cannot be written
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        if self.metadata_index.over_quota(self.user_id, size):
+            return self._quota_exceeded(filename), None
+        try:
+            file, created = self._open_append(filename)
+        except IsADirectoryError:
+            return "\nCannot write to folder " + filename, None
+        path = os.path.join(self.current_dir, filename)
+        self._written(path)
+        # Chunks are complete once renamed into the store, there is no
+        # open file to flush to the disk
+        fsync_bytes = 0 if isinstance(file, ChunkWriter) else None
+        return None, FileUpload(file, filename, size, created, fsync_bytes,
+                                on_close=functools.partial(self._written, path))
+
+    def _written(self, path):
+        """Drops the cached listing of the folder and blocks of a written
+        file or created folder, and brings its entry in the index up to date."""
+        self.directory_cache.invalidate(os.path.dirname(path))
+        self.block_cache.invalidate(path)
+        self.metadata_index.record(self.user_id, self._index_path(path), path)
+
+    def _index_path(self, path):
+        """Returns the path of an entry relative to the folder of the user, as the index keeps it."""
+        path = os.path.relpath(path, CommandHandler.ROOT_DIR + self.user_id)
+        return "" if path == os.curdir else path.replace(os.sep, "/")
+
+    def _quota_exceeded(self, filename):
+        """Returns the reply refusing a write which would take the user beyond the quota."""
+        return "\nCannot write to file " + filename + ", the quota of " \
+            + str(self.metadata_index.quota_bytes) + " bytes would be exceeded"
+
+    def _open_append(self, filename):
+        """
+        Opens a file for appending in binary mode. The open flags tell
+        whether the file was created, without listing the folder. With
+        the chunk store enabled the content goes to the store, else it
+        is compressed if the file or its folder is.
+
+        Returns
+        -------
+        tuple
+            The open file, and True if the file did not exist before
+        """
+        path = os.path.join(self.current_dir, filename)
+        store = ChunkStore.shared()
+        if store is not None:
+            return store.open_append(path)
+        try:
+            descriptor = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o666)
+            created = True
+        except FileExistsError:
+            descriptor = os.open(path, os.O_RDWR | os.O_APPEND)
+            created = False
+        root = CommandHandler.ROOT_DIR + self.user_id
+        return Compression.shared().open_append(descriptor, path, created, root), created
+
+    def _create_stored(self, path):
+        """Creates a file, which must not exist yet, and returns the file
+        object storing its content as write_file would: through the
+        chunk store if it is enabled, else compressed if its folder is."""
+        store = ChunkStore.shared()
+        if store is not None:
+            return store.open_append(path)[0]
+        descriptor = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o666)
+        root = CommandHandler.ROOT_DIR + self.user_id
+        return Compression.shared().open_append(descriptor, path, True, root)
+
+    @staticmethod
+    def _open_read(path):
+        """
+        Opens a file for reading in binary mode, through the chunk
+        store if it is enabled, decompressing it if it is compressed.
+
+        Returns
+        -------
+        tuple
+            The open file, and the size of its content
+        """
+        store = ChunkStore.shared()
+        if store is not None:
+            return store.open_read(path)
+        return Compression.shared().open_read(open(path, "rb"))
+
+    @timed
+    @_in_current_path()
+    def read_file(self, filename, offset=None, length=None):
         """
         Read the content from the file specified by the logged in user.
-        If the file path does not exist, it throws an error message 
+        Without an offset the next window of char_count bytes after the
+        previous read is returned, wrapping around at the end of the file;
+        the positions of the MAX_READ_CURSORS most recently read files are
+        kept. The window is read through the shared BlockCache.
+        If the file path does not exist, it throws an error message
         stating No Such file <filename> exists
 
         Parameters
         ----------
         filename : str
             Name of the file to be read
+        offset : int
+            Position of the first byte to read, by default the
+            position after the previous read
+        length : int
+            Number of bytes to read, by default char_count
 
         Returns
         -------
         str
             Read file from <old_index> to <current_index> are <content>
         """
-        self.access_user_info()
         if not self.is_login:
             return "\nLogin to Continue"
+        t_path = os.path.join(self.current_dir, filename)
+        if length is None:
+            length = self.char_count
+        index = None
+        if offset is None:
+            # Taken out and put back at the end, as the most recently read
+            index = self.read_index.pop(t_path, 0)
+            offset = index * self.char_count
         try:
-            t_path = os.path.join(self.current_dir, filename)
-            if t_path not in list(self.read_index.keys()):
-                self.read_index[t_path] = 0
-            with open(t_path, "r") as file:
-                content = file.read()
-            old_index = str(self.read_index[t_path]*self.char_count)
-            index = self.read_index[t_path]
-            data = content[index*self.char_count:(index+1)*self.char_count]
-            self.read_index[t_path] += 1
-            self.read_index[t_path] %= len(content) // self.char_count + 1
-            return "\n" + "Reading file from " + old_index + " bytes to " + str(int(old_index)+self.char_count) + " bytes\n"+ data
-        except FileNotFoundError:
-            "\nNo Such file " + filename + "exists!"
-        
-        
-    def list(self):
+            data, size = self.block_cache.read(t_path, offset, length, self._open_read)
+        except (FileNotFoundError, IsADirectoryError):
+            return "\nNo Such file " + filename + " exists!"
+        if index is not None:
+            self.read_index[t_path] = (index + 1) % (size // self.char_count + 1)
+            if len(self.read_index) > MAX_READ_CURSORS:
+                del self.read_index[next(iter(self.read_index))]
+        return "\n" + "Reading file from " + str(offset) + " bytes to " + str(offset+length) + " bytes\n"+ data.decode(errors="replace")
+
+    @timed
+    @_in_current_path(nones=1)
+    def stream_file(self, filename, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Opens the file specified by the logged in user for streaming
+        the whole content in chunks of chunk_size bytes.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be streamed
+        chunk_size : int
+            Number of bytes in each chunk
+
+        Returns
+        -------
+        tuple
+            Streaming <filename> <size> bytes, and an iterator over the
+            chunks of the file or None if the file cannot be streamed
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        try:
+            file, size = self._open_read(os.path.join(self.current_dir, filename))
+        except (FileNotFoundError, IsADirectoryError):
+            return "\nNo Such file " + filename + " exists!", None
+        return "\nStreaming " + filename + " " + str(size) + " bytes\n", _read_chunks(file, chunk_size)
+
+    @timed
+    @_in_current_path(nones=1)
+    def stream_compressed(self, filename, codecs):
+        """
+        Opens the file specified by the logged in user for streaming
+        its compressed blocks as they are stored, if it is compressed
+        with one of the codecs the client decompresses.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be streamed
+        codecs : tuple
+            Codecs the client decompresses
+
+        Returns
+        -------
+        tuple
+            Streaming <filename> <size> bytes, and an iterator over the
+            compressed blocks, or None if the file cannot be streamed
+            compressed
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        try:
+            file, size = self._open_read(os.path.join(self.current_dir, filename))
+        except (FileNotFoundError, IsADirectoryError):
+            return "\nNo Such file " + filename + " exists!", None
+        if getattr(file, "codec", None) not in codecs:
+            file.close()
+            return None, None
+        return "\nStreaming " + filename + " " + str(size) + " bytes\n", file.frames()
+
+    @timed
+    @_in_current_path(nones=1)
+    def download(self, filename):
+        """
+        Opens the file specified by the logged in user so the server
+        can send it straight from the file to the socket. The caller
+        owns the returned file and has to close it.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be downloaded
+
+        Returns
+        -------
+        tuple
+            Downloading <filename> <size> bytes, and the file opened in
+            binary mode, or a ChunkedFile from the chunk store, or None
+            if the file cannot be downloaded
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        try:
+            file, size = self._open_read(os.path.join(self.current_dir, filename))
+        except (FileNotFoundError, IsADirectoryError):
+            return "\nNo Such file " + filename + " exists!", None
+        return "\nDownloading " + filename + " " + str(size) + " bytes\n", file
+
+    @timed
+    @_in_current_path()
+    def upload_begin(self, filename, size):
+        """
+        Starts an upload of size bytes sent in ranges, possibly over
+        several connections, or resumes the one in progress.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be written
+        size : int
+            Size of the whole file
+
+        Returns
+        -------
+        str
+            Upload of <filename> <size> bytes has <count> ranges,
+            followed by a line "<offset> <length>" per range received
+        """
+        if not self.is_login:
+            return "\nLogin to Continue"
+        path = os.path.join(self.current_dir, filename)
+        if os.path.isdir(path):
+            return "\nCannot write to folder " + filename
+        if self.metadata_index.over_quota(self.user_id, size):
+            return self._quota_exceeded(filename)
+        ranges = PartialUpload(path).begin(size)
+        lines = ["\nUpload of " + filename + " " + str(size) + " bytes has "
+                 + str(len(ranges)) + " ranges"]
+        lines += [str(offset) + " " + str(length) for offset, length in ranges]
+        return "\n".join(lines)
+
+    @timed
+    @_in_current_path(nones=1)
+    def upload_range(self, filename, offset, length, digest):
+        """
+        Opens the upload of filename started by upload_begin to
+        receive length bytes from offset.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file being uploaded
+        offset : int
+            Offset of the range in the file
+        length : int
+            Number of bytes which will be uploaded, at most MAX_RANGE
+        digest : str
+            Hex sha256 digest of the range
+
+        Returns
+        -------
+        tuple
+            Error message or None, and the RangeUpload receiving the
+            content or None if the range cannot be written
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        partial = PartialUpload(os.path.join(self.current_dir, filename))
+        size = partial.size()
+        if size is None:
+            return "\nNo upload of " + filename + " in progress, send upload_begin first", None
+        if length > MAX_RANGE or offset + length > size:
+            return "\nRange " + str(offset) + " " + str(length) + " does not fit in " \
+                + filename + " of " + str(size) + " bytes", None
+        return None, RangeUpload(partial, filename, offset, length, digest)
+
+    @timed
+    @_in_current_path()
+    def upload_commit(self, filename):
+        """
+        Replaces the file with the ranges received, once they cover it.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file being uploaded
+
+        Returns
+        -------
+        str
+            Assembled <size> bytes to file <filename> successfully
+        """
+        if not self.is_login:
+            return "\nLogin to Continue"
+        path = os.path.join(self.current_dir, filename)
+        partial = PartialUpload(path)
+        if partial.size() is None:
+            return "\nNo upload of " + filename + " in progress, send upload_begin first"
+        root = CommandHandler.ROOT_DIR + self.user_id
+        open_stored = None
+        if ChunkStore.shared() is not None \
+                or Compression.shared().codec_for(os.path.dirname(path), root) is not None:
+            open_stored = self._create_stored
+        try:
+            size = partial.commit(open_stored)
+        except ValueError as error:
+            return "\nUpload of " + filename + " is missing " + str(error.args[0]) + " bytes"
+        except OSError as error:
+            # The ranges received are kept, the commit may be sent again
+            return "\nCannot commit upload of " + filename + ": " + str(error.strerror)
+        self._written(path)
+        return "\nAssembled " + str(size) + " bytes to file " + filename + " successfully"
+
+    @timed
+    @_in_current_path(nones=1)
+    def download_range(self, filename, offset, length):
+        """
+        Opens the file specified by the logged in user to send length
+        bytes of its content from offset, and checksums them. The
+        caller owns the returned file and has to close it.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file to be downloaded
+        offset : int
+            Offset of the range in the content
+        length : int
+            Number of bytes to send, at most MAX_RANGE, fewer at the
+            end of the file
+
+        Returns
+        -------
+        tuple
+            Range <filename> <offset> <length> <size> <version>
+            <sha256>, and the file or None if the range cannot be
+            downloaded
+        """
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        path = os.path.join(self.current_dir, filename)
+        try:
+            file, size = self._open_read(path)
+            version = file_version(path)
+        except (FileNotFoundError, IsADirectoryError):
+            return "\nNo Such file " + filename + " exists!", None
+        if offset > size:
+            file.close()
+            return "\nOffset " + str(offset) + " is beyond the " + str(size) \
+                + " bytes of " + filename, None
+        length = min(length, MAX_RANGE, size - offset)
+        digest = range_digest(file, offset, length)
+        return " ".join(["\nRange", filename, str(offset), str(length), str(size), version,
+                         digest]) + "\n", file
+
+    @timed
+    @_in_current_path()
+    def set_compression(self, codec):
+        """
+        Sets how the new files of the current folder and of its
+        sub-folders are stored: compressed with zlib or lzma, or
+        not compressed with none. Existing files keep their format.
+
+        Parameters
+        ----------
+        codec : str
+            zlib, lzma or none
+
+        Returns
+        -------
+        str
+            New files in <folder> are compressed with <codec>
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue"
+        if codec != NO_COMPRESSION and codec not in CODECS:
+            return "\nUnknown codec " + codec + ", use one of " + ", ".join(CODECS) + ", " + NO_COMPRESSION
+        Compression.set_folder_codec(self.current_dir, codec)
+        if codec == NO_COMPRESSION:
+            return "\nNew files in " + self.current_dir + " are not compressed"
+        return "\nNew files in " + self.current_dir + " are compressed with " + codec
+
+    @timed
+    @_in_current_path()
+    def list(self, cursor=None, limit=LIST_PAGE_SIZE):
         """
-        Lists out all the files and
-        folders in the user's current file path.
+        Lists out the files and folders in the user's current file
+        path, sorted by name, one page at a time. The listing comes
+        from the shared DirectoryCache, so repeated lists of the same
+        folder do not touch the disk.
+
+        Parameters
+        ----------
+        cursor : str
+            Cursor returned with the previous page, by default the
+            listing starts with the first entry
+        limit : int
+            Number of entries in the page
 
         Returns
         -------
         str
             File   | Size           | Modified Date
             <file> | <size_of_file> | <time_file_modified>
+            Next page: list <cursor> <limit>
         """
 
-        self.access_user_info()
         if not self.is_login:
             return "\nLogin to Continue!"
-        path = os.path.join(self.current_dir)
-        folders = []
         try:
-            for file_name in os.listdir(path):
-               file_stats = os.stat(os.path.join(path, file_name))
-               folders.append([file_name, str(file_stats.st_size), str(time.ctime(file_stats.st_ctime))])
-        except NotADirectoryError:
+            after = None if cursor is None else decode_cursor(cursor)
+        except ValueError:
+            return "\nInvalid cursor " + cursor
+        try:
+            folders, more = self.directory_cache.page(self.current_dir, after, limit)
+        except (NotADirectoryError, FileNotFoundError):
             return "\nNot A Directory"
-        details = "\nFile | Size | Modified Date"
+        details = ["\nFile | Size | Modified Date"]
         for folder in folders:
-            line = " | ".join([folder[0], folder[1], folder[2]]) + "\n"
-            details += "-----------------------\n" + line
-        return details
+            details.append("-----------------------\n" + " | ".join(folder) + "\n")
+        if more is not None:
+            details.append("Next page: list " + encode_cursor(more) + " " + str(limit) + "\n")
+        return "".join(details)
+
+    @timed
+    def find(self, pattern, limit=FIND_LIMIT):
+        """
+        Lists the files and folders below the user's current file path
+        whose name matches a pattern, looked up in the metadata index
+        rather than by walking the folders.
+
+        Parameters
+        ----------
+        pattern : str
+            Glob pattern matched against the names, e.g. *.txt
+        limit : int
+            Number of entries listed
+
+        Returns
+        -------
+        str
+            Path | Size
+            <path> | <size_of_file>
+            <path>/ | folder
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue"
+        folder = self._index_path(self.current_dir)
+        rows = self.metadata_index.find(self.user_id, folder, pattern, limit)
+        if not rows:
+            return "\nNo files or folders match " + pattern
+        start = len(folder) + 1 if folder else 0
+        details = ["\nPath | Size"]
+        for path, is_dir, size in rows[:limit]:
+            details.append(path[start:] + ("/ | folder" if is_dir else " | " + str(size)))
+        if len(rows) > limit:
+            details.append("More than " + str(limit) + " matches, showing the first ones")
+        return "\n".join(details)
+
+    @timed
+    @_in_current_path()
+    def du(self, folder=None):
+        """
+        Adds up the files and folders below the user's current file
+        path, or below one of its folders, from the metadata index.
+
+        Parameters
+        ----------
+        folder : str
+            Folder of the current path, by default the current path
+
+        Returns
+        -------
+        str
+            <bytes> bytes in <files> files and <folders> folders
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue"
+        path, index_path = self._folder(folder)
+        if path is None:
+            return "\n No such folder exists"
+        size, files, folders = self.metadata_index.usage(self.user_id, index_path)
+        return "\n" + str(size) + " bytes in " + str(files) + " files and " \
+            + str(folders) + " folders"
+
+    def _folder(self, folder):
+        """Returns the path of a folder of the current path, by default
+        the current path, and its path in the index, or None twice if it
+        is not an existing folder of the user."""
+        path, index_path = self._entry(os.curdir if folder is None else folder)
+        if path is None or not os.path.isdir(path):
+            return None, None
+        return path, index_path
+
+    def _entry(self, name):
+        """Returns the path of a file or folder of the current path and
+        its path in the index, or None twice if it is outside the folder
+        of the user. The entry may not exist."""
+        path = os.path.normpath(os.path.join(self.current_dir, name))
+        index_path = self._index_path(path)
+        if index_path.startswith(os.pardir):
+            return None, None
+        return path, index_path
+
+    @timed
+    @_in_current_path(nones=2)
+    def watch(self, folder=None):
+        """
+        Checks the folder a watch command asks to watch.
+
+        Parameters
+        ----------
+        folder : str
+            Folder of the current path, by default the current path
+
+        Returns
+        -------
+        tuple
+            The reply if the folder cannot be watched, else None, the
+            path of the folder and its path from the user's folder
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue", None, None
+        path, index_path = self._folder(folder)
+        if path is None:
+            return "\n No such folder exists", None, None
+        return None, path, index_path
+
+    @timed
+    def quota(self):
+        """
+        Returns
+        -------
+        str
+            Using <bytes> of <quota> bytes, in <files> files and
+            <folders> folders
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue"
+        size, files, folders = self.metadata_index.usage(self.user_id)
+        limit = self.metadata_index.quota_bytes
+        return "\nUsing " + str(size) + " of " + (str(limit) + " bytes" if limit else "unlimited bytes") \
+            + ", in " + str(files) + " files and " + str(folders) + " folders"
+
+    @timed
+    @_in_current_path(nones=1)
+    def tree(self, folder=None):
+        """
+        Lists the files and folders below the user's current file path,
+        or below one of its folders, walking them on disk.
+
+        Parameters
+        ----------
+        folder : str
+            Folder of the current path, by default the current path
+
+        Returns
+        -------
+        tuple
+            Running tree <folder>, and an iterator over the chunks of
+            lines "<path> | <size>" and "<path>/ | folder" ended by the
+            summary line, or None if the folder cannot be listed
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        path, _ = self._folder(folder)
+        if path is None:
+            return "\n No such folder exists", None
+        return "\nRunning tree " + (folder or os.curdir) + "\n", treeops.tree(path)
+
+    @timed
+    @_in_current_path(nones=1)
+    def copy(self, source, destination):
+        """
+        Copies a file, or a folder and everything below it, of the
+        user's current file path to a new name, on the server. The files
+        are copied as they are stored, compressed or as chunk manifests.
+
+        Parameters
+        ----------
+        source : str
+            File or folder to be copied
+        destination : str
+            Path of the copy, which must not exist yet
+
+        Returns
+        -------
+        tuple
+            Running copy <source> <destination>, and an iterator over
+            the progress lines ended by the summary line, or None if
+            the copy cannot run
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        source_path, source_index = self._source(source)
+        if source_path is None:
+            return "\nNo such file or folder " + source, None
+        destination_path, destination_index = self._entry(destination)
+        error = self._check_destination("copy", source, source_index, destination,
+                                        destination_path, destination_index)
+        if error is not None:
+            return error, None
+        if os.path.isdir(source_path):
+            size, files, _ = self.metadata_index.usage(self.user_id, source_index)
+        else:
+            size, files = logical_size(source_path, os.path.getsize(source_path)), 1
+        if self.metadata_index.over_quota(self.user_id, size):
+            return self._quota_exceeded(destination), None
+
+        def copied():
+            self._moved(destination_path)
+            self.metadata_index.record_tree(self.user_id, destination_index, destination_path)
+
+        return "\nRunning copy " + source + " " + destination + "\n", \
+            treeops.copy(source_path, destination_path, files, copied)
+
+    @timed
+    @_in_current_path(nones=1)
+    def move(self, source, destination):
+        """
+        Moves a file, or a folder and everything below it, of the
+        user's current file path to a new name, renaming it on disk.
+
+        Parameters
+        ----------
+        source : str
+            File or folder to be moved
+        destination : str
+            New path, which must not exist yet
+
+        Returns
+        -------
+        tuple
+            Running move <source> <destination>, and an iterator over
+            the progress lines ended by the summary line, or None if
+            the move cannot run
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        source_path, source_index = self._source(source)
+        if source_path is None:
+            return "\nNo such file or folder " + source, None
+        error = self._check_removable("move", source, source_index)
+        if error is not None:
+            return error, None
+        destination_path, destination_index = self._entry(destination)
+        error = self._check_destination("move", source, source_index, destination,
+                                        destination_path, destination_index)
+        if error is not None:
+            return error, None
+
+        def moved(renamed):
+            self._moved(source_path)
+            self._moved(destination_path)
+            if renamed:
+                self.metadata_index.move(self.user_id, source_index, destination_index)
+            else:
+                self.metadata_index.record_tree(self.user_id, source_index, source_path)
+                self.metadata_index.record_tree(self.user_id, destination_index, destination_path)
+
+        files = self.metadata_index.usage(self.user_id, source_index)[1] or 1
+        return "\nRunning move " + source + " " + destination + "\n", \
+            treeops.move(source_path, destination_path, files, moved)
+
+    @timed
+    @_in_current_path(nones=1)
+    def delete(self, name, recursive=False):
+        """
+        Deletes a file or an empty folder of the user's current file
+        path, or with recursive a folder and everything below it.
+
+        Parameters
+        ----------
+        name : str
+            File or folder to be deleted
+        recursive : bool
+            Whether a folder which is not empty is deleted
+
+        Returns
+        -------
+        tuple
+            Running delete <name>, and an iterator over the progress
+            lines ended by the summary line, or None if the delete
+            cannot run
+        """
+
+        if not self.is_login:
+            return "\nLogin to Continue", None
+        path, index_path = self._source(name)
+        if path is None:
+            return "\nNo such file or folder " + name, None
+        error = self._check_removable("delete", name, index_path)
+        if error is not None:
+            return error, None
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        if is_dir and not recursive and any(not treeops.hidden(entry) for entry in os.listdir(path)):
+            return "\nThe folder " + name + " is not empty, use delete -r " + name, None
+
+        def deleted():
+            self._moved(path)
+            self.metadata_index.record_tree(self.user_id, index_path, path)
+
+        files = self.metadata_index.usage(self.user_id, index_path)[1] if is_dir else 1
+        return "\nRunning delete " + name + "\n", treeops.delete(path, files, deleted)
+
+    def _source(self, name):
+        """Returns the path of an existing file or folder of the current
+        path and its path in the index, or None twice."""
+        path, index_path = self._entry(name)
+        if path is None or treeops.hidden(os.path.basename(path)) or not os.path.lexists(path):
+            return None, None
+        return path, index_path
+
+    def _check_removable(self, verb, name, index_path):
+        """Returns the reply refusing to move or delete the folder of the
+        user or a folder holding the current path, else None."""
+        if not index_path:
+            return "\nCannot " + verb + " the folder of the user"
+        current = self._index_path(self.current_dir)
+        if current == index_path or current.startswith(index_path + "/"):
+            return "\nCannot " + verb + " " + name + ", it holds the current path"
+        return None
+
+    @staticmethod
+    def _check_destination(verb, source, source_index, destination, path, index_path):
+        """Returns the reply refusing to copy or move source to a
+        destination which exists, is not in an existing folder of the
+        user or is below source, else None."""
+        if path is None or not index_path or not os.path.isdir(os.path.dirname(path)) \
+                or treeops.hidden(os.path.basename(path)):
+            return "\nCannot " + verb + " to " + destination + ", no such folder"
+        if os.path.lexists(path):
+            return "\nThe destination " + destination + " already exists"
+        if index_path.startswith(source_index + "/"):
+            return "\nCannot " + verb + " " + source + " into itself"
+        return None
+
+    def _moved(self, path):
+        """Drops the cached listings and blocks of a file or folder
+        whose whole tree was copied, moved or deleted."""
+        self.directory_cache.invalidate(os.path.dirname(path))
+        self.directory_cache.invalidate_tree(path)
+        self.block_cache.invalidate_tree(path)
@@ -0,0 +1,485 @@
+"""
+This program stores files compressed with zlib or lzma, in blocks
+which can be decompressed on their own, so a read at any offset only
+decompresses the blocks it covers.
+
+A compressed file starts with a header: MAGIC, the codec id, the block
+size and the size of the uncompressed content. Every block follows as
+its uncompressed and compressed lengths and the compressed bytes.
+Compressed files are marked as such with fileformat; files without the
+mark, or whose header does not hold together, are plain files and are
+read as they are, whatever their content starts with.
+"""
+
+import bisect
+import fcntl
+import lzma
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import fileformat
+
+MAGIC = b"FMSZ1"
+FILE_HEADER = struct.Struct("!5sBIQ")
+BLOCK_HEADER = struct.Struct("!II")
+BLOCK_SIZE = 64 * 1024
+COMPRESSION_FILE = ".compression"
+NO_COMPRESSION = "none"
+MAX_CACHED_INDEXES = 256
+
+# The default levels favour speed, compressing at disk speed rather
+# than squeezing out the last few percent
+DEFAULT_LEVELS = {"zlib": 1, "lzma": 1}
+CODECS = {
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "lzma": (2, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in CODECS.items()}
+
+
+def decompress_frame(payload):
+    """
+    Returns
+    -------
+    bytes
+        The content of a compressed block sent on the wire, one byte of
+        codec id followed by the compressed bytes
+
+    Raises
+    ------
+    ValueError
+        If the codec id is unknown or the bytes do not decompress
+    """
+    if not payload or payload[0] not in CODEC_NAMES:
+        raise ValueError("Unknown codec id in compressed frame")
+    try:
+        return CODECS[CODEC_NAMES[payload[0]]][2](payload[1:])
+    except (zlib.error, lzma.LZMAError) as error:
+        raise ValueError("Corrupt compressed frame: " + str(error)) from None
+
+
+def _parse_header(header):
+    """
+    Returns
+    -------
+    tuple
+        The codec, block size and content size of a compressed file
+        header, or None if it is not one
+    """
+    if len(header) < FILE_HEADER.size or not header.startswith(MAGIC):
+        return None
+    _, codec_id, block_size, size = FILE_HEADER.unpack(header[:FILE_HEADER.size])
+    if codec_id not in CODEC_NAMES or not block_size:
+        return None
+    return CODEC_NAMES[codec_id], block_size, size
+
+
+def _committed(index, size):
+    """Tells whether the size in a header ends on a block of the
+    index, as it does unless the file was damaged."""
+    if not size:
+        return True
+    # The blocks past the size, if any, are the last ones
+    for _, start, length, _ in reversed(index):
+        if start + length <= size:
+            return start + length == size
+    return False
+
+
+class Compression:
+    """
+
+    Compression settings of the server and index of the compressed
+    files. New files are compressed with the codec named in the
+    COMPRESSION_FILE of their folder or of the closest parent folder,
+    otherwise with the codec of the server. The block offsets of a
+    compressed file are found once by walking its block headers and
+    kept until the file changes.
+
+    Attributes
+    ----------
+    self.codec : str
+        Codec of the server, or None to store files as they are
+    self.level : int
+        Compression level, None for the level in DEFAULT_LEVELS
+    self.block_size : int
+        Size of the uncompressed blocks
+    self.indexes : OrderedDict
+        Maps the device and inode of a file to its modification time,
+        size and block index
+
+    Returns
+    -------
+    Object
+        Compression Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, codec=None, level=None, block_size=BLOCK_SIZE):
+        if codec is not None and codec not in CODECS:
+            raise ValueError("Unknown codec " + codec)
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        Compression
+            The settings used by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, codec=None, level=None, block_size=BLOCK_SIZE):
+        """
+        Replaces the shared settings, e.g. with the ones given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(codec, level, block_size)
+            return cls._shared
+
+    @staticmethod
+    def set_folder_codec(folder, codec):
+        """Sets the codec of the new files of a folder and its sub-folders."""
+        if codec != NO_COMPRESSION and codec not in CODECS:
+            raise ValueError("Unknown codec " + codec)
+        with open(os.path.join(folder, COMPRESSION_FILE), "w") as file:
+            file.write(codec)
+
+    def codec_for(self, folder, root):
+        """
+        Returns
+        -------
+        str
+            Codec of the new files of the folder, or None
+        """
+        folder = os.path.normpath(folder)
+        root = os.path.normpath(root)
+        while True:
+            try:
+                with open(os.path.join(folder, COMPRESSION_FILE)) as file:
+                    codec = file.read().strip()
+                return None if codec == NO_COMPRESSION else codec
+            except FileNotFoundError:
+                pass
+            if folder == root or not folder.startswith(root):
+                return self.codec
+            folder = os.path.dirname(folder)
+
+    def logical_size(self, path, default):
+        """
+        Returns
+        -------
+        int
+            Size of the uncompressed content of a compressed file, or
+            default for a plain file
+        """
+        if default < FILE_HEADER.size:
+            return default
+        try:
+            with open(path, "rb") as file:
+                if fileformat.stored_format(file.fileno()) != fileformat.COMPRESSED:
+                    return default
+                header = _parse_header(file.read(FILE_HEADER.size))
+        except OSError:
+            return default
+        return default if header is None else header[2]
+
+    def open_read(self, file):
+        """
+        Wraps a file opened in binary mode in a CompressedFile if it
+        is marked compressed and its header and blocks hold together.
+
+        Returns
+        -------
+        tuple
+            The CompressedFile or the file itself, and the size of the
+            content
+        """
+        header = None
+        if fileformat.stored_format(file.fileno()) == fileformat.COMPRESSED:
+            header = _parse_header(file.read(FILE_HEADER.size))
+        if header is not None:
+            codec, _, size = header
+            index = self.index(file)
+            if _committed(index, size):
+                return CompressedFile(file, codec, index, size), size
+        file.seek(0)
+        return file, os.fstat(file.fileno()).st_size
+
+    def open_append(self, descriptor, path, created, root):
+        """
+        Turns a descriptor opened for reading and appending into the
+        file object receiving the appended content: a CompressedWriter
+        if the file is compressed, or is new and its folder has a
+        codec, else the descriptor itself in binary append mode.
+
+        Parameters
+        ----------
+        descriptor : int
+            Descriptor of the file, opened with O_RDWR | O_APPEND
+        path : str
+            Path of the file
+        created : bool
+            True if the file was just created empty
+        root : str
+            Folder of the user, the last one searched for a codec
+
+        Returns
+        -------
+        file object
+            A CompressedWriter, or the file opened for appending
+        """
+        if created:
+            codec = self.codec_for(os.path.dirname(path), root)
+            if codec is None:
+                return os.fdopen(descriptor, "ab")
+            try:
+                fileformat.mark(descriptor, fileformat.COMPRESSED)
+            except OSError:
+                # Without extended attributes files are stored plain
+                return os.fdopen(descriptor, "ab")
+            os.write(descriptor, FILE_HEADER.pack(MAGIC, CODECS[codec][0], self.block_size, 0))
+        elif fileformat.stored_format(descriptor) != fileformat.COMPRESSED \
+                or _parse_header(os.pread(descriptor, FILE_HEADER.size, 0)) is None:
+            return os.fdopen(descriptor, "ab")
+        os.close(descriptor)
+        # Compressed files are appended to after their last committed
+        # block and their size rewritten in the header, which needs a
+        # descriptor without O_APPEND
+        file = open(path, "r+b")
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        codec, _, size = _parse_header(file.read(FILE_HEADER.size))
+        index = self.index(file)
+        return CompressedWriter(self, file, codec, index, size, self.level)
+
+    def index(self, file):
+        """
+        Returns
+        -------
+        list
+            (offset in the file, offset in the content, uncompressed
+            length, compressed length) of every block of an open
+            compressed file
+        """
+        stats = os.fstat(file.fileno())
+        key = (stats.st_dev, stats.st_ino)
+        with self._lock:
+            cached = self.indexes.get(key)
+            if cached is not None and cached[0] == (stats.st_mtime_ns, stats.st_size):
+                self.indexes.move_to_end(key)
+                return cached[1]
+        index = []
+        position, start = FILE_HEADER.size, 0
+        while position < stats.st_size:
+            file.seek(position)
+            header = file.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            length, compressed_length = BLOCK_HEADER.unpack(header)
+            if position + BLOCK_HEADER.size + compressed_length > stats.st_size:
+                # Still being written by an append
+                break
+            index.append((position + BLOCK_HEADER.size, start, length, compressed_length))
+            position += BLOCK_HEADER.size + compressed_length
+            start += length
+        with self._lock:
+            self.indexes[key] = ((stats.st_mtime_ns, stats.st_size), index)
+            while len(self.indexes) > MAX_CACHED_INDEXES:
+                self.indexes.popitem(last=False)
+        return index
+
+    def remember(self, file, index):
+        """Caches the index of an open file after it was written, which
+        the writer knows without walking the blocks again."""
+        stats = os.fstat(file.fileno())
+        with self._lock:
+            self.indexes[(stats.st_dev, stats.st_ino)] = ((stats.st_mtime_ns, stats.st_size), index)
+            self.indexes.move_to_end((stats.st_dev, stats.st_ino))
+            while len(self.indexes) > MAX_CACHED_INDEXES:
+                self.indexes.popitem(last=False)
+
+
+class CompressedWriter:
+    """
+
+    File-like object appending to a compressed file, holding an
+    exclusive lock on it until closed. The new content starts a block
+    of its own after the last one, which is never written again, and
+    every block is compressed as soon as it is full. The size in the
+    header only grows once the new blocks are written, so readers and
+    a server stopping before close both see the content as it was. As
+    for plain files, the blocks reach the disk when the caller syncs
+    them, e.g. an upload every UPLOAD_FSYNC_BYTES, not on every close.
+
+    Attributes
+    ----------
+    self.file :
+        Compressed file opened for reading and writing
+    self.codec : str
+        Codec of the file
+    self.size : int
+        Size of the uncompressed content written so far
+    self.index : list
+        Index of the blocks, as Compression.index returns it, with the
+        blocks written so far
+    """
+
+    def __init__(self, compression, file, codec, index, size, level=None):
+        self.compression = compression
+        self.file = file
+        self.codec = codec
+        self.level = level
+        self.block_size = compression.block_size
+        self.buffer = bytearray()
+        self.size = size
+        self.closed = False
+        # Blocks past the size in the header were left by an append which
+        # never closed, and are cut off; the committed ones are kept as
+        # they are, readers may be going through them
+        end = FILE_HEADER.size
+        self.index = []
+        for block in index:
+            offset, start, _, compressed_length = block
+            if start >= size:
+                break
+            end = offset + compressed_length
+            self.index.append(block)
+        file.truncate(end)
+        file.seek(end)
+
+    def write(self, data):
+        """Appends data, compressing every block it completes."""
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._write_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _write_block(self, block):
+        level = DEFAULT_LEVELS[self.codec] if self.level is None else self.level
+        compressed = CODECS[self.codec][1](block, level)
+        self.file.write(BLOCK_HEADER.pack(len(block), len(compressed)))
+        self.index.append((self.file.tell(), self.size, len(block), len(compressed)))
+        self.file.write(compressed)
+        self.size += len(block)
+
+    def flush(self):
+        """Flushes the complete blocks to the file."""
+        self.file.flush()
+
+    def fileno(self):
+        """Returns the descriptor of the compressed file."""
+        return self.file.fileno()
+
+    def close(self):
+        """Writes the last block and the new size, and unlocks the file."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+        self.file.flush()
+        self.file.seek(FILE_HEADER.size - 8)
+        self.file.write(struct.pack("!Q", self.size))
+        self.file.flush()
+        self.compression.remember(self.file, self.index)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CompressedFile:
+    """
+
+    Read-only file-like view of the uncompressed content of a
+    compressed file. The last decompressed block is kept, so reads
+    moving forward through a block decompress it once.
+
+    Attributes
+    ----------
+    self.file :
+        Compressed file opened in binary mode
+    self.codec : str
+        Codec of the file
+    self.size : int
+        Size of the uncompressed content
+    self.position : int
+        Offset of the next read in the content
+    """
+
+    def __init__(self, file, codec, index, size):
+        self.file = file
+        self.codec = codec
+        self.index = index
+        self.starts = [block[1] for block in index]
+        self.size = size
+        self.position = 0
+        self.cached = (None, b"")
+
+    def seek(self, offset):
+        """Moves the position of the next read."""
+        self.position = offset
+        return offset
+
+    def read(self, size=-1):
+        """Reads at most size bytes from the position."""
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        parts = []
+        number = bisect.bisect_right(self.starts, self.position) - 1
+        while self.position < end and number < len(self.index):
+            block = self._block(number)
+            inner = self.position - self.starts[number]
+            part = block[inner:inner + end - self.position]
+            parts.append(part)
+            self.position += len(part)
+            number += 1
+        return b"".join(parts)
+
+    def _block(self, number):
+        if self.cached[0] != number:
+            offset, _, _, compressed_length = self.index[number]
+            self.file.seek(offset)
+            self.cached = (number, CODECS[self.codec][2](self.file.read(compressed_length)))
+        return self.cached[1]
+
+    def frames(self):
+        """
+        Yields the blocks as they are stored, each prefixed with the
+        id of the codec, to be sent on the wire and decompressed by
+        the client with decompress_frame.
+        """
+        codec_id = bytes([CODECS[self.codec][0]])
+        with self.file:
+            for offset, start, _, compressed_length in self.index:
+                if start >= self.size:
+                    break
+                self.file.seek(offset)
+                yield codec_id + self.file.read(compressed_length)
+
+    def close(self):
+        """Closes the compressed file."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,170 @@
+"""
+This program caches the folder listings served by the list command.
+"""
+
+import base64
+import bisect
+import os
+import threading
+import time
+from collections import OrderedDict
+from chunkstore import ChunkStore
+from compression import Compression, COMPRESSION_FILE
+from transfers import PARTIAL_PREFIX
+
+MAX_CACHED_FOLDERS = 256
+CURSOR_PREFIX = "~"
+
+
+def encode_cursor(name):
+    """
+    Returns
+    -------
+    str
+        Opaque cursor pointing after the entry name, without spaces
+    """
+    return CURSOR_PREFIX + base64.urlsafe_b64encode(name.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns
+    -------
+    str
+        Name of the entry the cursor points after
+
+    Raises
+    ------
+    ValueError
+        If the cursor was not made by encode_cursor
+    """
+    if not cursor.startswith(CURSOR_PREFIX):
+        raise ValueError("Invalid cursor " + cursor)
+    return base64.urlsafe_b64decode(cursor[len(CURSOR_PREFIX):].encode()).decode()
+
+
+class DirectoryCache:
+    """
+
+    Process-wide cache of folder listings. Each folder is read once with
+    os.scandir and kept sorted by name together with the size and the
+    change time of every entry. A listing is read again when the
+    modification time of the folder changes, e.g. an entry was created
+    or removed by another process, or when the server invalidates it
+    after writing into the folder. Files kept in the chunk store or
+    compressed are listed with the size of their content. The least recently used folders are
+    dropped beyond max_folders.
+
+    Attributes
+    ----------
+    self.max_folders : int
+        Number of folders kept in the cache
+    self.folders : OrderedDict
+        Maps a folder path to its modification time, the sorted entry
+        names and the [name, size, change time] rows
+
+    Returns
+    -------
+    Object
+        DirectoryCache Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_folders=MAX_CACHED_FOLDERS):
+        self.max_folders = max_folders
+        self.folders = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        DirectoryCache
+            The cache shared by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def invalidate(self, path):
+        """Drops the listing of the folder, after it was written to."""
+        with self._lock:
+            self.folders.pop(os.path.normpath(path), None)
+
+    def invalidate_tree(self, path):
+        """Drops the listings of a folder and every folder below it, after it was moved or deleted."""
+        prefix = os.path.join(os.path.normpath(path), "")
+        with self._lock:
+            for folder in [folder for folder in self.folders
+                           if os.path.join(folder, "").startswith(prefix)]:
+                del self.folders[folder]
+
+    def page(self, path, after=None, limit=None):
+        """
+        Returns one page of the listing of a folder.
+
+        Parameters
+        ----------
+        path : str
+            Folder to list
+        after : str
+            Name of the last entry of the previous page, by default the
+            page starts with the first entry
+        limit : int
+            Number of entries in the page, by default all of them
+
+        Returns
+        -------
+        tuple
+            The [name, size, change time] rows of the page, and the
+            name of its last entry if more entries follow, else None
+
+        Raises
+        ------
+        NotADirectoryError, FileNotFoundError
+            If the path is not a folder
+        """
+        names, rows = self._listing(os.path.normpath(path))
+        start = 0 if after is None else bisect.bisect_right(names, after)
+        end = len(rows) if limit is None else min(start + limit, len(rows))
+        more = names[end - 1] if end < len(rows) and end > start else None
+        return rows[start:end], more
+
+    def _listing(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self.folders.get(path)
+            if cached is not None and cached[0] == mtime:
+                self.folders.move_to_end(path)
+                return cached[1], cached[2]
+
+        rows = []
+        store = ChunkStore.shared()
+        compression = Compression.shared()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name == COMPRESSION_FILE or entry.name.startswith(PARTIAL_PREFIX):
+                    continue
+                try:
+                    stats = entry.stat()
+                except FileNotFoundError:
+                    continue
+                size = stats.st_size
+                if store is not None and entry.is_file():
+                    size = store.logical_size(entry.path, size)
+                elif entry.is_file():
+                    size = compression.logical_size(entry.path, size)
+                rows.append([entry.name, str(size), time.ctime(stats.st_ctime)])
+        rows.sort(key=lambda row: row[0])
+        names = [row[0] for row in rows]
+
+        with self._lock:
+            self.folders[path] = (mtime, names, rows)
+            self.folders.move_to_end(path)
+            while len(self.folders) > self.max_folders:
+                self.folders.popitem(last=False)
+        return names, rows
@@ -0,0 +1,230 @@
+"""
+This program maps the commands sent by the clients to their handlers.
+The server registers the built-in commands, plugins register their own
+ones on the same shared dispatcher.
+"""
+
+import asyncio
+import threading
+from fileio import FileIO
+
+UNKNOWN_COMMAND = "unknown"
+
+
+class UsageError(Exception):
+    """
+    Raised by a handler when the arguments of its command are invalid,
+    the usage of the command is then sent to the client.
+    """
+
+
+class Command:
+    """
+
+    One registered command.
+
+    Attributes
+    ----------
+    self.name : str
+        First word of the command line
+    self.handler : callable
+        Function handling the command. A plain function is called with
+        the CommandHandler, the list of arguments and the binary payload
+        on the filesystem threads and returns the reply. A coroutine
+        function also gets the channel, runs on the event loop and
+        sends its replies itself, e.g. to stream a file.
+    self.min_args : int
+        Fewest arguments accepted
+    self.max_args : int
+        Most arguments accepted, None for any number
+    self.usage : str
+        Reply sent when the arguments are invalid
+    self.help : str
+        Description added to the reply of the commands command
+    self.raw_args : bool
+        True if the arguments are passed as one string, the rest of the
+        command line as it was sent
+    """
+
+    __slots__ = ("name", "handler", "min_args", "max_args", "usage", "help", "on_loop",
+                 "raw_args")
+
+    def __init__(self, name, handler, min_args, max_args, usage, help_text, raw_args=False):
+        self.name = name
+        self.handler = handler
+        self.min_args = min_args
+        self.max_args = max_args
+        self.usage = usage
+        self.help = help_text
+        self.on_loop = asyncio.iscoroutinefunction(handler)
+        self.raw_args = raw_args
+
+    def check_args(self, args):
+        """
+        Raises
+        ------
+        UsageError
+            If the command does not accept this number of arguments
+        """
+        if len(args) < self.min_args or (self.max_args is not None and len(args) > self.max_args):
+            raise UsageError(self.usage)
+
+
+class Dispatcher:
+    """
+
+    Table of the commands understood by the server. A command line is
+    split once into the command and its arguments, the handler is found
+    with one dictionary lookup and the number of arguments is checked
+    against the arity declared at registration.
+
+    Attributes
+    ----------
+    self.commands : dict
+        Maps a command name to its Command
+
+    Returns
+    -------
+    Object
+        Dispatcher Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.commands = {}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        Dispatcher
+            The dispatcher used by the server of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def register(self, name, handler, min_args=0, max_args=None, usage=None, help_text=None,
+                 raw_args=False):
+        """
+        Adds a command.
+
+        Parameters
+        ----------
+        name : str
+            First word of the command line
+        handler : callable
+            Function or coroutine function handling the command, see Command
+        min_args, max_args : int
+            Number of arguments accepted, max_args None for any number
+        usage : str
+            Reply sent when the arguments are invalid
+        help_text : str
+            Description added to the reply of the commands command
+        raw_args : bool
+            Passes the rest of the command line as one argument instead
+            of splitting it, e.g. for JSON holding spaces
+
+        Raises
+        ------
+        ValueError
+            If the command is already registered
+        """
+        if name in self.commands:
+            raise ValueError("Command " + name + " is already registered")
+        if usage is None:
+            usage = "Enter correct command: command -> " + name
+        self.commands[name] = Command(name, handler, min_args, max_args, usage, help_text,
+                                      raw_args)
+
+    def command(self, name, min_args=0, max_args=None, usage=None, help_text=None,
+                raw_args=False):
+        """
+        Decorator registering the decorated function as the handler
+        of a command, with the same parameters as register.
+        """
+        def decorate(handler):
+            self.register(name, handler, min_args, max_args, usage, help_text, raw_args)
+            return handler
+        return decorate
+
+    def help(self):
+        """
+        Returns
+        -------
+        str
+            Descriptions of the commands registered with a help text
+        """
+        return "".join(command.help for command in self.commands.values() if command.help)
+
+    def parse(self, message):
+        """
+        Splits a command line once.
+
+        Returns
+        -------
+        tuple
+            The Command, or None if it is not registered, the command
+            name and the list of arguments
+        """
+        name, _, rest = message.partition(" ")
+        command = self.commands.get(name)
+        if not rest:
+            return command, name, []
+        if command is not None and command.raw_args:
+            return command, name, [rest]
+        return command, name, rest.split(" ")
+
+    async def run(self, command, name, args, commandhandler, payload, channel):
+        """
+        Runs a parsed command and sends its reply through the channel.
+
+        Parameters
+        ----------
+        command : Command
+            Command returned by parse, or None
+        name : str
+            Command name returned by parse
+        args : list
+            Arguments returned by parse
+        commandhandler : CommandHandler
+            Command handler of the connection
+        payload : bytes
+            Body sent after the command line by framed clients, or None
+        channel : TextChannel or FramedChannel
+            Protocol spoken with the client
+        """
+        if command is None:
+            await channel.send("\nUnknown command " + name + ", send commands to see the commands")
+            return
+        try:
+            command.check_args(args)
+            if command.on_loop:
+                await command.handler(commandhandler, args, payload, channel)
+            else:
+                reply = await FileIO.shared().run(name, command.handler,
+                                                  commandhandler, args, payload)
+                await channel.send(str(reply))
+        except UsageError:
+            if command.on_loop:
+                # Clients of streaming commands read a header line
+                await channel.send_stream(command.usage, None)
+            else:
+                await channel.send(command.usage)
+
+    async def dispatch(self, commandhandler, message, payload, channel):
+        """
+        Parses and runs one command line.
+
+        Returns
+        -------
+        str
+            Name of the command, or UNKNOWN_COMMAND
+        """
+        command, name, args = self.parse(message)
+        await self.run(command, name, args, commandhandler, payload, channel)
+        return UNKNOWN_COMMAND if command is None else name
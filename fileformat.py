@@ -0,0 +1,71 @@
+"""
+This program marks the files the server stores in a format of its own,
+a chunk manifest or a compressed file, with an extended attribute. The
+content of a file is never what tells its format, so whatever a user
+writes is read back as it was sent, even when it starts like a
+manifest or a compressed file.
+"""
+
+import errno
+import os
+import tempfile
+
+FORMAT_ATTRIBUTE = "user.fms.format"
+MANIFEST = b"manifest"
+COMPRESSED = b"compressed"
+# Errors of getxattr for a file without the attribute, or a file
+# system without extended attributes, whose files are all plain
+_NO_FORMAT = (errno.ENODATA, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+def stored_format(file):
+    """
+    Parameters
+    ----------
+    file : str or int
+        Path or descriptor of the file
+
+    Returns
+    -------
+    bytes
+        MANIFEST or COMPRESSED, or None for a plain file
+    """
+    if not hasattr(os, "getxattr"):
+        return None
+    try:
+        return os.getxattr(file, FORMAT_ATTRIBUTE)
+    except OSError as error:
+        if error.errno in _NO_FORMAT:
+            return None
+        raise
+
+
+def mark(file, stored):
+    """
+    Marks a file, given by path or descriptor, as stored in a format.
+
+    Raises
+    ------
+    OSError
+        If the file system does not keep extended attributes
+    """
+    if not hasattr(os, "setxattr"):
+        raise OSError(errno.ENOTSUP, "Extended attributes are not supported")
+    os.setxattr(file, FORMAT_ATTRIBUTE, stored)
+
+
+def copy_format(source, destination):
+    """Marks a copy, given by path or descriptor, with the format of its source."""
+    stored = stored_format(source)
+    if stored is not None:
+        mark(destination, stored)
+
+
+def supported(folder):
+    """Tells whether the files of a folder can be marked."""
+    with tempfile.NamedTemporaryFile(dir=folder) as probe:
+        try:
+            mark(probe.fileno(), MANIFEST)
+        except OSError:
+            return False
+    return True
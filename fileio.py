@@ -0,0 +1,137 @@
+"""
+This program moves the blocking filesystem work of the commands
+off the event loop, onto a thread pool shared by all connections.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_THREADS = 16
+DEFAULT_LIMITS = {
+    "read_file": 8,
+    "stream_file": 8,
+    "download": 8,
+    "write_file": 4,
+    "upload": 4,
+    "list": 4,
+    "batch": 4,
+    "tree": 4,
+    "copy": 2,
+    "move": 2,
+    "delete": 2,
+    "register": 4,
+    "login": 4,
+}
+
+
+class FileIO:
+    """
+
+    Runs blocking calls on a thread pool. Every call names the
+    operation it belongs to, and at most limits[operation] calls of
+    that operation run at the same time so one kind of work, e.g.
+    large reads, cannot take all the threads. Operations without a
+    limit are only bounded by the size of the pool. With zero threads
+    the calls run inline on the event loop.
+
+    Attributes
+    ----------
+    self.threads : int
+        Number of threads in the pool
+    self.limits : dict
+        Maps an operation name to the number of calls allowed at once
+
+    Returns
+    -------
+    Object
+        FileIO Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, threads=DEFAULT_THREADS, limits=None):
+        """
+        Parameters
+        ----------
+        threads : int
+            Number of threads in the pool, 0 runs every call inline
+        limits : dict
+            Per operation limits, by default DEFAULT_LIMITS
+        """
+        self.threads = threads
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.executor = ThreadPoolExecutor(threads, "fileio") if threads else None
+        self.semaphores = {}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        FileIO
+            The pool shared by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, threads=DEFAULT_THREADS, limits=None):
+        """
+        Replaces the shared pool, e.g. with the settings given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.shutdown()
+            cls._shared = cls(threads, limits)
+            return cls._shared
+
+    def _semaphore(self, operation):
+        limit = self.limits.get(operation)
+        if not limit:
+            return None
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get((loop, operation))
+        if semaphore is None:
+            semaphore = self.semaphores[(loop, operation)] = asyncio.Semaphore(limit)
+        return semaphore
+
+    async def run(self, operation, function, *args):
+        """
+        Calls function(*args) on the pool once the operation is
+        below its limit.
+
+        Returns
+        -------
+        object
+            Whatever function returned
+        """
+        if self.executor is None:
+            return function(*args)
+        semaphore = self._semaphore(operation)
+        loop = asyncio.get_running_loop()
+        if semaphore is None:
+            return await loop.run_in_executor(self.executor, function, *args)
+        async with semaphore:
+            return await loop.run_in_executor(self.executor, function, *args)
+
+    async def iterate(self, operation, iterator):
+        """
+        Yields the items of a blocking iterator, e.g. the chunks read
+        from a file, fetching each one on the pool.
+        """
+        done = object()
+        while True:
+            item = await self.run(operation, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def shutdown(self):
+        """Stops the threads once the running calls are finished."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,840 @@
+"""
+This program is the asyncio client library of the file server. It
+speaks the framed protocol, so a Connection sends every command as
+soon as it is asked and matches the replies to the commands in the
+order they arrive: many requests are in flight on one connection
+instead of one round trip per command. A Pool keeps several logged in
+connections to the same folder and spreads parallel transfers over
+them.
+
+    async with await fmsclient.connect(host, port) as connection:
+        await connection.login("user", "password")
+        await asyncio.gather(*[connection.read_file(name) for name in names])
+
+    async with fmsclient.Pool(host, port, "user", "password", size=8) as pool:
+        await pool.upload_many(paths)
+        await pool.upload_parallel("disk.img")
+
+upload_parallel and download_parallel move one large file as ranges of
+RANGE_SIZE bytes sent over all the connections of a pool, each checked
+against its sha256 digest. Ranges lost with a connection or corrupted
+are sent again, and running them again after an interruption only
+transfers the ranges which did not arrive.
+
+After watch, the changes to the watched folder arrive on the events
+queue of the connection as (kind, path) pairs, whatever the requests
+in flight:
+
+    await connection.watch("docs")
+    kind, path = await connection.events.get()
+"""
+
+import asyncio
+import collections
+import json
+import os
+
+import protocol
+from compression import decompress_frame
+from transfers import checksum, range_digest
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_IN_FLIGHT = 64
+POOL_SIZE = 4
+RANGE_SIZE = 8 * 1024 * 1024
+RANGE_RETRIES = 3
+
+# How the reply to a command continues after its RESPONSE frame
+REPLY = 0
+STREAM = 1
+DOWNLOAD = 2
+RANGE = 3
+PROGRESS = 4
+
+
+class ClientError(Exception):
+    """
+    Raised when the connection to the server is lost, or when the
+    server refuses a transfer, with its reply as the message.
+    """
+
+
+async def connect(host, port, codecs=protocol.SUPPORTED_CODECS):
+    """
+    Opens a connection to the server.
+
+    Parameters
+    ----------
+    codecs : tuple
+        Codecs this client decompresses, compressed files are then
+        streamed as they are stored
+
+    Returns
+    -------
+    Connection
+        The open connection, not logged in
+    """
+    reader, writer = await protocol.open_framed_connection(host, port, codecs)
+    return Connection(reader, writer)
+
+
+def logged_in(reply):
+    """Returns True if reply is the answer to a successful login."""
+    return reply.startswith("Success") or reply == "\nYou logged through another system"
+
+
+class Connection:
+    """
+
+    One framed connection to the server. Requests may be made from any
+    number of tasks at once: each is written as soon as the previous
+    one is on the wire and its reply is read by a single reader task,
+    which resolves the requests in order and writes streamed and
+    downloaded content to where they asked for it. At most
+    max_in_flight requests wait for their reply at a time.
+
+    Attributes
+    ----------
+    self.reader : StreamReader
+        Reads data from the server socket
+    self.writer : StreamWriter
+        Writes data to the server socket
+    self.pending : deque
+        (future, kind of reply, sink) of the requests sent and not
+        answered yet, oldest first
+    self.requests : int
+        Requests made and not answered yet, including the ones
+        waiting to be sent
+    self.error : ClientError
+        Why the connection failed, or None while it works
+    self.events : asyncio.Queue
+        (kind, path) of the changes to the watched folders, in the
+        order the server sent them
+
+    Returns
+    -------
+    Object
+        Connection Object
+    """
+
+    def __init__(self, reader, writer, max_in_flight=MAX_IN_FLIGHT):
+        self.reader = reader
+        self.writer = writer
+        self.pending = collections.deque()
+        self.requests = 0
+        self.error = None
+        self.events = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def load(self):
+        """Returns the number of requests made and not answered yet."""
+        return self.requests
+
+    async def request(self, command, body=None, kind=REPLY, sink=None, frames=None):
+        """
+        Sends one command and waits for its reply.
+
+        Parameters
+        ----------
+        command : str
+            Command line, e.g. "read_file a.txt 0 10"
+        body : bytes
+            Binary body sent after the command line, e.g. the content
+            of write_file
+        kind : int
+            REPLY, or STREAM, DOWNLOAD or PROGRESS when content follows
+            the reply
+        sink : callable
+            Called with every chunk of the content following the reply
+        frames : iterable
+            Payloads of the DATA frames sent after the command, then
+            ended by an END frame, for upload
+
+        Returns
+        -------
+        str
+            The reply of the server
+
+        Raises
+        ------
+        ClientError
+            If the connection is lost before the reply arrives
+        """
+        payload = command.encode()
+        if body is not None:
+            payload += b"\n" + body
+        self.requests += 1
+        try:
+            async with self._in_flight:
+                future = asyncio.get_running_loop().create_future()
+                async with self._write_lock:
+                    if self.error is not None:
+                        raise self.error
+                    self.pending.append((future, kind, sink))
+                    protocol.write_frame(self.writer, protocol.COMMAND, payload)
+                    if frames is not None:
+                        for chunk in frames:
+                            protocol.write_frame(self.writer, protocol.DATA, chunk)
+                            await self._drain()
+                        protocol.write_frame(self.writer, protocol.END)
+                    await self._drain()
+                return await future
+        finally:
+            self.requests -= 1
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError as error:
+            self._fail(ClientError("Connection lost: " + str(error)))
+            raise self.error from error
+
+    async def _read_replies(self):
+        reader = self.reader
+        try:
+            while True:
+                opcode, payload = await protocol.read_frame(reader)
+                if opcode == protocol.EVENT:
+                    kind, _, path = payload.decode(errors="replace").partition(" ")
+                    self.events.put_nowait((kind, path))
+                    continue
+                if not self.pending:
+                    raise ClientError("Unexpected frame with opcode " + str(opcode))
+                future, kind, sink = self.pending[0]
+                if opcode == protocol.ERROR:
+                    raise ClientError(payload.decode(errors="replace"))
+                reply = payload.decode(errors="replace")
+                failure = None
+                if kind == STREAM and reply.startswith("\nStreaming"):
+                    failure = await self._receive_stream(sink)
+                elif kind == PROGRESS and reply.startswith("\nRunning"):
+                    failure = await self._receive_stream(sink)
+                elif kind == DOWNLOAD and reply.startswith("\nDownloading"):
+                    failure = await self._receive_download(int(reply.split(" ")[-2]), sink)
+                elif kind == RANGE and reply.startswith("\nRange"):
+                    failure = await self._receive_download(int(reply.split(" ")[3]), sink)
+                self.pending.popleft()
+                if future.done():
+                    continue
+                if failure is not None:
+                    future.set_exception(failure)
+                else:
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, protocol.ProtocolError) as error:
+            self._fail(ClientError("Connection lost: " + (str(error) or "closed by the server")))
+        except ClientError as error:
+            self._fail(error)
+
+    async def _receive_stream(self, sink):
+        """Passes the DATA and ZDATA frames up to END to the sink,
+        returns the exception the sink raised or the ClientError of a
+        frame which did not decompress, if any."""
+        failure = None
+        while True:
+            opcode, payload = await protocol.read_frame(self.reader)
+            if opcode == protocol.END:
+                return failure
+            if opcode == protocol.ZDATA:
+                try:
+                    payload = decompress_frame(payload)
+                except ValueError as error:
+                    # Like a failing sink, the rest of the stream is read
+                    failure = failure or ClientError(str(error))
+                    continue
+            elif opcode != protocol.DATA:
+                raise ClientError("Unexpected frame with opcode " + str(opcode))
+            if failure is None:
+                try:
+                    sink(payload)
+                except Exception as error:  # pylint: disable=broad-except
+                    # The rest of the stream is still read off the
+                    # connection, the next replies follow it
+                    failure = error
+
+    async def _receive_download(self, size, sink):
+        """Passes the size raw bytes following a download reply to the
+        sink, returns the exception the sink raised, if any."""
+        failure = None
+        remaining = size
+        while remaining:
+            chunk = await self.reader.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(chunk)
+            if failure is None:
+                try:
+                    sink(chunk)
+                except Exception as error:  # pylint: disable=broad-except
+                    failure = error
+        return failure
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        while self.pending:
+            future, _, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(self.error)
+
+    async def register(self, username, password):
+        """register <username> <password>"""
+        return await self.request(f"register {username} {password}")
+
+    async def login(self, username, password):
+        """login <username> <password>"""
+        return await self.request(f"login {username} {password}")
+
+    async def quit(self):
+        """quit"""
+        return await self.request("quit")
+
+    async def create_folder(self, folder):
+        """create_folder <folder>"""
+        return await self.request(f"create_folder {folder}")
+
+    async def change_folder(self, folder):
+        """change_folder <folder>"""
+        return await self.request(f"change_folder {folder}")
+
+    async def write_file(self, filename, content):
+        """Appends content, str or bytes, to a file."""
+        if isinstance(content, str):
+            content = content.encode()
+        return await self.request(f"write_file {filename}", content)
+
+    async def read_file(self, filename, offset=None, length=None):
+        """read_file <filename> [offset] [length]"""
+        words = ["read_file", filename] + [str(arg) for arg in (offset, length) if arg is not None]
+        return await self.request(" ".join(words))
+
+    async def list(self, cursor=None, limit=None):
+        """list [cursor] [limit]"""
+        words = ["list"] + [str(arg) for arg in (cursor, limit) if arg is not None]
+        return await self.request(" ".join(words))
+
+    async def set_compression(self, codec):
+        """set_compression <zlib|lzma|none>"""
+        return await self.request(f"set_compression {codec}")
+
+    async def stats(self):
+        """stats"""
+        return await self.request("stats")
+
+    async def commands(self):
+        """commands"""
+        return await self.request("commands")
+
+    async def batch(self, commands):
+        """
+        Runs many commands in one request and one reply.
+
+        Parameters
+        ----------
+        commands : list
+            Command lines, e.g. "read_file a.txt 0 10", or (command
+            line, body) pairs for write_file, the body str or UTF-8
+            bytes
+
+        Returns
+        -------
+        list
+            {"command": name, "reply": reply} per command which ran, or
+            {"command": name, "error": error} per command which did not
+
+        Raises
+        ------
+        ClientError
+            If the server refused the whole batch
+        """
+        operations = []
+        for command in commands:
+            if isinstance(command, tuple):
+                line, body = command
+                command = line + "\n" + (body.decode() if isinstance(body, bytes) else body)
+            operations.append(command)
+        reply = await self.request("batch", json.dumps(operations).encode())
+        try:
+            return json.loads(reply)
+        except ValueError:
+            raise ClientError(reply.strip()) from None
+
+    async def watch(self, folder=None):
+        """watch [folder], the changes then arrive on the events queue"""
+        return await self.request("watch" if folder is None else f"watch {folder}")
+
+    async def unwatch(self, folder=None):
+        """unwatch [folder]"""
+        return await self.request("unwatch" if folder is None else f"unwatch {folder}")
+
+    async def tree(self, folder=None, sink=None):
+        """tree [folder], returns the lines listing the files and folders
+        below it, or passes their chunks to sink"""
+        return await self._run_tree("tree" if folder is None else f"tree {folder}", sink)
+
+    async def copy(self, source, destination, sink=None):
+        """copy <source> <destination>, returns the progress lines, or
+        passes them to sink as they arrive"""
+        return await self._run_tree(f"copy {source} {destination}", sink)
+
+    async def move(self, source, destination, sink=None):
+        """move <source> <destination>"""
+        return await self._run_tree(f"move {source} {destination}", sink)
+
+    async def delete(self, name, recursive=False, sink=None):
+        """delete [-r] <name>"""
+        return await self._run_tree(f"delete -r {name}" if recursive else f"delete {name}", sink)
+
+    async def _run_tree(self, command, sink):
+        """
+        Sends a tree, copy, move or delete command and receives the
+        lines streamed until the operation is done.
+
+        Returns
+        -------
+        str
+            The lines, ended by the summary line, if no sink was given,
+            else the reply
+
+        Raises
+        ------
+        ClientError
+            If the server refuses the command, or without a sink if the
+            operation failed, with the summary line as the message
+        """
+        parts = []
+        reply = await self.request(command, kind=PROGRESS, sink=parts.append if sink is None else sink)
+        if not reply.startswith("\nRunning"):
+            raise ClientError(reply.strip())
+        if sink is not None:
+            return reply
+        lines = b"".join(parts).decode(errors="replace")
+        last = lines.rstrip("\n").rpartition("\n")[2]
+        if last.startswith("Failed:"):
+            raise ClientError(last)
+        return lines
+
+    async def stream_file(self, filename, sink=None):
+        """
+        Streams a file, decompressing it if the server sends it as it
+        is stored.
+
+        Parameters
+        ----------
+        sink : callable
+            Called with every chunk of the content; without a sink the
+            content is returned
+
+        Returns
+        -------
+        bytes or str
+            The content if no sink was given, else the reply
+
+        Raises
+        ------
+        ClientError
+            If the server does not stream the file, e.g. it does not exist
+        """
+        parts = []
+        reply = await self.request(f"stream_file {filename}", kind=STREAM,
+                                   sink=parts.append if sink is None else sink)
+        if not reply.startswith("\nStreaming"):
+            raise ClientError(reply.strip())
+        return b"".join(parts) if sink is None else reply
+
+    async def download(self, filename, path=None):
+        """
+        Downloads a file to path, by default to a file of the same name
+        in the current folder. The content is written to path.part,
+        which replaces path once complete.
+
+        Returns
+        -------
+        int
+            Size of the file
+
+        Raises
+        ------
+        ClientError
+            If the server does not send the file, e.g. it does not exist
+        """
+        path = filename if path is None else path
+        partial = path + ".part"
+        with open(partial, "wb") as file:
+            try:
+                reply = await self.request(f"download {filename}", kind=DOWNLOAD, sink=file.write)
+            except BaseException:
+                file.close()
+                os.remove(partial)
+                raise
+        if not reply.startswith("\nDownloading"):
+            os.remove(partial)
+            raise ClientError(reply.strip())
+        os.replace(partial, path)
+        return int(reply.split(" ")[-2])
+
+    async def upload(self, path, filename=None):
+        """
+        Uploads a local file, by default under its own name. As with
+        write_file the content is appended if the file exists.
+
+        Returns
+        -------
+        str
+            The reply of the server
+
+        Raises
+        ------
+        ClientError
+            If the server did not store the whole file
+        """
+        filename = os.path.basename(path) if filename is None else filename
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            chunks = iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b"")
+            reply = await self.request(f"upload {filename} {size}", frames=chunks)
+        if not reply.endswith("successfully"):
+            raise ClientError(reply.strip())
+        return reply
+
+    async def upload_begin(self, filename, size):
+        """
+        Starts a ranged upload of size bytes, or resumes the one in
+        progress.
+
+        Returns
+        -------
+        list
+            (offset, length) of the ranges the server already received
+
+        Raises
+        ------
+        ClientError
+            If the server refuses the upload
+        """
+        reply = await self.request(f"upload_begin {filename} {size}")
+        if not reply.startswith("\nUpload of "):
+            raise ClientError(reply.strip())
+        return [tuple(int(word) for word in line.split(" ")) for line in reply.split("\n")[2:]]
+
+    async def upload_range(self, path, filename, offset, length, digest=None):
+        """
+        Sends length bytes of a local file from offset as a range of
+        the upload of filename.
+
+        Raises
+        ------
+        ClientError
+            If the server did not receive the range intact
+        """
+        with open(path, "rb") as file:
+            if digest is None:
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    None, range_digest, file, offset, length)
+            reply = await self.request(f"upload_range {filename} {offset} {length} {digest}",
+                                       frames=_read_range(file, offset, length))
+        if not reply.startswith("\nReceived "):
+            raise ClientError(reply.strip())
+        return reply
+
+    async def upload_commit(self, filename):
+        """
+        Replaces the file on the server with the ranges received.
+
+        Raises
+        ------
+        ClientError
+            If ranges are missing
+        """
+        reply = await self.request(f"upload_commit {filename}")
+        if not reply.endswith("successfully"):
+            raise ClientError(reply.strip())
+        return reply
+
+    async def download_range(self, filename, offset, length, sink):
+        """
+        Downloads length bytes of a file from offset, fewer at the end
+        of the file, passing them to sink.
+
+        Returns
+        -------
+        tuple
+            Length of the range, size of the file and version of its
+            content
+
+        Raises
+        ------
+        ClientError
+            If the server does not send the range, or it does not
+            match its checksum
+        """
+        digest = checksum()
+
+        def check(chunk):
+            digest.update(chunk)
+            sink(chunk)
+
+        reply = await self.request(f"download_range {filename} {offset} {length}",
+                                   kind=RANGE, sink=check)
+        if not reply.startswith("\nRange "):
+            raise ClientError(reply.strip())
+        _, _, _, length, size, version, expected = reply.split(" ")
+        if digest.hexdigest() != expected.strip():
+            raise ClientError(f"Checksum mismatch for range {filename} {offset} {length}")
+        return int(length), int(size), version
+
+    async def close(self):
+        """Ends the connection, once the replies in flight arrived."""
+        if self.error is None and not self.writer.is_closing():
+            async with self._write_lock:
+                protocol.write_frame(self.writer, protocol.COMMAND, b"exit")
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    pass
+        await self._reader_task
+        self.writer.close()
+
+
+def _read_range(file, offset, length):
+    """Yields length bytes of a local file from offset, in chunks."""
+    file.seek(offset)
+    while length:
+        chunk = file.read(min(length, UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+class Pool:
+    """
+
+    Connections to the server logged in as the same user and moved to
+    the same folder, up to size of them, opened as they are needed.
+    Every request goes to the connection with the fewest requests in
+    flight, so parallel transfers run on parallel connections, which
+    the server serves at once.
+
+    Attributes
+    ----------
+    self.size : int
+        Most connections opened
+    self.connections : list
+        The open connections
+    self.folders : list
+        Folders changed to with change_folder, replayed on every new
+        connection
+
+    Returns
+    -------
+    Object
+        Pool Object
+    """
+
+    def __init__(self, host, port, username=None, password=None, size=POOL_SIZE,
+                 codecs=protocol.SUPPORTED_CODECS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.codecs = codecs
+        self.connections = []
+        self.folders = []
+        self._opening = 0
+        self._opened = asyncio.Condition()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connection(self):
+        """
+        Returns
+        -------
+        Connection
+            An idle connection, a new one while fewer than size are
+            open, else the least busy one
+        """
+        async with self._opened:
+            self.connections = [connection for connection in self.connections
+                                if connection.error is None]
+            idle = [connection for connection in self.connections if not connection.load()]
+            if idle:
+                return idle[0]
+            if len(self.connections) + self._opening >= self.size:
+                while not self.connections:
+                    await self._opened.wait()
+                return min(self.connections, key=Connection.load)
+            self._opening += 1
+        try:
+            connection = await self._open()
+        finally:
+            async with self._opened:
+                self._opening -= 1
+                self._opened.notify_all()
+        async with self._opened:
+            self.connections.append(connection)
+            self._opened.notify_all()
+        return connection
+
+    async def _open(self):
+        connection = await connect(self.host, self.port, self.codecs)
+        if self.username is not None:
+            reply = await connection.login(self.username, self.password)
+            if not logged_in(reply):
+                await connection.close()
+                raise ClientError(reply.strip())
+        for folder in self.folders:
+            await connection.change_folder(folder)
+        return connection
+
+    async def request(self, command, body=None):
+        """Sends one command on the least busy connection, returns the reply."""
+        return await (await self.connection()).request(command, body)
+
+    async def change_folder(self, folder):
+        """Moves every connection, and the ones opened later, to folder."""
+        self.folders.append(folder)
+        replies = await asyncio.gather(*[connection.change_folder(folder)
+                                         for connection in self.connections])
+        return replies[0] if replies else "\nSuccessfully moved to folder " + folder
+
+    async def upload_many(self, paths):
+        """Uploads local files in parallel, returns the replies."""
+        async def upload(path):
+            return await (await self.connection()).upload(path)
+        return await asyncio.gather(*[upload(path) for path in paths])
+
+    async def download_many(self, filenames, directory="."):
+        """Downloads files in parallel to directory, returns their sizes."""
+        async def download(filename):
+            connection = await self.connection()
+            return await connection.download(filename, os.path.join(directory, filename))
+        return await asyncio.gather(*[download(filename) for filename in filenames])
+
+    async def _each_range(self, ranges, transfer, retries):
+        """Runs transfer(connection, offset, length) for every range, at
+        most two per connection at once, retrying the failed ones."""
+        running = asyncio.Semaphore(2 * self.size)
+
+        async def run(offset, length):
+            async with running:
+                for attempt in range(retries + 1):
+                    try:
+                        return await transfer(await self.connection(), offset, length)
+                    except ClientError:
+                        if attempt == retries:
+                            raise
+            return None
+
+        return await asyncio.gather(*[run(offset, length) for offset, length in ranges])
+
+    async def upload_parallel(self, path, filename=None, range_size=RANGE_SIZE,
+                              retries=RANGE_RETRIES):
+        """
+        Uploads a local file as ranges sent over the connections of the
+        pool, then replaces the file on the server with it at once.
+        Ranges the server already has, from an earlier interrupted
+        call, are not sent again.
+
+        Returns
+        -------
+        str
+            The reply of the server to upload_commit
+        """
+        filename = os.path.basename(path) if filename is None else filename
+        size = os.path.getsize(path)
+        received = set(await (await self.connection()).upload_begin(filename, size))
+        ranges = [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)]
+
+        async def transfer(connection, offset, length):
+            return await connection.upload_range(path, filename, offset, length)
+
+        await self._each_range([item for item in ranges if item not in received], transfer, retries)
+        return await (await self.connection()).upload_commit(filename)
+
+    async def download_parallel(self, filename, path=None, range_size=RANGE_SIZE,
+                                retries=RANGE_RETRIES):
+        """
+        Downloads a file as ranges received over the connections of the
+        pool into path.part, renamed to path, by default the name of the
+        file, once complete. The ranges received are listed in
+        path.part.ranges, so a call interrupted is resumed by the next
+        one as long as the file did not change on the server.
+
+        Returns
+        -------
+        int
+            Size of the file
+
+        Raises
+        ------
+        ClientError
+            If a range cannot be received, or the file changed during
+            the download
+        """
+        path = filename if path is None else path
+        partial, journal_path = path + ".part", path + ".part.ranges"
+        first = bytearray()
+        _, size, version = await (await self.connection()).download_range(
+            filename, 0, range_size, first.extend)
+        done = set()
+        if os.path.exists(partial) and os.path.exists(journal_path):
+            with open(journal_path) as journal:
+                lines = journal.read().split("\n")
+            if lines[0] == version:
+                done = {tuple(int(word) for word in line.split(" ")) for line in lines[1:] if line}
+        if not done:
+            with open(partial, "wb") as file:
+                file.truncate(size)
+            with open(journal_path, "w") as journal:
+                journal.write(version + "\n")
+        descriptor = os.open(partial, os.O_WRONLY)
+        try:
+            with open(journal_path, "a") as journal:
+                os.pwrite(descriptor, first, 0)
+                journal.write("0 %d\n" % len(first))
+
+                async def transfer(connection, offset, length):
+                    position = offset
+
+                    def write(chunk):
+                        nonlocal position
+                        os.pwrite(descriptor, chunk, position)
+                        position += len(chunk)
+
+                    _, _, range_version = await connection.download_range(filename, offset,
+                                                                          length, write)
+                    if range_version != version:
+                        raise ClientError(f"{filename} changed during the download")
+                    journal.write("%d %d\n" % (offset, length))
+                    journal.flush()
+
+                ranges = [(offset, min(range_size, size - offset))
+                          for offset in range(len(first), size, range_size)]
+                await self._each_range([item for item in ranges if item not in done],
+                                       transfer, retries)
+        finally:
+            os.close(descriptor)
+        os.replace(partial, path)
+        os.remove(journal_path)
+        return size
+
+    async def close(self):
+        """Logs out and closes every connection."""
+        connections, self.connections = self.connections, []
+        if connections and self.username is not None and connections[0].error is None:
+            await connections[0].quit()
+        await asyncio.gather(*[connection.close() for connection in connections])
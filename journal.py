@@ -0,0 +1,248 @@
+"""
+This program keeps a CSV file as a write-ahead journal: rows are
+appended under a file lock, flushed to the disk with group commit and
+compacted into a snapshot of the rows still needed.
+"""
+
+import contextlib
+import csv
+import fcntl
+import io
+import os
+import threading
+
+SNAPSHOT_SUFFIX = ".snapshot"
+
+
+def _format(fields):
+    """Returns one CSV row, quoted where a field needs it."""
+    line = io.StringIO()
+    csv.writer(line, lineterminator="\n").writerow(fields)
+    return line.getvalue().encode()
+
+
+class Journal:
+    """
+
+    CSV file used as an append-only journal of changes, shared by the
+    threads of a process and by several processes. Every row is
+    appended with one write under an exclusive file lock, so the rows
+    of concurrent writers never mix, and the journal is read from where
+    the last look stopped, so a lookup rarely touches the file.
+
+    A writer returns once its row is on the disk, through group commit:
+    the first waiting writer flushes the file with fsync on behalf of
+    every row appended so far, and the writers who appended while it
+    ran share the next one. Under load many changes share one fsync.
+
+    compact writes the rows still needed to a snapshot file, flushes it
+    and renames it over the journal. The other processes notice the new
+    inode and read the snapshot from the start. A row torn by a crash
+    during its write is cut off the end of the file before the next row
+    is appended, so recovering is reading the file.
+
+    Attributes
+    ----------
+    self.path : str
+        CSV file
+    self.heading : str
+        First line of the file
+    self.apply : callable
+        Called with the fields of every row read from the file
+    self.reset : callable
+        Called before the file is read again from the start
+    self.sync : bool
+        Whether commit waits for the rows to be flushed to the disk
+    self.rows : int
+        Rows in the file
+    self.commits, self.fsyncs : int
+        Rows committed and fsync calls made by this process
+
+    Returns
+    -------
+    Object
+        Journal Object
+    """
+
+    def __init__(self, path, heading, apply, reset, sync=True):
+        self.path = path
+        self.heading = heading
+        self.apply = apply
+        self.reset = reset
+        self.sync = sync
+        self.rows = 0
+        self.commits = 0
+        self.fsyncs = 0
+        self.descriptor = None
+        self.offset = 0
+        self.generation = 0
+        self.flushed = 0
+        self.syncing = False
+        self._lock = threading.RLock()
+        self._flush = threading.Condition(threading.Lock())
+
+    def follow(self):
+        """
+        Applies the complete rows appended since the last call, reading
+        the file from the start when it was replaced or rewritten.
+        """
+        with self._lock:
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                inode = None
+            if self.descriptor is None or inode != os.fstat(self.descriptor).st_ino:
+                self._open()
+            size = os.fstat(self.descriptor).st_size
+            if size < self.offset:
+                self._restart(self.descriptor, 0)
+            if size == self.offset:
+                return
+            data = os.pread(self.descriptor, size - self.offset, self.offset)
+            end = data.rfind(b"\n") + 1
+            lines = data[:end].decode().splitlines()
+            if self.offset == 0:
+                lines = lines[1:]
+            for row in csv.reader(lines):
+                if len(row) >= 2:
+                    self.apply(*row[:2])
+                    self.rows += 1
+            self.offset += end
+
+    def _open(self):
+        """Opens the file, creating it with its heading if it is missing."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        descriptor = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        try:
+            if os.fstat(descriptor).st_size == 0:
+                os.write(descriptor, self.heading.encode())
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+        self._restart(descriptor, 0)
+
+    def _restart(self, descriptor, offset, rows=0):
+        """
+        Switches to a new descriptor of the file, read from offset on.
+        Waits for a flush of the previous one to end; rows waiting for
+        it are on the disk already, in the file which replaced it.
+        """
+        with self._flush:
+            while self.syncing:
+                self._flush.wait()
+            if self.descriptor is not None and self.descriptor != descriptor:
+                os.close(self.descriptor)
+            self.descriptor = descriptor
+            self.offset = offset
+            self.generation += 1
+            self.flushed = 0
+            self._flush.notify_all()
+        self.rows = rows
+        if offset == 0:
+            self.reset()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the file lock over the block, with every row appended by
+        other processes applied, so the block decides on the latest
+        state before it writes or compacts.
+        """
+        with self._lock:
+            if self.descriptor is None:
+                self.follow()
+            while True:
+                descriptor = self.descriptor
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                self.follow()
+                if self.descriptor == descriptor:
+                    break
+                # Compacted by another process while waiting for the
+                # lock, closing the old descriptor released it
+            try:
+                if os.fstat(descriptor).st_size != self.offset:
+                    self._repair()
+                yield self
+            finally:
+                # Unless compact closed it along with its lock
+                if self.descriptor == descriptor:
+                    fcntl.flock(descriptor, fcntl.LOCK_UN)
+
+    def _repair(self):
+        """Cuts off a row torn by a crash in the middle of its write,
+        which follow left unread."""
+        size = os.fstat(self.descriptor).st_size
+        if size and os.pread(self.descriptor, 1, size - 1) != b"\n":
+            tail = os.pread(self.descriptor, min(size, 64 * 1024), max(0, size - 64 * 1024))
+            os.ftruncate(self.descriptor, size - len(tail) + tail.rfind(b"\n") + 1)
+
+    def write(self, fields):
+        """
+        Appends one row, inside locked. The caller applies the change
+        itself.
+
+        Returns
+        -------
+        tuple
+            Token to pass to commit
+        """
+        row = _format(fields)
+        os.write(self.descriptor, row)
+        self.offset += len(row)
+        self.rows += 1
+        return self.generation, self.offset
+
+    def commit(self, token):
+        """
+        Returns once the row written with token is on the disk, outside
+        locked so other rows can be appended meanwhile and share the
+        flush.
+        """
+        generation, offset = token
+        with self._flush:
+            self.commits += 1
+            if not self.sync:
+                return
+            while self.generation == generation and self.flushed < offset:
+                if self.syncing:
+                    self._flush.wait()
+                    continue
+                self.syncing = True
+                descriptor, target = self.descriptor, self.offset
+                self._flush.release()
+                try:
+                    os.fsync(descriptor)
+                finally:
+                    self._flush.acquire()
+                    self.syncing = False
+                    self._flush.notify_all()
+                self.fsyncs += 1
+                self.flushed = max(self.flushed, target)
+
+    def compact(self, rows):
+        """
+        Replaces the journal, inside locked, with a snapshot holding
+        the given rows, which must describe the whole state. No row may
+        be written in the same locked block afterwards.
+        """
+        snapshot = self.path + SNAPSHOT_SUFFIX
+        data = self.heading.encode() + b"".join(_format(fields) for fields in rows)
+        descriptor = os.open(snapshot, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.write(descriptor, data)
+            if self.sync:
+                os.fsync(descriptor)
+            os.replace(snapshot, self.path)
+        except BaseException:
+            os.close(descriptor)
+            raise
+        if self.sync:
+            folder = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+            try:
+                os.fsync(folder)
+            finally:
+                os.close(folder)
+        # The snapshot is the journal now, appended to like the file it
+        # replaced; closing the old descriptor releases the lock on it
+        fcntl.fcntl(descriptor, fcntl.F_SETFL, fcntl.fcntl(descriptor, fcntl.F_GETFL) | os.O_APPEND)
+        self._restart(descriptor, len(data), len(rows))
@@ -0,0 +1,428 @@
+"""
+This program keeps an index of the files and folders of every user in
+a sqlite3 database, which answers the find, du and quota commands
+without walking the folders.
+"""
+
+import contextlib
+import os
+import sqlite3
+import stat
+import threading
+import treeops
+from chunkstore import ChunkStore
+from compression import Compression
+
+INDEX_FILE = "MetadataIndex.sqlite3"
+BUSY_TIMEOUT = 30
+FIND_LIMIT = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    user TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (user, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_by_name ON entries (user, name);
+CREATE TABLE IF NOT EXISTS usage (
+    user TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    folders INTEGER NOT NULL
+);
+"""
+
+
+def logical_size(path, size):
+    """Returns the size of the content of a file, as list shows it."""
+    store = ChunkStore.shared()
+    if store is not None:
+        return store.logical_size(path, size)
+    return Compression.shared().logical_size(path, size)
+
+
+def _subtree(folder):
+    """
+    Returns
+    -------
+    tuple
+        SQL condition on the path column and its parameters selecting
+        the entries below folder, all of them for the empty folder
+    """
+    if not folder:
+        return "1", ()
+    # "0" follows "/" in the byte order, so the range holds exactly
+    # the paths starting with folder + "/"
+    return "path > ? AND path < ?", (folder + "/", folder + "0")
+
+
+class MetadataIndex:
+    """
+
+    Process-wide index of the entries below the folder of every user,
+    kept in a sqlite3 database in WAL mode so the worker processes of
+    the server share it. Each entry is keyed by its user and its path
+    relative to the folder of the user, "/"-separated, and holds its
+    name, whether it is a folder, the size of its content and its
+    modification time. The usage table keeps the bytes, files and
+    folders of every user up to date with each change, so a quota check
+    is a single lookup.
+
+    The commands writing files record them as they go. Changes made
+    behind the server, or lost in a crash, are caught up by reconcile,
+    which compares the folders on disk with the index.
+
+    Attributes
+    ----------
+    self.path : str
+        Database file
+    self.quota_bytes : int
+        Bytes of content every user may store, 0 for no limit
+    self.reconciled : int
+        Entries added, changed or removed by reconcile in this process
+
+    Returns
+    -------
+    Object
+        MetadataIndex Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=INDEX_FILE, quota_bytes=0):
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.reconciled = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        MetadataIndex
+            The index used by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, path=INDEX_FILE, quota_bytes=0):
+        """
+        Replaces the shared index, e.g. with the settings given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(path, quota_bytes)
+            return cls._shared
+
+    def _connection(self):
+        """Returns the connection of the calling thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Commits are not flushed to the disk one by one, a crash
+            # may lose the last ones, which reconcile finds again
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Runs the statements of the block as one write transaction."""
+        connection = self._connection()
+        # Takes the write lock up front, a read upgraded to a write
+        # could fail against another process with SQLITE_BUSY
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _put(connection, user, path, entry):
+        """Writes one entry and moves the usage of the user by the difference."""
+        is_dir, size, mtime_ns = entry
+        old = connection.execute("SELECT is_dir, size FROM entries WHERE user = ? AND path = ?",
+                                 (user, path)).fetchone()
+        old_dir, old_size = old if old is not None else (None, 0)
+        connection.execute(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user, path) DO UPDATE "
+            "SET is_dir = excluded.is_dir, size = excluded.size, mtime_ns = excluded.mtime_ns",
+            (user, path, path.rpartition("/")[2], int(is_dir), size, mtime_ns))
+        _add_usage(connection, user, size - old_size,
+                   (not is_dir) - (old_dir == 0), bool(is_dir) - (old_dir == 1))
+
+    def record(self, user, path, full_path):
+        """
+        Brings the entry of a file or folder up to date with the disk,
+        after it was written or created; an entry which no longer
+        exists is removed along with everything below it.
+
+        Parameters
+        ----------
+        user : str
+            Owner of the entry
+        path : str
+            Path of the entry relative to the folder of the user
+        full_path : str
+            Path of the entry on disk
+        """
+        entry = _stat(full_path)
+        with self._transaction() as connection:
+            if entry is None:
+                self._delete(connection, user, path)
+            else:
+                self._put(connection, user, path, entry)
+
+    def record_tree(self, user, path, full_path):
+        """
+        Brings the entries of a folder and everything below it up to
+        date with the disk in one transaction, after a copy wrote them.
+        Entries the index held below the folder which are no longer on
+        disk are removed.
+
+        Parameters
+        ----------
+        user : str
+            Owner of the entries
+        path : str
+            Path of the folder relative to the folder of the user
+        full_path : str
+            Path of the folder on disk
+        """
+        entries = []
+        folders = [(path, full_path)]
+        while folders:
+            parent, folder = folders.pop()
+            entry = _stat(folder)
+            if entry is None:
+                continue
+            entries.append((parent, entry))
+            if not entry[0]:
+                continue
+            try:
+                names = [name for name in os.listdir(folder) if not treeops.hidden(name)]
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            folders.extend((parent + "/" + name if parent else name, os.path.join(folder, name))
+                           for name in names)
+        with self._transaction() as connection:
+            self._delete(connection, user, path)
+            for entry_path, entry in entries:
+                self._put(connection, user, entry_path, entry)
+
+    def move(self, user, old, new):
+        """
+        Moves the entry of a file or folder and everything below it to
+        a new path after a rename, keeping their sizes; whatever the
+        index held at the new path is removed first.
+        """
+        condition, parameters = _subtree(old)
+        with self._transaction() as connection:
+            self._delete(connection, user, new)
+            connection.execute("UPDATE entries SET path = ?, name = ? WHERE user = ? AND path = ?",
+                               (new, new.rpartition("/")[2], user, old))
+            connection.execute("UPDATE entries SET path = ? || substr(path, ?) WHERE user = ? AND "
+                               + condition, (new, len(old) + 1, user) + parameters)
+
+    def remove(self, user, path):
+        """Removes the entry of a file or folder and everything below it."""
+        with self._transaction() as connection:
+            self._delete(connection, user, path)
+
+    @staticmethod
+    def _delete(connection, user, path):
+        """Deletes an entry and everything below it and takes them off the usage of the user."""
+        condition, parameters = _subtree(path)
+        removed = connection.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) - COALESCE(SUM(is_dir), 0), "
+            "COALESCE(SUM(is_dir), 0) FROM entries WHERE user = ? AND (path = ? OR "
+            + condition + ")", (user, path) + parameters).fetchone()
+        connection.execute("DELETE FROM entries WHERE user = ? AND (path = ? OR " + condition + ")",
+                           (user, path) + parameters)
+        _add_usage(connection, user, -removed[0], -removed[1], -removed[2])
+
+    def find(self, user, folder, pattern, limit=FIND_LIMIT):
+        """
+        Looks up the entries below a folder whose name matches a glob
+        pattern, through the index on the names of every user.
+
+        Parameters
+        ----------
+        user : str
+            Owner of the entries
+        folder : str
+            Folder relative to the folder of the user, "" for all of it
+        pattern : str
+            Glob pattern matched against the names, case-sensitive
+        limit : int
+            Largest number of entries returned
+
+        Returns
+        -------
+        list
+            (path, is_dir, size) of at most limit + 1 entries sorted
+            by name then path, the extra one telling that more entries
+            match
+        """
+        # Sorted as the index on the names, which a pattern starting
+        # with a literal prefix narrows to a range and which the query
+        # stops reading after limit + 1 entries
+        condition, parameters = _subtree(folder)
+        return self._connection().execute(
+            "SELECT path, is_dir, size FROM entries WHERE user = ? AND name GLOB ? AND "
+            + condition + " ORDER BY name, path LIMIT ?",
+            (user, pattern) + parameters + (limit + 1,)).fetchall()
+
+    def usage(self, user, folder=""):
+        """
+        Returns
+        -------
+        tuple
+            Bytes, files and folders below a folder of the user, "" for
+            all of it
+        """
+        connection = self._connection()
+        if not folder:
+            row = connection.execute("SELECT bytes, files, folders FROM usage WHERE user = ?",
+                                     (user,)).fetchone()
+            return tuple(row) if row is not None else (0, 0, 0)
+        condition, parameters = _subtree(folder)
+        row = connection.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) - COALESCE(SUM(is_dir), 0), "
+            "COALESCE(SUM(is_dir), 0) FROM entries WHERE user = ? AND " + condition,
+            (user,) + parameters).fetchone()
+        return tuple(row)
+
+    def over_quota(self, user, size):
+        """Tells whether storing size more bytes would take the user beyond the quota."""
+        if not self.quota_bytes:
+            return False
+        return self.usage(user)[0] + size > self.quota_bytes
+
+    def reconcile(self, root):
+        """
+        Compares the folder of every user below root with the index and
+        fixes the entries which differ, e.g. to rebuild a lost index or
+        catch up with files changed behind the server. Unchanged entries
+        are recognised by their modification time without opening the
+        files. Every entry found different is looked at once more right
+        before it is fixed, so a file written while the scan ran keeps
+        the entry recorded by its writer.
+
+        Returns
+        -------
+        int
+            Number of entries added, changed or removed
+        """
+        try:
+            users = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+        except FileNotFoundError:
+            users = []
+        changes = 0
+        for user in users:
+            changes += self._reconcile_user(user, os.path.join(root, user))
+        stale = [row[0] for row in self._connection().execute("SELECT user FROM usage")
+                 if row[0] not in users]
+        for user in stale:
+            with self._transaction() as connection:
+                changes += connection.execute("DELETE FROM entries WHERE user = ?",
+                                              (user,)).rowcount
+                connection.execute("DELETE FROM usage WHERE user = ?", (user,))
+        with self._lock:
+            self.reconciled += changes
+        return changes
+
+    def _reconcile_user(self, user, folder):
+        # The modification time of a folder changes with every entry
+        # added to it and is not kept up to date, folders only have to exist
+        indexed = {path: (is_dir, mtime_ns) for path, is_dir, mtime_ns in self._connection().execute(
+            "SELECT path, is_dir, CASE WHEN is_dir THEN 0 ELSE mtime_ns END FROM entries "
+            "WHERE user = ?", (user,))}
+        found = {}
+        folders = [""]
+        while folders:
+            parent = folders.pop()
+            try:
+                entries = list(os.scandir(os.path.join(folder, parent)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if treeops.hidden(entry.name):
+                    continue
+                path = parent + "/" + entry.name if parent else entry.name
+                try:
+                    stats = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                is_dir = stat.S_ISDIR(stats.st_mode)
+                found[path] = (1, 0) if is_dir else (0, stats.st_mtime_ns)
+                if is_dir:
+                    folders.append(path)
+
+        changed = [path for path, entry in found.items() if indexed.get(path) != entry]
+        removed = [path for path in indexed if path not in found]
+        if not changed and not removed:
+            return 0
+        with self._transaction() as connection:
+            for path in removed:
+                if not os.path.lexists(os.path.join(folder, path)):
+                    self._delete(connection, user, path)
+            for path in changed:
+                entry = _stat(os.path.join(folder, path))
+                if entry is not None:
+                    self._put(connection, user, path, entry)
+        return len(changed) + len(removed)
+
+    def counters(self):
+        """
+        Returns
+        -------
+        dict
+            The entries fixed by reconcile
+        """
+        with self._lock:
+            return {"metadata_index_reconciled": self.reconciled}
+
+
+def _stat(path):
+    """
+    Returns
+    -------
+    tuple
+        Whether the entry is a folder, the size of its content and its
+        modification time, or None if it does not exist
+    """
+    try:
+        stats = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if stat.S_ISDIR(stats.st_mode):
+        return True, 0, stats.st_mtime_ns
+    return False, logical_size(path, stats.st_size), stats.st_mtime_ns
+
+
+def _add_usage(connection, user, size, files, folders):
+    """Moves the usage of a user by the given differences."""
+    if size or files or folders:
+        connection.execute(
+            "INSERT INTO usage VALUES (?, ?, ?, ?) ON CONFLICT (user) DO UPDATE "
+            "SET bytes = bytes + excluded.bytes, files = files + excluded.files, "
+            "folders = folders + excluded.folders", (user, size, files, folders))
@@ -0,0 +1,299 @@
+"""
+This program collects the metrics of the server: per command counts,
+errors and latency histograms, bytes moved and connections. They are
+read through the stats command or scraped in the Prometheus text
+format from a local HTTP endpoint.
+"""
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+
+    Latency histogram with fixed buckets. Observing a value costs a
+    binary search and two additions.
+
+    Attributes
+    ----------
+    self.counts : list
+        Number of values per bucket, the last one counting the values
+        above the largest bucket
+    self.total : float
+        Sum of all the values
+    self.errors : int
+        Number of calls which raised an exception
+    """
+
+    __slots__ = ("counts", "total", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds):
+        """Adds one value."""
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def count(self):
+        """Returns the number of values."""
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding the quantile."""
+        rank = fraction * self.count()
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+
+class Metrics:
+    """
+
+    Process-wide metrics of the server, safe to update from the event
+    loop and from the filesystem threads.
+
+    Attributes
+    ----------
+    self.commands : dict
+        Maps a command to the Histogram of its latency, measured from
+        the request being read to the reply being sent
+    self.handlers : dict
+        Maps a CommandHandler method to the Histogram of its run time
+    self.bytes_in : int
+        Bytes received from the clients
+    self.bytes_out : int
+        Bytes sent to the clients
+    self.active_connections : int
+        Connections currently open
+    self.total_connections : int
+        Connections accepted since the start
+    self.rejected_connections : int
+        Connections closed right away as max_connections were open
+    self.timed_out_connections : int
+        Connections closed as the client was idle or stalled too long
+    self.collectors : list
+        Functions returning a dict of more values to report, e.g. the
+        counters of a cache
+
+    Returns
+    -------
+    Object
+        Metrics Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.commands = {}
+        self.handlers = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.total_connections = 0
+        self.rejected_connections = 0
+        self.timed_out_connections = 0
+        self.started = time.time()
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        Metrics
+            The metrics of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def observe_command(self, command, seconds, error=False):
+        """Records one command served to a client."""
+        self._observe(self.commands, command, seconds, error)
+
+    def observe_handler(self, method, seconds, error=False):
+        """Records one call of a CommandHandler method."""
+        self._observe(self.handlers, method, seconds, error)
+
+    def _observe(self, histograms, name, seconds, error):
+        with self._lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                histogram.errors += 1
+
+    def add_bytes(self, received=0, sent=0):
+        """Records bytes moved on a client connection."""
+        with self._lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def add_collector(self, collector):
+        """Reports the values returned by collector() with the metrics."""
+        self.collectors.append(collector)
+
+    def _collect(self):
+        values = {}
+        for collector in self.collectors:
+            values.update(collector())
+        return values
+
+    def connection_opened(self):
+        """Records a new client connection."""
+        with self._lock:
+            self.active_connections += 1
+            self.total_connections += 1
+
+    def connection_closed(self):
+        """Records a client connection being closed."""
+        with self._lock:
+            self.active_connections -= 1
+
+    def connection_rejected(self):
+        """Records a connection refused as too many were open."""
+        with self._lock:
+            self.rejected_connections += 1
+
+    def connection_timed_out(self):
+        """Records a connection closed by the idle or read timeout."""
+        with self._lock:
+            self.timed_out_connections += 1
+
+    def render_text(self):
+        """
+        Returns
+        -------
+        str
+            Summary of the metrics sent as the reply to stats
+        """
+        with self._lock:
+            lines = ["\nUptime: " + str(int(time.time() - self.started)) + " s",
+                     "Connections: active " + str(self.active_connections)
+                     + ", total " + str(self.total_connections)
+                     + ", rejected " + str(self.rejected_connections)
+                     + ", timed out " + str(self.timed_out_connections),
+                     "Bytes: in " + str(self.bytes_in) + ", out " + str(self.bytes_out),
+                     "Command | Count | Errors | Avg ms | p50 ms | p99 ms"]
+            for name in sorted(self.commands):
+                histogram = self.commands[name]
+                count = histogram.count()
+                lines.append(" | ".join([name, str(count), str(histogram.errors),
+                                         "%.3f" % (histogram.total / count * 1000),
+                                         "%.3f" % (histogram.quantile(0.5) * 1000),
+                                         "%.3f" % (histogram.quantile(0.99) * 1000)]))
+        for name, value in self._collect().items():
+            lines.append(name + ": " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def render_prometheus(self):
+        """
+        Returns
+        -------
+        str
+            The metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            lines = ["# TYPE fms_connections_active gauge",
+                     "fms_connections_active " + str(self.active_connections),
+                     "# TYPE fms_connections_total counter",
+                     "fms_connections_total " + str(self.total_connections),
+                     "# TYPE fms_connections_rejected_total counter",
+                     "fms_connections_rejected_total " + str(self.rejected_connections),
+                     "# TYPE fms_connections_timed_out_total counter",
+                     "fms_connections_timed_out_total " + str(self.timed_out_connections),
+                     "# TYPE fms_bytes_received_total counter",
+                     "fms_bytes_received_total " + str(self.bytes_in),
+                     "# TYPE fms_bytes_sent_total counter",
+                     "fms_bytes_sent_total " + str(self.bytes_out)]
+            for metric, label, histograms in [("fms_command", "command", self.commands),
+                                              ("fms_handler", "method", self.handlers)]:
+                lines.append("# TYPE " + metric + "_seconds histogram")
+                for name in sorted(histograms):
+                    lines += _histogram_lines(metric + "_seconds", label, name, histograms[name])
+                lines.append("# TYPE " + metric + "_errors_total counter")
+                for name in sorted(histograms):
+                    lines.append('%s_errors_total{%s="%s"} %d'
+                                 % (metric, label, name, histograms[name].errors))
+        for name, value in self._collect().items():
+            lines += ["# TYPE fms_" + name + " gauge", "fms_" + name + " " + str(value)]
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(metric, label, name, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s="%s",le="%g"} %d' % (metric, label, name, bound, cumulative))
+    cumulative += histogram.counts[-1]
+    lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, cumulative))
+    lines.append('%s_sum{%s="%s"} %.6f' % (metric, label, name, histogram.total))
+    lines.append('%s_count{%s="%s"} %d' % (metric, label, name, cumulative))
+    return lines
+
+
+def timed(method):
+    """
+    Decorator recording the run time of a CommandHandler method
+    in the shared metrics.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            Metrics.shared().observe_handler(name, time.perf_counter() - start, error)
+    return wrapper
+
+
+async def serve_prometheus(host, port, metrics=None):
+    """
+    Starts a minimal HTTP server answering every request with the
+    metrics in the Prometheus text format.
+
+    Returns
+    -------
+    asyncio.Server
+        The listening server
+    """
+    metrics = Metrics.shared() if metrics is None else metrics
+
+    async def handle(reader, writer):
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = metrics.render_prometheus().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
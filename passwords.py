@@ -0,0 +1,248 @@
+"""
+This program hashes the passwords of the users with a salted key
+derivation function, scrypt or PBKDF2-HMAC-SHA256 from hashlib, whose
+cost is tunable, and keeps the logins it verified so a client logging
+in again does not pay for the hash again.
+"""
+
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SCHEMES = ("scrypt", "pbkdf2")
+DEFAULT_SCHEME = "scrypt"
+# Log2 of scrypt's N, or of the PBKDF2 iterations; both take tens of
+# milliseconds per hash on a current core
+DEFAULT_COST = {"scrypt": 14, "pbkdf2": 19}
+SCRYPT_BLOCK_SIZE = 8
+SALT_BYTES = 16
+KEY_BYTES = 32
+VERIFIED_LOGINS = 10000
+VERIFIED_TTL = 3600
+
+
+def _derive(scheme, cost, password, salt):
+    """Returns the key derived from a password, as bytes."""
+    if scheme == "scrypt":
+        n = 2 ** cost
+        return hashlib.scrypt(password, salt=salt, n=n, r=SCRYPT_BLOCK_SIZE, p=1,
+                              maxmem=129 * SCRYPT_BLOCK_SIZE * n + 2**20, dklen=KEY_BYTES)
+    return hashlib.pbkdf2_hmac("sha256", password, salt, 2 ** cost, KEY_BYTES)
+
+
+def hash_password(password, scheme=DEFAULT_SCHEME, cost=None):
+    """
+    Hashes a password with a new random salt.
+
+    Returns
+    -------
+    str
+        <scheme>$<cost>$<salt>$<key>, the salt and key in hex, which
+        is what the registered users file keeps
+    """
+    cost = DEFAULT_COST[scheme] if cost is None else cost
+    salt = os.urandom(SALT_BYTES)
+    key = _derive(scheme, cost, password.encode(), salt)
+    return "$".join([scheme, str(cost), salt.hex(), key.hex()])
+
+
+def parse(stored):
+    """
+    Returns
+    -------
+    tuple
+        The scheme, cost, salt and key of a stored hash, or None if it
+        is a password kept in plain text by an older server
+    """
+    fields = stored.split("$")
+    if len(fields) != 4 or fields[0] not in SCHEMES or not fields[1].isdigit():
+        return None
+    try:
+        return fields[0], int(fields[1]), bytes.fromhex(fields[2]), bytes.fromhex(fields[3])
+    except ValueError:
+        return None
+
+
+def verify_password(password, stored):
+    """Tells whether a password matches a stored hash, or a password
+    kept in plain text, in a time which does not depend on where they
+    differ."""
+    parsed = parse(stored)
+    if parsed is None:
+        return hmac.compare_digest(password.encode(), stored.encode())
+    scheme, cost, salt, key = parsed
+    return hmac.compare_digest(_derive(scheme, cost, password.encode(), salt), key)
+
+
+class PasswordHasher:
+    """
+
+    Process-wide hasher of the passwords. The hashes run on a pool of
+    processes, so a burst of logins is spread over every core rather
+    than taking turns for the interpreter, and the threads waiting for
+    them, not the event loop, are the only ones held up. With zero
+    processes the hashes run on the calling thread.
+
+    A login whose password was verified is remembered for VERIFIED_TTL
+    seconds: a keyed digest of the password, never the password, and
+    the stored hash it matched. The same user and password are then
+    accepted without hashing until the stored hash changes. Wrong
+    passwords are never remembered and always pay the full cost.
+
+    Attributes
+    ----------
+    self.scheme : str
+        scrypt or pbkdf2, for the new hashes
+    self.cost : int
+        Log2 of the work of a new hash
+    self.processes : int
+        Processes hashing the passwords, 0 hashes on the calling thread
+    self.max_verified : int
+        Logins remembered at most, 0 remembers none
+    self.verified : dict
+        Maps a username to the digest of its verified password, the
+        stored hash it matched and when it is forgotten, least recently
+        used first
+    self.hashes, self.cache_hits : int
+        Passwords hashed, and logins accepted without hashing
+
+    Returns
+    -------
+    Object
+        PasswordHasher Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, scheme=DEFAULT_SCHEME, cost=None, processes=0,
+                 max_verified=VERIFIED_LOGINS):
+        if scheme not in SCHEMES:
+            raise ValueError("Unknown password hash " + scheme)
+        self.scheme = scheme
+        self.cost = DEFAULT_COST[scheme] if cost is None else cost
+        self.processes = processes
+        self.max_verified = max_verified
+        self.verified = {}
+        self.hashes = 0
+        self.cache_hits = 0
+        self._secret = os.urandom(32)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        PasswordHasher
+            The hasher used by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, scheme=DEFAULT_SCHEME, cost=None, processes=0,
+                  max_verified=VERIFIED_LOGINS):
+        """
+        Replaces the shared hasher, e.g. with the settings given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.shutdown()
+            cls._shared = cls(scheme, cost, processes, max_verified)
+            return cls._shared
+
+    def hash(self, password):
+        """Returns the stored form of a new password, hashed with a new salt."""
+        return self._run(hash_password, password, self.scheme, self.cost)
+
+    def verify(self, user_id, password, stored):
+        """
+        Tells whether a password matches the hash stored for a user,
+        hashing it only if this login was not verified lately.
+        """
+        digest = hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self.verified.pop(user_id, None)
+            if entry is not None and entry[1] == stored and entry[2] > now \
+                    and hmac.compare_digest(entry[0], digest):
+                # Put back at the end, as the most recently used
+                self.verified[user_id] = entry
+                self.cache_hits += 1
+                return True
+        if not self._run(verify_password, password, stored):
+            return False
+        self._remember(user_id, digest, stored)
+        return True
+
+    def remember(self, user_id, password, stored):
+        """Remembers a password as verified against a stored hash, e.g.
+        the hash just made for it."""
+        self._remember(user_id, hmac.new(self._secret, password.encode(), hashlib.sha256).digest(),
+                       stored)
+
+    def _remember(self, user_id, digest, stored):
+        if not self.max_verified:
+            return
+        with self._lock:
+            self.verified.pop(user_id, None)
+            self.verified[user_id] = (digest, stored, time.monotonic() + VERIFIED_TTL)
+            if len(self.verified) > self.max_verified:
+                del self.verified[next(iter(self.verified))]
+
+    def needs_rehash(self, stored):
+        """Tells whether a stored password is in plain text or hashed
+        with another scheme or cost than the new hashes."""
+        parsed = parse(stored)
+        return parsed is None or parsed[:2] != (self.scheme, self.cost)
+
+    def start(self):
+        """
+        Starts the hashing processes, which are otherwise started by the
+        first hash. The server starts them before any of its threads, as
+        the processes are forked and a thread holding a lock at that
+        moment would leave it locked in every one of them.
+        """
+        with self._lock:
+            if self.processes and self._executor is None:
+                self._executor = ProcessPoolExecutor(self.processes,
+                                                     multiprocessing.get_context("fork"))
+                # All the processes of a forking pool start with its first job
+                self._executor.submit(int).result()
+            return self._executor
+
+    def _run(self, function, *args):
+        with self._lock:
+            self.hashes += 1
+        executor = self.start()
+        if executor is None:
+            return function(*args)
+        return executor.submit(function, *args).result()
+
+    def counters(self):
+        """
+        Returns
+        -------
+        dict
+            The passwords hashed and the logins accepted without hashing
+        """
+        with self._lock:
+            return {"password_hashes": self.hashes, "password_cache_hits": self.cache_hits}
+
+    def shutdown(self):
+        """Stops the hashing processes, once the running hashes are finished."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Waited for, a worker of the server leaves through os._exit
+            # which would leave the processes behind
+            executor.shutdown(wait=True)
@@ -0,0 +1,717 @@
+"""
+This program defines the two wire protocols understood by the server.
+
+The text protocol sends one command per socket read and one reply per
+command, exactly as the first versions of client.py did.
+
+The framed protocol prefixes every message with a 5 byte header: a one
+byte opcode followed by the payload length as a 4 byte big-endian
+unsigned integer. Payloads may carry binary data, and as replies are
+sent in the order the commands arrived a client may send several
+commands before reading any reply. A framed client opens the
+connection with a HELLO frame; text commands never start with a zero
+byte, which is how the server tells the two apart. The HELLO payload
+may list, after the version and a space, the comma separated codecs
+the client can decompress; files stored compressed with one of them
+are then streamed in ZDATA frames holding the stored blocks.
+
+A client watching folders is sent the changes to their files as they
+happen, between two replies: one EVENT frame per change holding its
+kind and the path of the file, e.g. "modified docs/a.txt", or with the
+text protocol a block of "Event <kind> <path>" lines.
+
+Both channels enforce the Limits of the server: a client waiting
+longer than the idle timeout between two commands, or taking longer
+than the read timeout to send the rest of a command or to take the
+reply off the output buffer, gets its connection closed.
+"""
+
+import asyncio
+import mmap
+import os
+import struct
+import threading
+
+HEADER = struct.Struct("!BI")
+MAX_PAYLOAD = 64 * 1024 * 1024
+TEXT_READ_SIZE = 4096
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+PROTOCOL_VERSION = b"FMS/1"
+SUPPORTED_CODECS = ("zlib", "lzma")
+
+HELLO = 0x00
+COMMAND = 0x01
+RESPONSE = 0x02
+DATA = 0x03
+END = 0x04
+ERROR = 0x05
+ZDATA = 0x06
+EVENT = 0x07
+
+MAX_CONNECTIONS = 1024
+IDLE_TIMEOUT = 300
+READ_TIMEOUT = 30
+OUTPUT_BUFFER = 256 * 1024
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame which breaks the framed protocol.
+    """
+
+
+def write_frame(writer, opcode, payload=b""):
+    """
+    Writes one frame. The payload is written after the header
+    without being copied into a new buffer.
+
+    Parameters
+    ----------
+    writer : StreamWriter
+        Writes data to the socket
+    opcode : int
+        Type of the frame
+    payload : bytes
+        Content of the frame
+    """
+    writer.write(HEADER.pack(opcode, len(payload)))
+    if payload:
+        writer.write(payload)
+
+
+async def read_frame(reader):
+    """
+    Reads one frame.
+
+    Parameters
+    ----------
+    reader : StreamReader
+        Reads data from the socket
+
+    Returns
+    -------
+    tuple
+        Opcode and payload of the frame
+
+    Raises
+    ------
+    asyncio.IncompleteReadError
+        If the peer closed the connection
+    ProtocolError
+        If the payload is longer than MAX_PAYLOAD
+    """
+    opcode, length = unpack_header(await reader.readexactly(HEADER.size))
+    payload = await reader.readexactly(length) if length else b""
+    return opcode, payload
+
+
+def unpack_header(header):
+    """
+    Returns
+    -------
+    tuple
+        Opcode and payload length of a frame header
+
+    Raises
+    ------
+    ProtocolError
+        If the payload is longer than MAX_PAYLOAD
+    """
+    opcode, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise ProtocolError("Frame of " + str(length) + " bytes is too large")
+    return opcode, length
+
+
+async def send_file(writer, file, drain=None, offset=0, count=None):
+    """
+    Sends the content of an open file. The kernel copies the file
+    to the socket with sendfile() where the event loop supports it,
+    otherwise the file is memory-mapped and its pages are handed to the
+    transport, so the content never becomes a Python bytes object.
+
+    Parameters
+    ----------
+    writer : StreamWriter
+        Writes data to the socket
+    file : file object
+        File opened in binary mode, or an object whose parts() method
+        yields the files making up its content, e.g. a ChunkedFile, or
+        an async iterator of the chunks of the content
+    drain : coroutine function
+        Waits for the output buffer to drain, writer.drain by default
+    offset : int
+        Offset of the first byte sent from a file opened in binary mode
+    count : int
+        Number of bytes sent from such a file, by default up to its end
+
+    Returns
+    -------
+    int
+        Number of bytes sent
+    """
+    if drain is None:
+        drain = writer.drain
+    if hasattr(file, "__aiter__"):
+        sent = 0
+        async for chunk in file:
+            writer.write(chunk)
+            sent += len(chunk)
+            await drain()
+        return sent
+    parts = getattr(file, "parts", None)
+    if parts is not None:
+        sent = 0
+        for part in parts():
+            with part:
+                sent += await send_file(writer, part, drain)
+        return sent
+    size = os.fstat(file.fileno()).st_size - offset
+    if count is not None:
+        size = min(size, count)
+    if size <= 0:
+        return 0
+    await drain()
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.sendfile(writer.transport, file, offset, size, fallback=False)
+    except (asyncio.SendfileNotAvailableError, NotImplementedError):
+        pass
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            for start in range(offset, offset + size, SENDFILE_CHUNK_SIZE):
+                writer.write(view[start:min(start + SENDFILE_CHUNK_SIZE, offset + size)])
+                await drain()
+    return size
+
+
+class Limits:
+    """
+
+    Limits every client connection of the server is held to.
+
+    Attributes
+    ----------
+    self.max_connections : int
+        Connections served at once, the ones beyond are closed as
+        soon as they are accepted
+    self.idle_timeout : float
+        Seconds a client may wait before sending its next command,
+        None to wait forever
+    self.read_timeout : float
+        Seconds a client may take to send the rest of a command or of
+        an upload once started, or to read the reply filling the output
+        buffer, None to wait forever
+    self.output_buffer : int
+        Bytes of replies queued for a client before the server waits
+        for them to be sent; a reply may overshoot it by one chunk
+
+    Returns
+    -------
+    Object
+        Limits Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, output_buffer=OUTPUT_BUFFER):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.output_buffer = output_buffer
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        Limits
+            The limits of the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                  read_timeout=READ_TIMEOUT, output_buffer=OUTPUT_BUFFER):
+        """
+        Replaces the shared limits, e.g. with the ones given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(max_connections, idle_timeout, read_timeout, output_buffer)
+            return cls._shared
+
+
+class Watchdog:
+    """
+
+    Closes a connection whose client keeps the server waiting past a
+    deadline. Setting the deadline only stores it: a single timer per
+    connection checks it when it fires and is moved to the deadline
+    then, so a connection serving many commands does not create and
+    cancel a timer per read as asyncio.wait_for would. A connection
+    past its deadline is aborted and its pending and next reads raise
+    asyncio.TimeoutError.
+
+    Attributes
+    ----------
+    self.deadline : float
+        Event loop time the client must be done by, or None
+    self.expired : bool
+        True once the connection was closed for missing the deadline
+    """
+
+    __slots__ = ("reader", "writer", "loop", "deadline", "timer", "expired")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.deadline = None
+        self.timer = None
+        self.expired = False
+
+    def expect(self, timeout):
+        """Gives the client timeout seconds, or forever if None."""
+        if timeout is None:
+            self.deadline = None
+            return
+        self.deadline = self.loop.time() + timeout
+        if self.timer is not None and self.timer.when() > self.deadline:
+            self.timer.cancel()
+            self.timer = None
+        if self.timer is None:
+            self.timer = self.loop.call_at(self.deadline, self._check)
+
+    def _check(self):
+        self.timer = None
+        if self.deadline is None:
+            return
+        if self.loop.time() < self.deadline:
+            self.timer = self.loop.call_at(self.deadline, self._check)
+            return
+        self.expired = True
+        self.reader.set_exception(asyncio.TimeoutError())
+        self.writer.transport.abort()
+
+    def cancel(self):
+        """Stops watching the connection, once it is closed."""
+        self.deadline = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class Channel:
+    """
+
+    Counts the bytes a server side channel moves, for the metrics,
+    holds the connection to its Limits through its Watchdog and sends
+    the changes to the folders it watches between two replies. There is
+    one per connection, so the channels keep their state in slots and
+    only make the subscriptions of a watch when the client watches a
+    folder.
+
+    Attributes
+    ----------
+    self.bytes_in : int
+        Bytes received since the last call of take_bytes
+    self.bytes_out : int
+        Bytes sent since the last call of take_bytes
+    self.limits : Limits
+        Timeouts and output buffer size of the connection
+    self.watchdog : Watchdog
+        Closes the connection when the client misses a timeout
+    self.send_lock : asyncio.Lock
+        Held while a command runs, so changes are not sent in the
+        middle of its reply. Made with the channel, a watch starting
+        while a command holds it must not swap it for another one
+    self.subscriptions : dict
+        Maps every folder watched to its Subscription, or None until
+        the first watch; the client may then wait for changes past the
+        idle timeout
+    """
+
+    __slots__ = ("reader", "writer", "bytes_in", "bytes_out", "limits", "watchdog", "send_lock",
+                 "subscriptions")
+
+    def _watch(self, limits, watchdog):
+        self.bytes_in = self.bytes_out = 0
+        self.limits = Limits.shared() if limits is None else limits
+        self.watchdog = Watchdog(self.reader, self.writer) if watchdog is None else watchdog
+        self.send_lock = asyncio.Lock()
+        self.subscriptions = None
+
+    def watching(self):
+        """
+        Returns
+        -------
+        dict
+            The subscriptions of the channel, to add a watch to
+        """
+        if self.subscriptions is None:
+            self.subscriptions = {}
+        return self.subscriptions
+
+    def _idle_timeout(self):
+        return None if self.subscriptions else self.limits.idle_timeout
+
+    def take_bytes(self):
+        """
+        Returns
+        -------
+        tuple
+            Bytes received and sent since the last call
+        """
+        counts = self.bytes_in, self.bytes_out
+        self.bytes_in = self.bytes_out = 0
+        return counts
+
+    async def drain(self):
+        """
+        Waits until the output buffer is below the output_buffer limit,
+        at most read_timeout seconds.
+
+        Raises
+        ------
+        asyncio.TimeoutError
+            If the client does not read what it was sent
+        """
+        if not self.writer.transport.get_write_buffer_size():
+            # Nothing queued, drain only raises if the connection was lost
+            await self.writer.drain()
+            return
+        self.watchdog.expect(self.limits.read_timeout)
+        await self.writer.drain()
+        self.watchdog.expect(None)
+
+    async def send_events(self, events):
+        """
+        Sends changes to the watched folders once no reply is being
+        sent. The watchdog keeps the deadline of the command being
+        read, so the changes get their own read_timeout to drain; a
+        client missing it has its connection closed.
+
+        Parameters
+        ----------
+        events : list
+            (kind, path) of every change
+        """
+        async with self.send_lock:
+            if self.writer.is_closing():
+                return
+            self._write_events(events)
+            if not self.writer.transport.get_write_buffer_size():
+                return
+            try:
+                await asyncio.wait_for(self.writer.drain(), self.limits.read_timeout)
+            except asyncio.TimeoutError:
+                self.reader.set_exception(asyncio.TimeoutError())
+                self.writer.transport.abort()
+            except ConnectionError:
+                self.writer.transport.abort()
+
+    def _write_events(self, events):
+        raise NotImplementedError
+
+
+class TextChannel(Channel):
+    """
+
+    Server side of the text protocol.
+
+    Attributes
+    ----------
+    self.reader : StreamReader
+        Reads data from the client socket
+    self.writer : StreamWriter
+        Writes data to the client socket
+    self.pending : bytes
+        Bytes read while detecting the protocol, not yet handled
+    """
+
+    __slots__ = ("pending",)
+    framed = False
+    codecs = ()
+
+    def __init__(self, reader, writer, pending=b"", limits=None, watchdog=None):
+        self.reader = reader
+        self.writer = writer
+        self.pending = pending
+        self._watch(limits, watchdog)
+
+    async def receive(self):
+        """
+        Returns
+        -------
+        tuple
+            The command read from the client and no payload, or None
+            if the client closed the connection
+        """
+        self.watchdog.expect(self._idle_timeout())
+        data = await self.reader.read(TEXT_READ_SIZE - len(self.pending))
+        self.watchdog.expect(None)
+        if not data and not self.pending:
+            return None
+        self.bytes_in += len(data)
+        data = self.pending + data
+        self.pending = b""
+        if data.startswith((b"upload ", b"upload_range ")):
+            # The upload command line is followed by the raw content
+            data, _, self.pending = data.partition(b"\n")
+        return data.decode().strip(), None
+
+    async def receive_payload(self, size, chunk_size):
+        """
+        Yields the size raw bytes sent after an upload command, in
+        chunks of at most chunk_size bytes.
+        """
+        remaining = size
+        if self.pending:
+            chunk, self.pending = self.pending[:remaining], self.pending[remaining:]
+            remaining -= len(chunk)
+            yield chunk
+        while remaining:
+            self.watchdog.expect(self.limits.read_timeout)
+            chunk = await self.reader.read(min(remaining, chunk_size))
+            self.watchdog.expect(None)
+            if not chunk:
+                return
+            self.bytes_in += len(chunk)
+            remaining -= len(chunk)
+            yield chunk
+
+    async def send(self, reply):
+        """Sends the reply to a command."""
+        self._write(reply.encode())
+        await self.drain()
+
+    async def send_stream(self, header, chunks):
+        """
+        Sends the header line followed by the raw chunks of an async
+        iterator, waiting for the socket buffer to drain after every
+        chunk. Without chunks only the header is sent, ended by a newline.
+        """
+        if chunks is None:
+            await self.send(header + "\n")
+            return
+        self._write(header.encode())
+        async for chunk in chunks:
+            self._write(chunk)
+            await self.drain()
+        await self.drain()
+
+    async def send_download(self, header, file, offset=0, count=None):
+        """
+        Sends the header line followed by the raw content of the file,
+        or count bytes of it from offset. Without a file only the
+        header is sent, ended by a newline.
+        """
+        if file is None:
+            await self.send(header + "\n")
+            return
+        self._write(header.encode())
+        self.bytes_out += await send_file(self.writer, file, self.drain, offset, count)
+
+    def _write_events(self, events):
+        self._write("".join("\nEvent " + kind + " " + path for kind, path in events).encode())
+
+    def _write(self, data):
+        self.writer.write(data)
+        self.bytes_out += len(data)
+
+
+class FramedChannel(Channel):
+    """
+
+    Server side of the framed protocol.
+
+    Attributes
+    ----------
+    self.reader : StreamReader
+        Reads data from the client socket
+    self.writer : StreamWriter
+        Writes data to the client socket
+    self.codecs : tuple
+        Codecs the client can decompress
+    """
+
+    __slots__ = ("codecs",)
+    framed = True
+
+    def __init__(self, reader, writer, codecs=(), limits=None, watchdog=None):
+        self.reader = reader
+        self.writer = writer
+        self.codecs = codecs
+        self._watch(limits, watchdog)
+
+    async def receive(self):
+        """
+        Reads the next COMMAND frame. The command line may be followed
+        by a newline and a binary body, e.g. the content of write_file.
+
+        Returns
+        -------
+        tuple
+            The command and its body, or None if the client closed
+            the connection
+        """
+        try:
+            opcode, payload = await self._read_frame(idle=True)
+        except asyncio.IncompleteReadError:
+            return None
+        if opcode != COMMAND:
+            raise ProtocolError("Expected a command frame, got opcode " + str(opcode))
+        line, newline, body = payload.partition(b"\n")
+        return line.decode().strip(), body if newline else None
+
+    async def receive_payload(self, size, chunk_size):
+        """
+        Yields the payloads of the DATA frames sent after an upload
+        command until the END frame. Every frame is read on its own so
+        memory use is bounded by the frame size chosen by the client.
+        """
+        del size, chunk_size
+        while True:
+            opcode, payload = await self._read_frame()
+            if opcode == END:
+                return
+            if opcode != DATA:
+                raise ProtocolError("Expected a data frame, got opcode " + str(opcode))
+            yield payload
+
+    async def send(self, reply):
+        """Sends the reply to a command as a RESPONSE frame."""
+        self._write_frame(RESPONSE, reply.encode())
+        await self.drain()
+
+    async def send_stream(self, header, chunks, opcode=DATA):
+        """
+        Sends the header as a RESPONSE frame followed by one DATA frame,
+        or frame of the given opcode, per chunk of an async iterator and
+        an END frame, waiting for the socket buffer to drain after every
+        chunk. Without chunks only the header is sent.
+        """
+        self._write_frame(RESPONSE, header.encode())
+        if chunks is None:
+            await self.drain()
+            return
+        async for chunk in chunks:
+            self._write_frame(opcode, chunk)
+            await self.drain()
+        self._write_frame(END)
+        await self.drain()
+
+    async def send_download(self, header, file, offset=0, count=None):
+        """
+        Sends the header as a RESPONSE frame followed by the raw content
+        of the file, or count bytes of it from offset, whose size is
+        given in the header, outside of any frame. Without a file only
+        the header is sent.
+        """
+        self._write_frame(RESPONSE, header.encode())
+        if file is None:
+            await self.drain()
+            return
+        self.bytes_out += await send_file(self.writer, file, self.drain, offset, count)
+
+    async def _read_frame(self, idle=False):
+        """Reads one frame, waiting for it to start the idle timeout
+        if idle, else read_timeout."""
+        read_timeout = self.limits.read_timeout
+        self.watchdog.expect(self._idle_timeout() if idle else read_timeout)
+        opcode, length = unpack_header(await self.reader.readexactly(HEADER.size))
+        if length:
+            self.watchdog.expect(read_timeout)
+            payload = await self.reader.readexactly(length)
+        else:
+            payload = b""
+        self.watchdog.expect(None)
+        self.bytes_in += HEADER.size + length
+        return opcode, payload
+
+    def _write_events(self, events):
+        for kind, path in events:
+            self._write_frame(EVENT, (kind + " " + path).encode())
+
+    def _write_frame(self, opcode, payload=b""):
+        write_frame(self.writer, opcode, payload)
+        self.bytes_out += HEADER.size + len(payload)
+
+
+async def open_channel(reader, writer, limits=None):
+    """
+    Detects the protocol spoken by a new client from its first byte.
+
+    Parameters
+    ----------
+    limits : Limits
+        Limits of the connection, by default the shared ones; the
+        output buffer limit is set on the transport
+
+    Returns
+    -------
+    TextChannel or FramedChannel
+        Channel to talk to the client, or None if the client
+        disconnected before sending anything
+
+    Raises
+    ------
+    asyncio.TimeoutError
+        If the client sends nothing for idle_timeout seconds, or
+        stops within the HELLO frame for read_timeout seconds
+    """
+    if limits is None:
+        limits = Limits.shared()
+    writer.transport.set_write_buffer_limits(high=limits.output_buffer)
+    watchdog = Watchdog(reader, writer)
+    try:
+        watchdog.expect(limits.idle_timeout)
+        first = await reader.readexactly(1)
+        if first[0] != HELLO:
+            watchdog.expect(None)
+            return TextChannel(reader, writer, first, limits, watchdog)
+        watchdog.expect(limits.read_timeout)
+        _, length = unpack_header(first + await reader.readexactly(HEADER.size - 1))
+        _, _, offered = (await reader.readexactly(length)).decode().partition(" ")
+        watchdog.expect(None)
+    except asyncio.IncompleteReadError:
+        watchdog.cancel()
+        return None
+    except BaseException:
+        watchdog.cancel()
+        raise
+    codecs = tuple(codec for codec in offered.split(",") if codec in SUPPORTED_CODECS)
+    write_frame(writer, HELLO, b" ".join([PROTOCOL_VERSION, ",".join(codecs).encode()]).strip())
+    await writer.drain()
+    return FramedChannel(reader, writer, codecs, limits, watchdog)
+
+
+async def open_framed_connection(host, port, codecs=()):
+    """
+    Connects to the server and switches the connection to the
+    framed protocol.
+
+    Parameters
+    ----------
+    codecs : tuple
+        Codecs the client decompresses, e.g. SUPPORTED_CODECS, so
+        compressed files may be streamed in ZDATA frames
+
+    Returns
+    -------
+    tuple
+        StreamReader and StreamWriter of the connection
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    write_frame(writer, HELLO, b" ".join([PROTOCOL_VERSION, ",".join(codecs).encode()]).strip())
+    await writer.drain()
+    opcode, _ = await read_frame(reader)
+    if opcode != HELLO:
+        raise ProtocolError("The server does not speak the framed protocol")
+    return reader, writer
@@ -1,58 +1,577 @@
 """[module-docstring]
 """
 
+import argparse
 import asyncio
+import collections
+import copy
+import functools
+import importlib
+import json
+import os
 import signal
 import socket
-from commandhandler import CommandHandler
+import string
+import time
+import traceback
+import protocol
+from commandhandler import CommandHandler, LIST_PAGE_SIZE, STREAM_CHUNK_SIZE, UPLOAD_CHUNK_SIZE
+from compression import Compression, CompressedFile, CODECS
+from blockcache import BlockCache, CACHE_BYTES
+from chunkstore import ChunkStore, ChunkedFile, CHUNK_STORE_DIR
+from dircache import CURSOR_PREFIX
+from dispatcher import Dispatcher, UsageError, UNKNOWN_COMMAND
+from fileio import FileIO, DEFAULT_LIMITS, DEFAULT_THREADS
+from metaindex import MetadataIndex, INDEX_FILE
+from metrics import Metrics, serve_prometheus
+from passwords import PasswordHasher, SCHEMES, DEFAULT_SCHEME, VERIFIED_LOGINS
+from treeops import TreeWorkers, TREE_THREADS
+from userstore import UserStore
+from watcher import FolderWatcher, DEBOUNCE, MAX_DELAY, POLL_INTERVAL
 
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-def client_request(commandhandler, message):
+PORT = 8088
+SHUTDOWN_TIMEOUT = 5
+RESTART_DELAY = 1
+RECONCILE_INTERVAL = 3600
+BATCH_COMMANDS = ("create_folder", "change_folder", "write_file", "read_file", "list")
+MAX_BATCH = 1000
+MAX_WATCHES = 16
+ACTIVE_CONNECTIONS = set()
+
+DISPATCHER = Dispatcher.shared()
+Metrics.shared().add_collector(lambda: BlockCache.shared().counters())
+Metrics.shared().add_collector(lambda: MetadataIndex.shared().counters())
+Metrics.shared().add_collector(lambda: UserStore.shared().counters())
+Metrics.shared().add_collector(lambda: PasswordHasher.shared().counters())
+
+
+@DISPATCHER.command("commands")
+def show_commands(commandhandler, args, payload):
+    """Describes the built-in commands and the ones added by plugins."""
+    del args, payload
+    return commandhandler.commands() + DISPATCHER.help()
+
+
+@DISPATCHER.command("register", 2, 2, usage="Enter correct command")
+def register(commandhandler, args, payload):
+    """register <username> <password>"""
+    del payload
+    return commandhandler.register(args[0], args[1])
+
+
+@DISPATCHER.command("login", 2, 2, usage="Enter Right Command")
+def login(commandhandler, args, payload):
+    """login <username> <password>"""
+    del payload
+    return commandhandler.login(args[0], args[1])
+
+
+@DISPATCHER.command("quit")
+def quit_session(commandhandler, args, payload):
+    """quit"""
+    del args, payload
+    return commandhandler.quit()
+
+
+@DISPATCHER.command("create_folder", 1, 1,
+                    usage="Enter correct command: command --> create_folder <folder-name>")
+def create_folder(commandhandler, args, payload):
+    """create_folder <folder-name>"""
+    del payload
+    return commandhandler.create_folder(args[0])
+
+
+@DISPATCHER.command("change_folder", 1, 1,
+                    usage="Enter correct command: command --> change_folder <folder-name>")
+def change_folder(commandhandler, args, payload):
+    """change_folder <folder-name>"""
+    del payload
+    return commandhandler.change_folder(args[0])
+
+
+@DISPATCHER.command("write_file", 1,
+                    usage="Enter correct command: command -> write_file <file_name> <content>")
+def write_file(commandhandler, args, payload):
+    """write_file <file_name> <content>, framed clients may send the
+    content as the binary payload instead
+    """
+    if payload is not None:
+        return commandhandler.write_file(args[0], payload)
+    return commandhandler.write_file(args[0], " ".join(args[1:]))
+
+
+@DISPATCHER.command("read_file", 1, 3,
+                    usage="Enter correct command: command -> read_file <file_name> [offset] [length]")
+def read_file(commandhandler, args, payload):
+    """read_file <file_name> [offset] [length]"""
+    del payload
+    if not all(arg.isdigit() for arg in args[1:]):
+        raise UsageError()
+    return commandhandler.read_file(args[0], *[int(arg) for arg in args[1:]])
+
+
+@DISPATCHER.command("list", 0, 2, usage="Enter correct command: command -> list [cursor] [limit]")
+def list_folder(commandhandler, args, payload):
+    """list [cursor] [limit]"""
+    del payload
+    cursor, limit = None, None
+    for arg in args:
+        if arg.startswith(CURSOR_PREFIX) and cursor is None:
+            cursor = arg
+        elif arg.isdigit() and int(arg) > 0 and limit is None:
+            limit = int(arg)
+        else:
+            raise UsageError()
+    return commandhandler.list(cursor, limit or LIST_PAGE_SIZE)
+
+
+@DISPATCHER.command("stream_file", 1, 1,
+                    usage="\nEnter correct command: command -> stream_file <file_name>")
+async def stream_file(commandhandler, args, payload, channel):
+    """Sends the whole file named in the stream_file command
+    through the channel, chunk by chunk. A compressed file is sent as
+    its stored blocks to framed clients which decompress its codec.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [file_name]
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    fileio = FileIO.shared()
+    if channel.codecs:
+        header, frames = await fileio.run("stream_file", commandhandler.stream_compressed,
+                                          args[0], channel.codecs)
+        if frames is not None:
+            await channel.send_stream(header, fileio.iterate("stream_file", frames), protocol.ZDATA)
+            return
+        if header is not None:
+            await channel.send_stream(header, None)
+            return
+    header, chunks = await fileio.run("stream_file", commandhandler.stream_file, args[0])
+    if chunks is not None:
+        chunks = fileio.iterate("stream_file", chunks)
+    await channel.send_stream(header, chunks)
+
+
+@DISPATCHER.command("download", 1, 1,
+                    usage="\nEnter correct command: command -> download <file_name>")
+async def download(commandhandler, args, payload, channel):
+    """Sends the whole file named in the download command
+    through the channel without copying it into Python objects.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [file_name]
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    fileio = FileIO.shared()
+    header, file = await fileio.run("download", commandhandler.download, args[0])
+    if file is None:
+        await channel.send_download(header, None)
+        return
+    with file:
+        if isinstance(file, CompressedFile):
+            # Decompressed on the pool, there is no file to sendfile from
+            chunks = iter(functools.partial(file.read, STREAM_CHUNK_SIZE), b"")
+            await channel.send_download(header, fileio.iterate("download", chunks))
+        else:
+            await channel.send_download(header, file)
+
+
+@DISPATCHER.command("upload", 2, 2,
+                    usage="\nEnter correct command: command -> upload <file_name> <size>")
+async def upload(commandhandler, args, payload, channel):
+    """Receives the content following the upload command and writes
+    it to disk chunk by chunk as it arrives.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [file_name, size]
+    payload : bytes
+        Unused, the content follows the command
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    if not args[1].isdigit():
+        raise UsageError()
+    size = int(args[1])
+    fileio = FileIO.shared()
+    error, file_upload = await fileio.run("upload", commandhandler.upload, args[0], size)
+    try:
+        async for chunk in channel.receive_payload(size, UPLOAD_CHUNK_SIZE):
+            if file_upload is not None:
+                await fileio.run("upload", file_upload.write, chunk)
+    except BaseException:
+        # The connection was lost or timed out, keep what arrived and
+        # release the file, which may hold a lock
+        if file_upload is not None:
+            await fileio.run("upload", file_upload.close)
+        raise
+    if file_upload is not None:
+        await channel.send(await fileio.run("upload", file_upload.close))
+        return
+    await channel.send(error)
+
+
+@DISPATCHER.command("upload_begin", 2, 2,
+                    usage="Enter correct command: command -> upload_begin <file_name> <size>")
+def upload_begin(commandhandler, args, payload):
+    """upload_begin <file_name> <size>"""
+    del payload
+    if not args[1].isdigit():
+        raise UsageError()
+    return commandhandler.upload_begin(args[0], int(args[1]))
+
+
+@DISPATCHER.command("upload_range", 4, 4,
+                    usage="\nEnter correct command: command -> "
+                          "upload_range <file_name> <offset> <length> <sha256>")
+async def upload_range(commandhandler, args, payload, channel):
+    """Receives one range of a ranged upload and writes it at its
+    offset in the staged file as it arrives.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [file_name, offset, length, sha256]
+    payload : bytes
+        Unused, the content follows the command
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    if not (args[1].isdigit() and args[2].isdigit() and len(args[3]) == 64
+            and all(char in string.hexdigits for char in args[3])):
+        raise UsageError()
+    offset, length = int(args[1]), int(args[2])
+    fileio = FileIO.shared()
+    error, range_upload = await fileio.run("upload", commandhandler.upload_range, args[0],
+                                           offset, length, args[3].lower())
+    try:
+        async for chunk in channel.receive_payload(length, UPLOAD_CHUNK_SIZE):
+            if range_upload is not None:
+                await fileio.run("upload", range_upload.write, chunk)
+    except BaseException:
+        if range_upload is not None:
+            await fileio.run("upload", range_upload.close)
+        raise
+    if range_upload is not None:
+        await channel.send(await fileio.run("upload", range_upload.close))
+        return
+    await channel.send(error)
+
+
+@DISPATCHER.command("upload_commit", 1, 1,
+                    usage="Enter correct command: command -> upload_commit <file_name>")
+def upload_commit(commandhandler, args, payload):
+    """upload_commit <file_name>"""
+    del payload
+    return commandhandler.upload_commit(args[0])
+
+
+@DISPATCHER.command("download_range", 3, 3,
+                    usage="\nEnter correct command: command -> "
+                          "download_range <file_name> <offset> <length>")
+async def download_range(commandhandler, args, payload, channel):
+    """Sends length bytes of the file from offset through the
+    channel, preceded by their checksum.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [file_name, offset, length]
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    if not (args[1].isdigit() and args[2].isdigit()):
+        raise UsageError()
+    fileio = FileIO.shared()
+    header, file = await fileio.run("download", commandhandler.download_range, args[0],
+                                    int(args[1]), int(args[2]))
+    if file is None:
+        await channel.send_download(header, None)
+        return
+    offset, length = int(args[1]), int(header.split(" ")[3])
+    with file:
+        if isinstance(file, (CompressedFile, ChunkedFile)):
+            chunks = _read_range(file, offset, length)
+            await channel.send_download(header, fileio.iterate("download", chunks))
+        else:
+            await channel.send_download(header, file, offset, length)
+
+
+def _read_range(file, offset, length):
+    """Yields length bytes of a file-like object from offset, in chunks."""
+    file.seek(offset)
+    while length:
+        chunk = file.read(min(length, STREAM_CHUNK_SIZE))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+@DISPATCHER.command("set_compression", 1, 1,
+                    usage="Enter correct command: command -> set_compression <zlib|lzma|none>")
+def set_compression(commandhandler, args, payload):
+    """set_compression <zlib|lzma|none>"""
+    del payload
+    return commandhandler.set_compression(args[0])
+
+
+@DISPATCHER.command("find", 1, 2, usage="Enter correct command: command -> find <pattern> [limit]")
+def find(commandhandler, args, payload):
+    """find <pattern> [limit]"""
+    del payload
+    if len(args) > 1 and not (args[1].isdigit() and int(args[1]) > 0):
+        raise UsageError()
+    return commandhandler.find(args[0], *[int(arg) for arg in args[1:]])
+
+
+@DISPATCHER.command("du", 0, 1, usage="Enter correct command: command -> du [folder]")
+def disk_usage(commandhandler, args, payload):
+    """du [folder]"""
+    del payload
+    return commandhandler.du(*args)
+
+
+@DISPATCHER.command("quota")
+def quota(commandhandler, args, payload):
+    """quota"""
+    del args, payload
+    return commandhandler.quota()
+
+
+@DISPATCHER.command("batch", usage="Enter correct command: command -> batch <json list of commands>",
+                    raw_args=True)
+def batch(commandhandler, args, payload):
+    """batch <json list of commands>, framed clients may send the list
+    as the payload instead. Every command is a string written as it
+    would be sent on its own in a command frame, e.g.
+    "write_file a.txt\\n<content>". The commands run one after the
+    other in a single call on the filesystem threads, and the reply is
+    a JSON list holding for every command its name and either its reply
+    or the error which kept it from running
     """
-    This function initiates the functions for given commands by user
+    try:
+        operations = json.loads(payload.decode() if payload is not None else "".join(args))
+    except ValueError:
+        raise UsageError() from None
+    if not isinstance(operations, list) or not all(isinstance(operation, str)
+                                                   for operation in operations):
+        raise UsageError()
+    if len(operations) > MAX_BATCH:
+        return "\nA batch holds at most " + str(MAX_BATCH) + " commands"
+    if not commandhandler.is_login:
+        return "\nLogin to Continue"
+    results = []
+    for operation in operations:
+        line, newline, body = operation.partition("\n")
+        command, name, command_args = DISPATCHER.parse(line.strip())
+        result = {"command": name}
+        try:
+            if name not in BATCH_COMMANDS or command is None:
+                result["error"] = "Command " + name + " cannot run in a batch"
+            else:
+                command.check_args(command_args)
+                result["reply"] = str(command.handler(commandhandler, command_args,
+                                                      body.encode() if newline else None))
+        except UsageError:
+            result["error"] = command.usage
+        except OSError as error:
+            # The commands before it already ran, their replies are kept
+            result["error"] = str(error)
+        results.append(result)
+    return "\n" + json.dumps(results)
+
+
+@DISPATCHER.command("watch", 0, 1, usage="Enter correct command: command -> watch [folder]")
+async def watch(commandhandler, args, payload, channel):
+    """Starts sending the client the files created, modified and
+    deleted in a folder, as paths from the user's folder. Changes are
+    gathered until the folder stays quiet for a moment, so a burst of
+    writes to a file is sent as one change, between two replies.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [folder], by default the current path
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
     """
-    command = message.rstrip("\n").rstrip(" ").lstrip(" ").split(" ")[0]
-    if command == "commands":
-        return commandhandler.commands()
-    if command == "register":
-        if len(message.split(" ")) == 3:
-            return commandhandler.register(message.split(" ")[1], message.split(" ")[2])
-        return "Enter correct command"
 
-    if command == "login":
-        if len(message.split(" ")) == 3:
-            return commandhandler.login(message.split(" ")[1], message.split(" ")[2])
-        return "Enter Right Command"
+    del payload
+    fileio = FileIO.shared()
+    error, path, index_path = await fileio.run("watch", commandhandler.watch, *args)
+    if error is not None:
+        await channel.send(error)
+        return
+    name = index_path or "/"
+    subscriptions = channel.watching()
+    if path in subscriptions:
+        await channel.send("\nAlready watching " + name)
+        return
+    if len(subscriptions) >= MAX_WATCHES:
+        await channel.send("\nA connection watches at most " + str(MAX_WATCHES) + " folders")
+        return
+    prefix = index_path + "/" if index_path else ""
 
-    if command == "quit":
-        return commandhandler.quit()
+    def notify(changes):
+        asyncio.ensure_future(channel.send_events([(kind, prefix + filename)
+                                                   for filename, kind in changes]))
 
-    if command == "create_folder":
-        if len(message.split(" ")) == 2:
-            return commandhandler.create_folder(message.split(" ")[1])
-        return "Enter correct command: command --> create_folder <folder-name>"
+    try:
+        subscriptions[path] = await fileio.run(
+            "watch", FolderWatcher.shared().subscribe, path, notify, asyncio.get_running_loop())
+    except OSError as error:
+        await channel.send("\nCannot watch " + name + ": " + error.strerror)
+        return
+    await channel.send("\nWatching " + name + " for changes")
 
-    if command == "change_folder":
-        if len(message.split(" ")) == 2:
-            return commandhandler.change_folder(message.split(" ")[1])
-        return "Enter correct command: command --> change_folder <folder-name>"
 
-    if command == "write_file":
-        if len(message.split(" ")) >= 2:
-            return commandhandler.write_file(message.split(" ")[1], " ".join(message.split(" ")[2:]))
-        return "Enter correct command: command -> write_file <file_name> <content>"
+@DISPATCHER.command("unwatch", 0, 1, usage="Enter correct command: command -> unwatch [folder]")
+async def unwatch(commandhandler, args, payload, channel):
+    """Stops sending the changes to a folder, which may have been
+    deleted since.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [folder], by default the current path
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    path = os.path.normpath(os.path.join(commandhandler.current_dir, *args))
+    subscription = channel.subscriptions.pop(path, None) if channel.subscriptions else None
+    if subscription is None:
+        await channel.send("\nNot watching " + (args[0] if args else "the current path"))
+        return
+    FolderWatcher.shared().unsubscribe(subscription)
+    await channel.send("\nStopped watching " + (args[0] if args else "the current path"))
+
+
+def stop_watching(channel):
+    """This function drops every watch of a connection, once it is
+    closed or its user logged out
+    """
+    watcher = FolderWatcher.shared()
+    while channel.subscriptions:
+        watcher.unsubscribe(channel.subscriptions.popitem()[1])
+
+
+@DISPATCHER.command("tree", 0, 1, usage="Enter correct command: command -> tree [folder]")
+async def tree(commandhandler, args, payload, channel):
+    """Sends the files and folders below a folder, walked on disk,
+    as lines of "<path> | <size>", a chunk at a time.
+    Parameters
+    ----------
+    commandhandler : CommandHandler
+        Command handler of the connection
+    args : list
+        [folder], by default the current path
+    payload : bytes
+        Unused
+    channel : TextChannel or FramedChannel
+        Protocol spoken with the client
+    """
+
+    del payload
+    fileio = FileIO.shared()
+    header, lines = await fileio.run("tree", commandhandler.tree, *args)
+    if lines is not None:
+        lines = fileio.iterate("tree", lines)
+    await channel.send_stream(header, lines)
+
+
+@DISPATCHER.command("copy", 2, 2, usage="Enter correct command: command -> copy <name> <new name>")
+async def copy_entry(commandhandler, args, payload, channel):
+    """copy <name> <new name>, copies a file or a folder on the server
+    and sends how far it got every half a second"""
+    del payload
+    await run_tree_command("copy", channel, commandhandler.copy, *args)
+
+
+@DISPATCHER.command("move", 2, 2, usage="Enter correct command: command -> move <name> <new name>")
+async def move_entry(commandhandler, args, payload, channel):
+    """move <name> <new name>, renames a file or a folder, or copies
+    then deletes it across file systems"""
+    del payload
+    await run_tree_command("move", channel, commandhandler.move, *args)
+
+
+@DISPATCHER.command("delete", 1, 2, usage="Enter correct command: command -> delete [-r] <name>")
+async def delete_entry(commandhandler, args, payload, channel):
+    """delete [-r] <name>, deletes a file or an empty folder, or with -r
+    a folder and everything below it"""
+    del payload
+    if len(args) == 2 and args[0] != "-r":
+        raise UsageError()
+    await run_tree_command("delete", channel, commandhandler.delete, args[-1], len(args) == 2)
+
+
+async def run_tree_command(operation, channel, method, *args):
+    """This function runs a copy, move or delete on the filesystem
+    threads and streams its progress lines. An operation whose client
+    went away is still run to the end, stopping it half way would
+    leave half a tree behind
+    """
+    fileio = FileIO.shared()
+    header, lines = await fileio.run(operation, method, *args)
+    if lines is None:
+        await channel.send_stream(header, None)
+        return
+    try:
+        await channel.send_stream(header, fileio.iterate(operation, lines))
+    except (ConnectionError, asyncio.TimeoutError):
+        await fileio.run(operation, collections.deque, lines, 0)
+        raise
+
 
-    if command == "read_file":
-        if len(message.split(" ")) >= 2:
-            return commandhandler.read_file(message.split(" ")[1])
-        return "Enter correct command: command -> read_file <file_name>"
+@DISPATCHER.command("stats")
+async def stats(commandhandler, args, payload, channel):
+    """Sends the metrics of this server process."""
+    del commandhandler, args, payload
+    await channel.send(Metrics.shared().render_text())
 
-    if command == "list":
-        return commandhandler.list()
 
 async def handle_client(reader, writer):
     """This funtion acknowledges the connection from the client,
+    detects whether it speaks the text or the framed protocol and
     acknowledges the messages from the client
     Parameters
     ----------
@@ -60,34 +579,328 @@ async def handle_client(reader, writer):
         Reads data from the client socket
     writer : StreamWriter
         Writes data to the client socket
+
+    Beyond max_connections the connection is closed at once. A client
+    which disconnects, idles or stalls past the limits has its
+    connection closed, dropping whatever is still queued for it.
     """
 
     client_addr = writer.get_extra_info('peername')
+    limits = protocol.Limits.shared()
+    metrics = Metrics.shared()
+    if len(ACTIVE_CONNECTIONS) >= limits.max_connections:
+        print(f"{client_addr} is rejected, {len(ACTIVE_CONNECTIONS)} connections are open")
+        metrics.connection_rejected()
+        writer.transport.abort()
+        return
     message = f"{client_addr} is connected !!!!"
     print(message)
     commandhandler = CommandHandler()
-    while True:
-        data = await reader.read(4096)
-        message = data.decode().strip()
-        if message == 'exit':
-            break
+    task = asyncio.current_task()
+    ACTIVE_CONNECTIONS.add(task)
+    metrics.connection_opened()
+    aborted = False
+    channel = None
+    try:
+        channel = await protocol.open_channel(reader, writer, limits)
+        while channel is not None:
+            request = await channel.receive()
+            if request is None or request[0] == 'exit':
+                break
+
+            print(f"Received {request[0]} from {client_addr}")
+            await serve_command(commandhandler, channel, *request)
+            # Not kept while the client idles, the payload may be large
+            del request
+    except protocol.ProtocolError as error:
+        protocol.write_frame(writer, protocol.ERROR, str(error).encode())
+    except asyncio.TimeoutError:
+        print(f"{client_addr} timed out")
+        metrics.connection_timed_out()
+        aborted = True
+    except (ConnectionError, asyncio.IncompleteReadError):
+        aborted = True
+    finally:
+        if channel is not None:
+            channel.watchdog.cancel()
+            stop_watching(channel)
+        ACTIVE_CONNECTIONS.discard(task)
+        metrics.connection_closed()
+        print("Close the connection")
+        if aborted:
+            writer.transport.abort()
+        else:
+            writer.close()
+
+
+async def serve_command(commandhandler, channel, message, payload):
+    """This function runs one command received on a connection and
+    records its latency and traffic in the metrics
+    """
+    metrics = Metrics.shared()
+    command, name, args = DISPATCHER.parse(message)
+    start = time.perf_counter()
+    failed = True
+    try:
+        async with channel.send_lock:
+            await DISPATCHER.run(command, name, args, commandhandler, payload, channel)
+        failed = False
+        if channel.subscriptions and not commandhandler.is_login:
+            stop_watching(channel)
+    finally:
+        metrics.observe_command(UNKNOWN_COMMAND if command is None else name,
+                                time.perf_counter() - start, failed)
+        metrics.add_bytes(*channel.take_bytes())
+
 
-        print(f"Received {message} from {client_addr}")
-        writer.write(str(client_request(commandhandler, message)).encode())
-        await writer.drain()
-    print("Close the connection")
-    writer.close()
+def parse_args(argv=None):
+    """This function reads the server options from the command line
+    """
+    parser = argparse.ArgumentParser(description="File management server")
+    parser.add_argument("--host", default=None,
+                        help="address to listen on, by default the address of this host")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--shutdown-timeout", type=float, default=SHUTDOWN_TIMEOUT,
+                        help="seconds open connections get to finish on shutdown")
+    parser.add_argument("--max-connections", type=int, default=protocol.MAX_CONNECTIONS,
+                        help="connections served at once by each worker, more are closed")
+    parser.add_argument("--idle-timeout", type=float, default=protocol.IDLE_TIMEOUT,
+                        help="seconds a client may wait between two commands, 0 waits forever")
+    parser.add_argument("--read-timeout", type=float, default=protocol.READ_TIMEOUT,
+                        help="seconds a client may take to send the rest of a command or "
+                             "upload, or to read a reply off the output buffer, 0 waits forever")
+    parser.add_argument("--output-buffer-kb", type=int, default=protocol.OUTPUT_BUFFER // 1024,
+                        help="KB of replies queued for a client before waiting for it to read them")
+    parser.add_argument("--io-threads", type=int, default=DEFAULT_THREADS,
+                        help="threads running filesystem calls, 0 runs them on the event loop")
+    parser.add_argument("--io-limit", action="append", default=[], metavar="COMMAND=N",
+                        help="most calls of COMMAND running at once, e.g. read_file=8")
+    parser.add_argument("--cache-mb", type=float, default=CACHE_BYTES / 2**20,
+                        help="size of the block cache shared by read_file, 0 disables it")
+    parser.add_argument("--dedup", action="store_true",
+                        help="store file content once per distinct chunk in the chunk store")
+    parser.add_argument("--chunk-store", default=CHUNK_STORE_DIR, metavar="DIR",
+                        help="folder of the chunk store used with --dedup")
+    parser.add_argument("--compress", choices=sorted(CODECS), default=None,
+                        help="store new files compressed with this codec, unless their "
+                             "folder says otherwise with set_compression; not used with --dedup")
+    parser.add_argument("--compress-level", type=int, default=None,
+                        help="compression level, by default 1 which compresses fast")
+    parser.add_argument("--metadata-index", default=INDEX_FILE, metavar="FILE",
+                        help="sqlite3 database indexing the files for find, du and quota")
+    parser.add_argument("--quota-mb", type=float, default=0,
+                        help="MB of content every user may store, 0 for no limit")
+    parser.add_argument("--reconcile-interval", type=float, default=RECONCILE_INTERVAL,
+                        help="seconds between scans of the folders fixing the metadata index, "
+                             "which is also scanned at startup; 0 scans only at startup")
+    parser.add_argument("--no-fsync", action="store_true",
+                        help="reply to register, login and quit before their changes to the "
+                             "user files are flushed to the disk")
+    parser.add_argument("--password-hash", choices=SCHEMES, default=DEFAULT_SCHEME,
+                        help="key derivation function hashing the new passwords")
+    parser.add_argument("--hash-cost", type=int, default=None,
+                        help="log2 of the work of a password hash, scrypt's N or the PBKDF2 "
+                             "iterations, by default 14 for scrypt and 19 for pbkdf2; "
+                             "passwords hashed with another cost are hashed again at login")
+    parser.add_argument("--hash-processes", type=int, default=None,
+                        help="processes hashing the passwords of each worker, by default the "
+                             "cores shared out among the --workers, at least one; 0 hashes "
+                             "them on the filesystem threads")
+    parser.add_argument("--verified-logins", type=int, default=VERIFIED_LOGINS,
+                        help="logins remembered as verified, so the same user and password "
+                             "are not hashed again for an hour; 0 hashes every login")
+    parser.add_argument("--watch-polling", action="store_true",
+                        help="find the changes to watched folders by listing them every "
+                             "--watch-interval seconds, instead of with inotify")
+    parser.add_argument("--watch-interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between two listings of a watched folder when polling")
+    parser.add_argument("--watch-debounce", type=float, default=DEBOUNCE,
+                        help="seconds a watched folder must stay quiet before its changes "
+                             "are sent")
+    parser.add_argument("--tree-threads", type=int, default=TREE_THREADS,
+                        help="threads copying and deleting the files of the copy, move and "
+                             "delete commands, 0 runs them on the filesystem threads")
+    parser.add_argument("--plugin", action="append", default=[], metavar="MODULE",
+                        help="import MODULE, which registers more commands on the dispatcher")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics over HTTP on this port of 127.0.0.1, "
+                             "worker N of --workers uses the port plus N")
+    args = parser.parse_args(argv)
+    if args.host is None:
+        args.host = socket.gethostbyname(socket.gethostname())
+    if args.hash_processes is None:
+        args.hash_processes = max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    return args
+
+
+def configure_io(args):
+    """This function sets up the filesystem thread pool from the options
+    """
+    limits = dict(DEFAULT_LIMITS)
+    # Every login or registration waits on a hashing process, a lower
+    # limit would leave some of the processes idle
+    for command in ("register", "login"):
+        limits[command] = max(limits[command], args.hash_processes)
+    for option in args.io_limit:
+        command, _, limit = option.partition("=")
+        limits[command] = int(limit)
+    FileIO.configure(args.io_threads, limits)
 
 
-async def main():
-    """This function starts the connection between the server and client
+def start_hasher(args):
+    """This function starts the password hashing processes. It is called
+    before the event loop runs, so the forked processes do not inherit
+    the state of the loop and of its threads
     """
-    
-    server = await asyncio.start_server(handle_client, socket.gethostbyname(socket.gethostname()), 8088)
+    PasswordHasher.configure(args.password_hash, args.hash_cost, args.hash_processes,
+                             args.verified_logins).start()
+
+
+async def main(args=None):
+    """This function starts the connection between the server and client.
+    On SIGTERM or SIGINT the server stops accepting connections and gives
+    the open ones shutdown_timeout seconds to finish before closing them.
+    The password hashing processes are started by the caller, with
+    start_hasher, unless args is None
+    """
+    if args is None:
+        args = parse_args()
+        start_hasher(args)
+    configure_io(args)
+    UserStore.configure(sync=not args.no_fsync)
+    protocol.Limits.configure(args.max_connections, args.idle_timeout or None,
+                              args.read_timeout or None, args.output_buffer_kb * 1024)
+    if args.dedup:
+        ChunkStore.configure(args.chunk_store)
+    Compression.configure(args.compress, args.compress_level)
+    BlockCache.configure(int(args.cache_mb * 2**20))
+    index = MetadataIndex.configure(args.metadata_index, int(args.quota_mb * 2**20))
+    FolderWatcher.configure(not args.watch_polling, args.watch_interval, args.watch_debounce,
+                            max(MAX_DELAY, args.watch_debounce))
+    TreeWorkers.configure(args.tree_threads)
+    for plugin in args.plugin:
+        importlib.import_module(plugin)
+
+    server = await asyncio.start_server(handle_client, args.host, args.port,
+                                        reuse_port=args.workers > 1)
     server_listening_ip = server.sockets[0].getsockname()
-    print(f'Serving on {server_listening_ip}')
-    async with server:
-        await server.serve_forever()
+    print(f'Serving on {server_listening_ip} (pid {os.getpid()})')
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = await serve_prometheus("127.0.0.1", args.metrics_port)
+        print(f'Serving metrics on {metrics_server.sockets[0].getsockname()}')
+    reconciler = None
+    if args.reconcile_interval is not None:
+        reconciler = asyncio.ensure_future(reconcile(index, args.reconcile_interval))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    if reconciler is not None:
+        reconciler.cancel()
+    server.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    if ACTIVE_CONNECTIONS:
+        _, pending = await asyncio.wait(ACTIVE_CONNECTIONS, timeout=args.shutdown_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await server.wait_closed()
+    FileIO.shared().shutdown()
+    PasswordHasher.shared().shutdown()
+
+
+async def reconcile(index, interval):
+    """This function scans the folders of the users in the background
+    once at startup, then every interval seconds unless it is 0, and
+    fixes the entries of the metadata index which differ from the disk
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # Runs on its own thread, a long scan would hold up the
+            # commands waiting for the filesystem threads
+            changes = await loop.run_in_executor(None, index.reconcile, CommandHandler.ROOT_DIR)
+            if changes:
+                print(f"Reconciled {changes} entries of the metadata index")
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+        if not interval:
+            return
+        await asyncio.sleep(interval)
+
+
+def run_worker(args, index=0):
+    """This function runs one worker process of the server and never returns.
+    Only the first worker reconciles the metadata index they share
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    args = copy.copy(args)
+    if args.metrics_port is not None:
+        args.metrics_port += index
+    if index:
+        args.reconcile_interval = None
+    code = 0
+    try:
+        start_hasher(args)
+        asyncio.run(main(args))
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)  # pylint: disable=protected-access
+
+
+def supervise(args):
+    """This function forks args.workers processes which all listen on the
+    same port, the kernel spreading the connections among them. A worker
+    exiting on its own is started again; SIGTERM or SIGINT is passed on to
+    every worker and the supervisor returns once all of them have exited
+    """
+    workers = {}
+    stopping = []
+
+    def start_worker(index):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(args, index)
+        workers[pid] = (time.monotonic(), index)
+
+    def stop(signum, _frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        start_worker(index)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = workers.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        started, index = worker
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        if not stopping:
+            start_worker(index)
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    ARGS = parse_args()
+    if ARGS.workers > 1:
+        supervise(ARGS)
+    else:
+        start_hasher(ARGS)
+        asyncio.run(main(ARGS))
@@ -3,11 +3,35 @@ This program defines the unit tests for testing the
 modules of the file server application.
 """
 
+import asyncio
+import hashlib
+import json
 import unittest
 import sys
 import os
 import shutil
-from commandhandler import CommandHandler
+import tempfile
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+import server
+import protocol
+import treeops
+import fmsclient
+from dispatcher import Dispatcher
+from fileio import FileIO
+from metrics import Metrics, serve_prometheus
+from chunkstore import ChunkStore
+from blockcache import BlockCache
+from commandhandler import CommandHandler, MAX_READ_CURSORS
+from metaindex import MetadataIndex, INDEX_FILE
+from compression import Compression, decompress_frame
+from userstore import UserStore, COMPACT_ROWS
+from passwords import PasswordHasher
+from watcher import FolderWatcher, CREATED, MODIFIED, DELETED, coalesce
 
 
 class TestClient(unittest.TestCase):
@@ -29,14 +53,54 @@ class TestClient(unittest.TestCase):
                     command:quit\n""",
                     """change_folder : To change the current path,
                     command:change_folder <name>\n""",
-                    """list : Lists all files in the current path,
-                    command:list\n""",
+                    """list : Lists the files in the current path, a page at a time,
+                    command:list [cursor] [limit]\n""",
                     """read_file : To read content from the file,
-                    command:read_file <name>\n""",
+                    command:read_file <name> [offset] [length]\n""",
+                    """stream_file : To receive the whole file in chunks,
+                    command:stream_file <name>\n""",
+                    """download : To save the whole file locally,
+                    command:download <name>\n""",
                     """write_file : To write content into the file,
                     command:write_file <name> <content>\n""",
+                    """upload : To send <size> bytes of content into the file,
+                    command:upload <name> <size>\n""",
                     """create_folder : To create new folder,
-                    command:create_folder <name>\n"""
+                    command:create_folder <name>\n""",
+                    """stats : Shows the command counts, latencies and traffic of the server,
+                    command:stats\n""",
+                    """set_compression : To store the new files of the current folder compressed,
+                    command:set_compression <zlib|lzma|none>\n""",
+                    """upload_begin : To start or resume an upload sent in ranges,
+                    command:upload_begin <name> <size>\n""",
+                    """upload_range : To send <length> bytes of an upload from <offset>,
+                    command:upload_range <name> <offset> <length> <sha256>\n""",
+                    """upload_commit : To replace the file with the upload once complete,
+                    command:upload_commit <name>\n""",
+                    """download_range : To save <length> bytes of the file from <offset> locally,
+                    command:download_range <name> <offset> <length>\n""",
+                    """find : Lists the files and folders below the current path whose name matches,
+                    command:find <pattern> [limit]\n""",
+                    """du : Shows the bytes, files and folders below the current path or a folder,
+                    command:du [folder]\n""",
+                    """quota : Shows the bytes stored by the user and the most allowed,
+                    command:quota\n""",
+                    """batch : To run many create_folder, change_folder, write_file, read_file
+                    and list commands at once, replying with a JSON list of their replies,
+                    command:batch <json list of commands>\n""",
+                    """watch : To be sent the files created, modified and deleted in the current
+                    path or a folder as they change, until unwatch or the end of the session,
+                    command:watch [folder]\n""",
+                    """unwatch : To stop watching the current path or a folder,
+                    command:unwatch [folder]\n""",
+                    """tree : Lists the files and folders below the current path or a folder,
+                    command:tree [folder]\n""",
+                    """copy : To copy a file or a folder and everything below it,
+                    command:copy <name> <new name>\n""",
+                    """move : To move or rename a file or a folder,
+                    command:move <name> <new name>\n""",
+                    """delete : To delete a file or an empty folder, with -r a folder and everything below it,
+                    command:delete [-r] <name>\n"""
                 ]
         expected = "".join(commands)
 
@@ -160,6 +224,42 @@ class TestClient(unittest.TestCase):
         self.assertEqual(expected, actual)
         test_user.quit()
 
+    def test_write_file_to_folder(self):
+        """Tests if the user is attempting to write content into
+        a folder
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test14", "ohgwoegh2840")
+        test_user.login("test14", "ohgwoegh2840")
+        test_user.create_folder("docs")
+        expected = "\nCannot write to folder docs"
+        actual = test_user.write_file("docs", "Hello World")
+        self.assertEqual(expected, actual)
+        test_user.quit()
+
+    def test_list_pages(self):
+        """Tests if the listing is returned in pages which follow
+        each other through the cursor, and if it sees new files.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test15", "gwhegowh2893")
+        test_user.login("test15", "gwhegowh2893")
+        for name in ["c.txt", "a.txt", "b.txt"]:
+            test_user.write_file(name, "Hello")
+        first = test_user.list(limit=2)
+        names = [line.split(" | ")[0] for line in first.split("\n")[2:] if " | " in line]
+        self.assertEqual(["a.txt", "b.txt"], names)
+        next_page = first.rstrip("\n").split("\n")[-1].split(" ")
+        self.assertEqual(["Next", "page:", "list"], next_page[:3])
+        second = test_user.list(next_page[3], 2)
+        self.assertIn("c.txt | 5 | ", second)
+        self.assertNotIn("Next page", second)
+        test_user.write_file("d.txt", "Hello World")
+        self.assertIn("d.txt | 11 | ", test_user.list(next_page[3], 2))
+        test_user.quit()
+
     def test_read_file(self):
         """Tests if the user is attempting to read content from already 
         existing file
@@ -187,6 +287,1365 @@ class TestClient(unittest.TestCase):
         expected = "\nNo Such file " + filename + " exists!"
         actual = test_user.read_file(filename)
 
+    def test_read_file_window(self):
+        """Tests if the user is able to read a window of the file
+        given an offset and a length
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test12", "gbwsoghwo28g4")
+        test_user.login("test12", "gbwsoghwo28g4")
+        test_user.write_file("w.txt", "0123456789" * 30)
+        expected = "\nReading file from 205 bytes to 210 bytes\n56789"
+        actual = test_user.read_file("w.txt", 205, 5)
+        self.assertEqual(expected, actual)
+        # Reading without an offset still pages from the start
+        expected = "\nReading file from 0 bytes to 4 bytes\n0123"
+        actual = test_user.read_file("w.txt", length=4)
+        self.assertEqual(expected, actual)
+        test_user.quit()
+
+    def test_session_footprint(self):
+        """Tests if the objects made for every connection keep their
+        state in slots, without a __dict__ each.
+        """
+
+        self.assertFalse(hasattr(CommandHandler(), "__dict__"))
+        for kind in (protocol.TextChannel, protocol.FramedChannel, protocol.Watchdog):
+            self.assertEqual(0, kind.__dictoffset__, kind.__name__)
+
+    def test_stream_file(self):
+        """Tests if the streamed chunks add up to the whole file
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test13", "nvbeuw9gh2b")
+        test_user.login("test13", "nvbeuw9gh2b")
+        test_user.write_file("s.txt", "abc" * 1000)
+        header, chunks = test_user.stream_file("s.txt", chunk_size=512)
+        self.assertEqual("\nStreaming s.txt 3000 bytes\n", header)
+        chunks = list(chunks)
+        self.assertEqual(6, len(chunks))
+        self.assertEqual(b"abc" * 1000, b"".join(chunks))
+        test_user.quit()
+
+class TestUserStore(unittest.TestCase):
+    """
+    This class defines the unit tests for the user store
+    shared by all the client connections.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_reloads_users_and_sessions(self):
+        """Tests if registered users and sessions written by one store
+        are read back by a new store.
+        """
+
+        store = UserStore(self.directory)
+        store.add_user("alice", "alicepassword")
+        store.add_user("bob", "bobpassword")
+        store.start_session("alice")
+        store.start_session("bob")
+        store.end_session("alice")
+
+        reloaded = UserStore(self.directory)
+        self.assertTrue(reloaded.check_password("bob", "bobpassword"))
+        self.assertFalse(reloaded.check_password("bob", "alicepassword"))
+        self.assertFalse(reloaded.is_logged_in("alice"))
+        self.assertTrue(reloaded.is_logged_in("bob"))
+
+    def test_store_follows_other_processes(self):
+        """Tests if changes appended by another store using the same
+        files, as another server process would, are picked up.
+        """
+
+        first = UserStore(self.directory)
+        second = UserStore(self.directory)
+        self.assertFalse(second.is_registered("erin"))
+        first.add_user("erin", "erinpassword")
+        self.assertTrue(second.is_registered("erin"))
+        self.assertFalse(second.add_user("erin", "otherpassword"))
+        second.start_session("erin")
+        self.assertTrue(first.is_logged_in("erin"))
+        first.end_session("erin")
+        self.assertFalse(second.is_logged_in("erin"))
+
+    def test_store_reads_legacy_session_file(self):
+        """Tests if a logged in users file in the old username,password
+        format is read and rewritten as login events.
+        """
+
+        with open(os.path.join(self.directory, UserStore.LOGGED_IN_USERS_CSV_FILE), "w") as file:
+            file.write(UserStore.CSV_HEADING + "dave,davepassword\n")
+        store = UserStore(self.directory)
+        self.assertTrue(store.is_logged_in("dave"))
+        store.end_session("dave")
+        self.assertFalse(UserStore(self.directory).is_logged_in("dave"))
+
+    def test_journal_compaction_and_recovery(self):
+        """Tests if the sessions journal is compacted into a snapshot
+        followed by other stores, and if a row torn by a crash is cut off
+        before the next one is appended.
+        """
+
+        store = UserStore(self.directory, sync=False)
+        other = UserStore(self.directory, sync=False)
+        store.start_session("grace")
+        for _ in range(COMPACT_ROWS):
+            store.start_session("heidi")
+            store.end_session("heidi")
+        self.assertLess(store.sessions.rows, COMPACT_ROWS)
+        with open(os.path.join(self.directory, UserStore.LOGGED_IN_USERS_CSV_FILE)) as file:
+            self.assertLess(len(file.readlines()), COMPACT_ROWS)
+        other.load()
+        self.assertEqual({"grace"}, other.logged_in_users)
+        other.start_session("ivan")
+        self.assertTrue(store.is_logged_in("ivan"))
+
+        with open(os.path.join(self.directory, UserStore.LOGGED_IN_USERS_CSV_FILE), "a") as file:
+            file.write("judy,log")
+        recovered = UserStore(self.directory)
+        self.assertFalse(recovered.is_logged_in("judy"))
+        recovered.start_session("judy")
+        recovered.end_session("grace")
+        reloaded = UserStore(self.directory)
+        reloaded.load()
+        self.assertEqual({"ivan", "judy"}, reloaded.logged_in_users)
+        self.assertEqual(2, recovered.counters()["user_store_commits"])
+
+    def test_passwords_are_hashed(self):
+        """Tests if passwords are stored salted and hashed, if passwords
+        in plain text or with another cost are hashed again at login, and
+        if a verified login is not hashed again.
+        """
+
+        store = UserStore(self.directory)
+        store.add_user("oscar", "oscarpassword")
+        store.add_user("olivia", "oscarpassword")
+        with open(os.path.join(self.directory, UserStore.REGISTERED_USERS_CSV_FILE)) as file:
+            rows = file.read().splitlines()[1:]
+        self.assertNotIn("oscarpassword", "".join(rows))
+        self.assertTrue(rows[0].startswith("oscar,scrypt$14$"))
+        self.assertNotEqual(rows[0].split(",")[1], rows[1].split(",")[1])
+
+        with open(os.path.join(self.directory, UserStore.REGISTERED_USERS_CSV_FILE), "a") as file:
+            file.write("peggy,peggypassword\n")
+        hasher = PasswordHasher.configure("pbkdf2", 10)
+        try:
+            reloaded = UserStore(self.directory)
+            self.assertFalse(reloaded.check_password("peggy", "wrongpassword"))
+            self.assertTrue(reloaded.check_password("peggy", "peggypassword"))
+            self.assertTrue(reloaded.registered_users["peggy"].startswith("pbkdf2$10$"))
+            self.assertTrue(reloaded.check_password("oscar", "oscarpassword"))
+            self.assertTrue(reloaded.registered_users["oscar"].startswith("pbkdf2$10$"))
+            hashes = hasher.counters()["password_hashes"]
+            for _ in range(3):
+                self.assertTrue(UserStore(self.directory).check_password("oscar", "oscarpassword"))
+            self.assertFalse(reloaded.check_password("oscar", "olivia"))
+            self.assertEqual({"password_hashes": hashes + 1, "password_cache_hits": 3},
+                             hasher.counters())
+        finally:
+            PasswordHasher.configure()
+
+        pool = PasswordHasher("scrypt", 4, processes=1)
+        try:
+            stored = pool.hash("pooledpassword")
+            self.assertTrue(pool.verify("trent", "pooledpassword", stored))
+            self.assertFalse(pool.verify("trent", "otherpassword", stored))
+        finally:
+            pool.shutdown()
+
+    def test_store_shared_between_handlers(self):
+        """Tests if a user registered through one handler can login
+        through another handler using the same store.
+        """
+
+        store = UserStore(self.directory)
+        first = CommandHandler(user_store=store)
+        second = CommandHandler(user_store=store)
+        first.register("carol", "carolpassword")
+        expected = "Success carol Logged into the system"
+        actual = second.login("carol", "carolpassword")
+        self.assertEqual(expected, actual)
+        second.quit()
+
+
+class TestChunkStore(unittest.TestCase):
+    """
+    This class defines the tests of the deduplicating chunk store
+    used under the commands.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ChunkStore.configure(self.directory, chunk_size=16)
+
+    def tearDown(self):
+        ChunkStore.configure(None)
+        shutil.rmtree(self.directory)
+
+    def test_identical_files_share_chunks(self):
+        """Tests if the same content written by two users is stored once
+        and read back whole, in windows and through list.
+        """
+
+        content = "0123456789abcdef" * 4 + "tail"
+        for user in ["test16", "test17"]:
+            test_user = CommandHandler()
+            test_user.register(user, "gwoeghwoeg284")
+            test_user.login(user, "gwoeghwoeg284")
+            self.assertEqual("\nCreated and written data to file same.txt successfully",
+                             test_user.write_file("same.txt", content))
+            test_user.quit()
+        self.assertEqual(2, self.store.stored_chunks)
+        self.assertEqual(8, self.store.deduplicated_chunks)
+
+        test_user.login("test17", "gwoeghwoeg284")
+        self.assertEqual("\nReading file from 60 bytes to 70 bytes\ncdeftail",
+                         test_user.read_file("same.txt", 60, 10))
+        self.assertIn("same.txt | 68 | ", test_user.list())
+        _, chunks = test_user.stream_file("same.txt", 24)
+        self.assertEqual(content.encode(), b"".join(chunks))
+        _, file = test_user.download("same.txt")
+        self.assertEqual(content.encode(), b"".join(part.read() for part in file.parts()))
+        test_user.quit()
+
+    def test_small_appends_merge_into_last_chunk(self):
+        """Tests if small appends rewrite the last chunk instead of
+        adding a chunk per append.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test18", "bwoegbweog284")
+        test_user.login("test18", "bwoegbweog284")
+        for word in ["abc", "def", "ghi", "jklmnopqrstu"]:
+            test_user.write_file("log.txt", word)
+        path = os.path.join(test_user.current_dir, "log.txt")
+        self.assertEqual([9, 12], [length for _, length in self.store.read_manifest(path)])
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\nabcdefghijklmnopqrstu",
+                         test_user.read_file("log.txt", 0))
+        test_user.quit()
+
+    def test_content_cannot_pass_for_a_manifest(self):
+        """Tests if content looking like a manifest is read back as it
+        was written, and if manifests naming paths as chunks are refused.
+        """
+
+        forged = "FMSDEDUP1\n27\n../rv/secret.txt 27\n"
+        test_user = CommandHandler()
+        test_user.register("test27", "gwoebgwe2846")
+        test_user.login("test27", "gwoebgwe2846")
+        test_user.write_file("chunked.txt", forged)
+        with open(os.path.join(test_user.current_dir, "plain.txt"), "w") as file:
+            file.write(forged)
+        for name in ["chunked.txt", "plain.txt"]:
+            self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + forged,
+                             test_user.read_file(name, 0))
+
+        path = os.path.join(test_user.current_dir, "chunked.txt")
+        self.store.write_manifest(path, [("0" * 64, 4)])
+        self.assertEqual([("0" * 64, 4)], self.store.read_manifest(path))
+        with open(path, "r+b") as file:
+            file.seek(0, os.SEEK_END)
+            file.write(b"../rv/secret.txt 27\n")
+        with self.assertRaises(ValueError):
+            self.store.read_manifest(path)
+        with self.assertRaises(ValueError):
+            self.store.chunk_path("../rv/secret.txt")
+        test_user.quit()
+
+    def test_ranged_uploads_are_stored_like_writes(self):
+        """Tests if a committed ranged upload is stored through the chunk
+        store, or compressed, as write_file would store it.
+        """
+
+        forged = b"FMSDEDUP1\n27\n../rv/secret.txt 27\n"
+        test_user = CommandHandler()
+        test_user.register("test29", "gbwoegbw28465")
+        test_user.login("test29", "gbwoegbw28465")
+
+        def upload(name):
+            test_user.upload_begin(name, len(forged))
+            _, ranged = test_user.upload_range(name, 0, len(forged),
+                                               hashlib.sha256(forged).hexdigest())
+            ranged.write(forged)
+            ranged.close()
+            return test_user.upload_commit(name)
+
+        self.assertEqual("\nAssembled 33 bytes to file up.txt successfully", upload("up.txt"))
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + forged.decode(),
+                         test_user.read_file("up.txt", 0))
+        path = os.path.join(test_user.current_dir, "up.txt")
+        self.assertEqual([16, 16, 1], [length for _, length in self.store.read_manifest(path)])
+
+        ChunkStore.configure(None)
+        test_user.set_compression("zlib")
+        upload("zipped.txt")
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + forged.decode(),
+                         test_user.read_file("zipped.txt", 0))
+        with open(os.path.join(test_user.current_dir, "zipped.txt"), "rb") as file:
+            self.assertTrue(file.read().startswith(b"FMSZ1"))
+        test_user.quit()
+
+
+class TestCompression(unittest.TestCase):
+    """
+    This class defines the tests of the files stored compressed.
+    """
+
+    def setUp(self):
+        Compression.configure("zlib", block_size=64)
+
+    def tearDown(self):
+        Compression.configure()
+
+    def test_compressed_write_and_read(self):
+        """Tests if files are stored compressed in blocks, appended to,
+        read back at any offset and listed with their content size.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test19", "gbwoegbw2947")
+        test_user.login("test19", "gbwoegbw2947")
+        content = "".join("line %04d of the log\n" % number for number in range(20))
+        test_user.write_file("log.txt", content[:50])
+        test_user.write_file("log.txt", content[50:])
+        path = os.path.join(test_user.current_dir, "log.txt")
+        with open(path, "rb") as file:
+            self.assertTrue(file.read().startswith(b"FMSZ1"))
+        self.assertEqual("\nReading file from 100 bytes to 130 bytes\n" + content[100:130],
+                         test_user.read_file("log.txt", 100, 30))
+        self.assertIn("log.txt | " + str(len(content)) + " | ", test_user.list())
+        _, chunks = test_user.stream_file("log.txt", 7)
+        self.assertEqual(content.encode(), b"".join(chunks))
+        _, frames = test_user.stream_compressed("log.txt", ("zlib",))
+        self.assertEqual(content.encode(), b"".join(decompress_frame(frame) for frame in frames))
+        test_user.quit()
+
+    def test_folder_codec(self):
+        """Tests if set_compression changes the codec of new files in
+        the folder and its sub-folders only.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test20", "wegbowegb2847")
+        test_user.login("test20", "wegbowegb2847")
+        test_user.create_folder("raw")
+        test_user.change_folder("raw")
+        self.assertEqual("\nNew files in Root/test20/raw are not compressed",
+                         test_user.set_compression("none"))
+        test_user.create_folder("packed")
+        test_user.change_folder("packed")
+        test_user.set_compression("lzma")
+        test_user.write_file("a.txt", "x" * 1000)
+        self.assertNotIn(".compression", test_user.list())
+        test_user.change_folder("..")
+        test_user.write_file("b.txt", "x" * 1000)
+        self.assertEqual(1000, os.path.getsize("Root/test20/raw/b.txt"))
+        self.assertEqual("lzma", Compression.shared().open_read(
+            open("Root/test20/raw/packed/a.txt", "rb"))[0].codec)
+        self.assertEqual("\nUnknown codec gzip, use one of zlib, lzma, none",
+                         test_user.set_compression("gzip"))
+        test_user.quit()
+
+    def test_content_cannot_pass_for_a_compressed_file(self):
+        """Tests if content starting like a compressed file is read back
+        as it was written, and if a compressed file whose header does
+        not hold together is read as a plain file.
+        """
+
+        Compression.configure()
+        forged = "FMSZ1" + "\x09" * 13 + "hello"
+        test_user = CommandHandler()
+        test_user.register("test28", "gbwoegb28466")
+        test_user.login("test28", "gbwoegb28466")
+        test_user.write_file("a.txt", forged)
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + forged,
+                         test_user.read_file("a.txt", 0))
+        self.assertIn("a.txt | 23 | ", test_user.list())
+        _, file = test_user.download("a.txt")
+        with file:
+            self.assertEqual(forged.encode(), file.read())
+
+        Compression.configure("zlib", block_size=64)
+        test_user.write_file("b.txt", "x" * 100)
+        path = os.path.join(test_user.current_dir, "b.txt")
+        with open(path, "r+b") as file:
+            file.seek(len(b"FMSZ1") + 1 + 4)
+            file.write(struct.pack("!Q", 99))
+        with open(path, "rb") as file:
+            stored = file.read()
+        plain, size = Compression.shared().open_read(open(path, "rb"))
+        with plain:
+            self.assertEqual((stored, len(stored)), (plain.read(), size))
+        with self.assertRaises(ValueError):
+            decompress_frame(b"\x09hello")
+        test_user.quit()
+
+    def test_reads_during_and_after_an_append(self):
+        """Tests if a file being appended to reads as it was until the
+        append is closed, and still does once an append was abandoned
+        without closing it.
+        """
+
+        writer, reader = CommandHandler(), CommandHandler()
+        writer.register("test26", "gwoebgwo2846")
+        writer.login("test26", "gwoebgwo2846")
+        reader.login("test26", "gwoebgwo2846")
+        writer.write_file("log.txt", "a" * 100)
+        path = os.path.join(writer.current_dir, "log.txt")
+
+        def open_append():
+            descriptor = os.open(path, os.O_RDWR | os.O_APPEND)
+            return Compression.shared().open_append(descriptor, path, False, writer.current_dir)
+
+        append = open_append()
+        append.write(b"b" * 100)
+        append.flush()
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + "a" * 100,
+                         reader.read_file("log.txt", 0))
+        append.close()
+        self.assertEqual("a" * 100 + "b" * 100, reader.read_file("log.txt", 0, 300).split("\n")[2])
+
+        abandoned = open_append()
+        abandoned.write(b"c" * 100)
+        abandoned.flush()
+        abandoned.file.close()
+        self.assertEqual("a" * 100 + "b" * 100, reader.read_file("log.txt", 0, 300).split("\n")[2])
+        writer.write_file("log.txt", "d" * 10)
+        self.assertEqual("a" * 100 + "b" * 100 + "d" * 10,
+                         reader.read_file("log.txt", 0, 300).split("\n")[2])
+        writer.quit()
+        reader.quit()
+
+
+class TestBlockCache(unittest.TestCase):
+    """
+    This class defines the tests of the block cache shared by the
+    read_file calls of all the connections.
+    """
+
+    def setUp(self):
+        self.cache = BlockCache.configure(max_bytes=1024, block_size=64)
+
+    def tearDown(self):
+        BlockCache.configure()
+
+    def test_reads_hit_the_cache_until_written(self):
+        """Tests if a second reader hits the blocks read by the first one
+        and if write_file makes the next read see the new content.
+        """
+
+        first, second = CommandHandler(), CommandHandler()
+        first.register("test21", "gowbegwobe284")
+        first.login("test21", "gowbegwobe284")
+        first.write_file("hot.txt", "a" * 100)
+        self.assertEqual("\nReading file from 0 bytes to 100 bytes\n" + "a" * 100,
+                         first.read_file("hot.txt", 0))
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+        second.login("test21", "gowbegwobe284")
+        second.read_file("hot.txt", 60, 10)
+        self.assertEqual((2, 2), (self.cache.hits, self.cache.misses))
+
+        second.write_file("hot.txt", "b" * 10)
+        self.assertNotIn("Root/test21/hot.txt", self.cache.paths)
+        self.assertEqual("\nReading file from 95 bytes to 115 bytes\naaaaabbbbbbbbbb",
+                         first.read_file("hot.txt", 95, 20))
+        first.quit()
+
+    def test_cache_and_cursors_are_bounded(self):
+        """Tests if the cache drops the least recently used blocks beyond
+        its size and if a handler keeps a bounded number of cursors.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test22", "bgowegbwoeg284")
+        test_user.login("test22", "bgowegbwoeg284")
+        for number in range(MAX_READ_CURSORS + 10):
+            test_user.write_file("f%d.txt" % number, "x" * 64)
+            test_user.read_file("f%d.txt" % number)
+        self.assertLessEqual(self.cache.bytes, 1024)
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertEqual(MAX_READ_CURSORS, len(test_user.read_index))
+        self.assertIn("Root/test22/f%d.txt" % (MAX_READ_CURSORS + 9), test_user.read_index)
+        test_user.quit()
+        self.assertEqual(0, len(test_user.read_index))
+
+
+class TestMetadataIndex(unittest.TestCase):
+    """
+    This class defines the tests of the metadata index behind the find,
+    du and quota commands.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = MetadataIndex.configure(os.path.join(self.directory, "index.sqlite3"),
+                                             quota_bytes=1000)
+
+    def tearDown(self):
+        MetadataIndex.configure()
+        shutil.rmtree(self.directory)
+
+    def test_find_du_and_quota(self):
+        """Tests if the commands writing files keep the index up to date
+        for find, du and quota, and if writes beyond the quota are refused.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test23", "gbwoegbw2384")
+        test_user.login("test23", "gbwoegbw2384")
+        test_user.create_folder("docs")
+        test_user.write_file("a.txt", "x" * 100)
+        test_user.change_folder("docs")
+        test_user.create_folder("old")
+        test_user.write_file("b.txt", "y" * 50)
+        test_user.write_file("b.txt", "y" * 50)
+        test_user.write_file("c.md", "z" * 10)
+
+        self.assertEqual("\nPath | Size\nb.txt | 100", test_user.find("*.txt"))
+        self.assertEqual("\nPath | Size\nold/ | folder", test_user.find("o*"))
+        test_user.change_folder("..")
+        self.assertEqual("\nPath | Size\na.txt | 100\ndocs/b.txt | 100", test_user.find("*.txt"))
+        self.assertEqual("\nPath | Size\na.txt | 100\nMore than 1 matches, showing the first ones",
+                         test_user.find("*.txt", 1))
+        self.assertEqual("\nNo files or folders match *.pdf", test_user.find("*.pdf"))
+        self.assertEqual("\n210 bytes in 3 files and 2 folders", test_user.du())
+        self.assertEqual("\n110 bytes in 2 files and 1 folders", test_user.du("docs"))
+        self.assertEqual("\n No such folder exists", test_user.du(".."))
+        self.assertEqual("\nUsing 210 of 1000 bytes, in 3 files and 2 folders", test_user.quota())
+
+        self.assertEqual("\nCannot write to file big.txt, the quota of 1000 bytes would be exceeded",
+                         test_user.write_file("big.txt", "x" * 791))
+        self.assertEqual("\nCannot write to file big.txt, the quota of 1000 bytes would be exceeded",
+                         test_user.upload("big.txt", 791)[0])
+        # 400 characters, but 800 bytes once encoded
+        self.assertEqual("\nCannot write to file big.txt, the quota of 1000 bytes would be exceeded",
+                         test_user.write_file("big.txt", "\u00e9" * 400))
+        self.assertFalse(os.path.exists("Root/test23/big.txt"))
+        test_user.quit()
+
+    def test_reconcile_rebuilds_the_index(self):
+        """Tests if a scan of the folders catches up with files changed
+        behind the server and rebuilds a lost index.
+        """
+
+        test_user = CommandHandler()
+        test_user.register("test24", "bwoegbwoe2384")
+        test_user.login("test24", "bwoegbwoe2384")
+        test_user.create_folder("docs")
+        test_user.write_file("a.txt", "x" * 100)
+        test_user.write_file("gone.txt", "x" * 20)
+        self.index.reconcile(CommandHandler.ROOT_DIR)
+        self.assertEqual(0, self.index.reconcile(CommandHandler.ROOT_DIR))
+
+        with open("Root/test24/docs/new.txt", "w") as file:
+            file.write("n" * 30)
+        os.remove("Root/test24/gone.txt")
+        self.assertEqual(2, self.index.reconcile(CommandHandler.ROOT_DIR))
+        self.assertEqual("\n130 bytes in 2 files and 1 folders", test_user.du())
+
+        MetadataIndex.configure(os.path.join(self.directory, "rebuilt.sqlite3"))
+        rebuilt = CommandHandler()
+        rebuilt.login("test24", "bwoegbwoe2384")
+        self.assertEqual("\nNo files or folders match *.txt", rebuilt.find("*.txt"))
+        # Also indexes the folders of the users of the other tests
+        self.assertGreaterEqual(MetadataIndex.shared().reconcile(CommandHandler.ROOT_DIR), 3)
+        self.assertEqual("\nPath | Size\na.txt | 100\ndocs/new.txt | 30", rebuilt.find("*.txt"))
+        self.assertEqual(test_user.metadata_index.usage("test24"),
+                         MetadataIndex.shared().usage("test24"))
+        test_user.quit()
+
+
+    def test_copy_move_and_delete(self):
+        """Tests if copy, move and delete change the folders on disk and
+        the index alike, and refuse what would lose or exceed anything.
+        """
+
+        def run(reply):
+            header, lines = reply
+            return header + b"".join(lines).decode()
+
+        test_user = CommandHandler()
+        test_user.register("test25", "gwboegwb2385")
+        test_user.login("test25", "gwboegwb2385")
+        test_user.create_folder("docs")
+        test_user.write_file("c.txt", "z" * 10)
+        test_user.change_folder("docs")
+        test_user.create_folder("sub")
+        test_user.write_file("a.txt", "x" * 100)
+        test_user.change_folder("sub")
+        test_user.write_file("b.txt", "y" * 50)
+        test_user.change_folder("..")
+        test_user.change_folder("..")
+
+        self.assertEqual("\nRunning copy docs backup\nDone: copied 2 files and 2 folders\n",
+                         run(test_user.copy("docs", "backup")))
+        with open("Root/test25/backup/sub/b.txt") as file:
+            self.assertEqual("y" * 50, file.read())
+        self.assertEqual("\n150 bytes in 2 files and 1 folders", test_user.du("backup"))
+        self.assertEqual("\nUsing 310 of 1000 bytes, in 5 files and 4 folders", test_user.quota())
+        self.assertEqual(("\nThe destination backup already exists", None),
+                         test_user.copy("docs", "backup"))
+        self.assertEqual(("\nCannot copy docs into itself", None), test_user.copy("docs", "docs/sub/x"))
+        self.assertEqual(("\nNo such file or folder nothing", None), test_user.copy("nothing", "x"))
+        test_user.write_file("big.txt", "b" * 600)
+        self.assertEqual(("\nCannot write to file big2.txt, the quota of 1000 bytes would be exceeded",
+                          None), test_user.copy("big.txt", "big2.txt"))
+
+        self.assertEqual("\nRunning move backup archive\nDone: moved backup\n",
+                         run(test_user.move("backup", "archive")))
+        self.assertEqual("\nPath | Size\narchive/sub/b.txt | 50\ndocs/sub/b.txt | 50",
+                         test_user.find("b.txt"))
+        self.assertFalse(os.path.exists("Root/test25/backup"))
+        test_user.change_folder("docs")
+        self.assertEqual(("\nCannot move the folder of the user", None), test_user.move("..", "x"))
+        self.assertEqual(("\nCannot delete ../docs, it holds the current path", None),
+                         test_user.delete("../docs", True))
+        test_user.change_folder("..")
+
+        self.assertEqual(("\nThe folder archive is not empty, use delete -r archive", None),
+                         test_user.delete("archive"))
+        self.assertEqual("\nRunning delete archive\nDone: deleted 2 files and 2 folders\n",
+                         run(test_user.delete("archive", True)))
+        self.assertEqual("\nRunning delete big.txt\nDone: deleted 1 files and 0 folders\n",
+                         run(test_user.delete("big.txt")))
+        self.assertEqual(["c.txt", "docs"], sorted(os.listdir("Root/test25")))
+        self.assertEqual("\n160 bytes in 3 files and 2 folders", test_user.du())
+        self.assertEqual("\nRunning tree docs\na.txt | 100\nsub/ | folder\nsub/b.txt | 50\n"
+                         "Done: 2 files and 1 folders, 150 bytes\n", run(test_user.tree("docs")))
+
+        other = CommandHandler()
+        other.login("test25", "gwboegwb2385")
+        other.change_folder("docs")
+        other.change_folder("sub")
+        b"".join(test_user.delete("docs", True)[1])
+        self.assertEqual("\nThe folder Root/test25/docs/sub was moved or deleted, moved back to "
+                         "folder Root/test25", other.write_file("d.txt", "d"))
+        self.assertEqual("Root/test25", other.current_dir)
+        self.assertIn("c.txt | 10 |", other.list())
+        other.quit()
+        test_user.quit()
+
+
+class TestFolderWatcher(unittest.IsolatedAsyncioTestCase):
+    """
+    This class defines the tests of the watcher behind the watch command.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_coalesce(self):
+        """Tests if two changes of a file in a row make the one change a
+        client syncing the folder needs to apply.
+        """
+
+        self.assertEqual(CREATED, coalesce(None, CREATED))
+        self.assertEqual(CREATED, coalesce(CREATED, MODIFIED))
+        self.assertIsNone(coalesce(CREATED, DELETED))
+        self.assertEqual(MODIFIED, coalesce(DELETED, CREATED))
+        self.assertEqual(DELETED, coalesce(MODIFIED, DELETED))
+        self.assertEqual(MODIFIED, coalesce(MODIFIED, MODIFIED))
+
+    async def test_polling_fallback(self):
+        """Tests if comparing the listings of a folder finds the same
+        changes as inotify, leaving out the files of the server.
+        """
+
+        with open(os.path.join(self.directory, "old.txt"), "w") as file:
+            file.write("old")
+        with open(os.path.join(self.directory, "gone.txt"), "w") as file:
+            file.write("gone")
+        watcher = FolderWatcher(use_inotify=False, poll_interval=0.05, debounce=0.2)
+        self.assertIsNone(watcher.inotify)
+        changes = asyncio.Queue()
+        subscription = watcher.subscribe(self.directory, changes.put_nowait,
+                                         asyncio.get_running_loop())
+        for _ in range(5):
+            with open(os.path.join(self.directory, "new.txt"), "a") as file:
+                file.write("new")
+            await asyncio.sleep(0.06)
+        with open(os.path.join(self.directory, "old.txt"), "a") as file:
+            file.write("er")
+        with open(os.path.join(self.directory, ".partial-x"), "w") as file:
+            file.write("hidden")
+        os.remove(os.path.join(self.directory, "gone.txt"))
+        self.assertEqual({"new.txt": CREATED, "old.txt": MODIFIED, "gone.txt": DELETED},
+                         dict(await asyncio.wait_for(changes.get(), 5)))
+        watcher.unsubscribe(subscription)
+        self.assertEqual({}, watcher.folders)
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    """
+    This class defines the tests which exercise the server
+    over a loopback connection.
+    """
+
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+    async def asyncTearDown(self):
+        self.writer.write(b"exit")
+        await self.writer.drain()
+        # The server closes its side once it handled exit
+        await self.reader.read()
+        self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def request(self, message):
+        """Sends one command and returns the reply."""
+        self.writer.write(message.encode())
+        await self.writer.drain()
+        return (await self.reader.read(4096)).decode()
+
+    async def test_stream_file(self):
+        """Tests if stream_file sends the header followed by
+        every byte of the file.
+        """
+
+        await self.request("register server1 bgsbgouwe83")
+        await self.request("login server1 bgsbgouwe83")
+        await self.request("write_file big.txt " + "x" * 3000)
+        self.writer.write(b"stream_file big.txt")
+        await self.writer.drain()
+        self.assertEqual(b"\n", await self.reader.readline())
+        self.assertEqual(b"Streaming big.txt 3000 bytes\n", await self.reader.readline())
+        self.assertEqual(b"x" * 3000, await self.reader.readexactly(3000))
+        await self.request("quit")
+
+    async def test_download(self):
+        """Tests if download sends the header followed by the raw file
+        over both protocols.
+        """
+
+        content = "0123456789abcdef" * 4096
+        await self.request("register server3 gbeowgb2935")
+        await self.request("login server3 gbeowgb2935")
+        await self.request("write_file d.txt " + content[:4000])
+        self.writer.write(b"download d.txt")
+        await self.writer.drain()
+        self.assertEqual(b"\n", await self.reader.readline())
+        self.assertEqual(b"Downloading d.txt 4000 bytes\n", await self.reader.readline())
+        self.assertEqual(content[:4000].encode(), await self.reader.readexactly(4000))
+
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", self.port)
+        for message in [b"login server3 gbeowgb2935", b"write_file d.txt\n" + content[4000:].encode(),
+                        b"download d.txt"]:
+            protocol.write_frame(writer, protocol.COMMAND, message)
+            opcode, payload = await protocol.read_frame(reader)
+        self.assertEqual((protocol.RESPONSE, b"\nDownloading d.txt 65536 bytes\n"),
+                         (opcode, payload))
+        self.assertEqual(content.encode(), await reader.readexactly(len(content)))
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+        await self.request("quit")
+
+    async def test_batch(self):
+        """Tests if a batch runs its commands in order and replies with
+        the reply or the error of each one, over both protocols.
+        """
+
+        await self.request("register server7 gbweogbw2935")
+        await self.request("login server7 gbweogbw2935")
+        reply = await self.request('batch ["create_folder docs", "write_file docs/a.txt one two",'
+                                   ' "read_file docs/a.txt 0 3", "stats", "read_file a b c d"]')
+        self.assertEqual([{"command": "create_folder", "reply": "\nSuccessfully created folder docs"},
+                          {"command": "write_file",
+                           "reply": "\nCreated and written data to file docs/a.txt successfully"},
+                          {"command": "read_file",
+                           "reply": "\nReading file from 0 bytes to 3 bytes\none"},
+                          {"command": "stats", "error": "Command stats cannot run in a batch"},
+                          {"command": "read_file", "error": "Enter correct command: command -> "
+                                                            "read_file <file_name> [offset] [length]"}],
+                         json.loads(reply))
+        self.assertEqual("Enter correct command: command -> batch <json list of commands>",
+                         await self.request("batch [1, 2]"))
+        results = json.loads(await self.request(
+            'batch ["write_file c.txt two  spaces", "create_folder missing/sub",'
+            ' "read_file c.txt 0 20"]'))
+        self.assertIn("Created", results[0]["reply"])
+        self.assertIn("No such file or directory", results[1]["error"])
+        self.assertEqual("\nReading file from 0 bytes to 20 bytes\ntwo  spaces", results[2]["reply"])
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            self.assertEqual("\nLogin to Continue", (await connection.request("batch", b"[]")))
+            await connection.login("server7", "gbweogbw2935")
+            results = await connection.batch([("write_file b.txt", b"line one\nline two"),
+                                              "change_folder docs", "list"])
+            self.assertEqual("\nCreated and written data to file b.txt successfully",
+                             results[0]["reply"])
+            self.assertIn("a.txt | 7 |", results[2]["reply"])
+            await connection.quit()
+        with open("Root/server7/b.txt", "rb") as file:
+            self.assertEqual(b"line one\nline two", file.read())
+        await self.request("quit")
+
+    async def test_watch(self):
+        """Tests if a watching client is sent one change per file after a
+        burst of writes, between the replies to its commands.
+        """
+
+        await self.request("register server8 gbowegbw2836")
+        await self.request("login server8 gbowegbw2836")
+        await self.request("create_folder docs")
+        self.assertEqual("\nWatching docs for changes", await self.request("watch docs"))
+        self.assertEqual("\nAlready watching docs", await self.request("watch docs"))
+        self.assertEqual("\n No such folder exists", await self.request("watch missing"))
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            await connection.login("server8", "gbowegbw2836")
+            self.assertEqual("\nWatching docs for changes", await connection.watch("docs"))
+            await asyncio.gather(*[connection.write_file("docs/a.txt", "x" * 100)
+                                   for _ in range(20)])
+            await connection.write_file("docs/b.txt", "y")
+            await connection.write_file("notes.txt", "z")
+            events = {await asyncio.wait_for(connection.events.get(), 5) for _ in range(2)}
+            self.assertEqual({(CREATED, "docs/a.txt"), (CREATED, "docs/b.txt")}, events)
+            await connection.write_file("docs/b.txt", "y")
+            self.assertEqual((MODIFIED, "docs/b.txt"),
+                             await asyncio.wait_for(connection.events.get(), 5))
+            self.assertEqual("\nStopped watching docs", await connection.unwatch("docs"))
+            self.assertEqual("\nNot watching docs", await connection.unwatch("docs"))
+            await connection.quit()
+        # The text client was sent the same changes, unasked
+        events = ""
+        while not events.endswith("modified docs/b.txt"):
+            events += (await asyncio.wait_for(self.reader.read(4096), 5)).decode()
+        self.assertEqual("\nEvent created docs/a.txt\nEvent created docs/b.txt"
+                         "\nEvent modified docs/b.txt", events)
+        self.assertEqual("\nStopped watching docs", await self.request("unwatch docs"))
+        await self.request("quit")
+
+    async def test_upload(self):
+        """Tests if upload writes the raw content following the command
+        over both protocols, appending to an existing file.
+        """
+
+        content = bytes(range(256)) * 40
+        await self.request("register server4 ngoewhg2048")
+        await self.request("login server4 ngoewhg2048")
+        self.writer.write(b"upload u.bin 10240\n" + content[:5000])
+        await self.writer.drain()
+        self.writer.write(content[5000:])
+        expected = "\nCreated and uploaded 10240 bytes to file u.bin successfully"
+        self.assertEqual(expected, (await self.reader.read(4096)).decode())
+
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", self.port)
+        protocol.write_frame(writer, protocol.COMMAND, b"login server4 ngoewhg2048")
+        protocol.write_frame(writer, protocol.COMMAND, b"upload u.bin 10240")
+        for offset in range(0, len(content), 4096):
+            protocol.write_frame(writer, protocol.DATA, content[offset:offset + 4096])
+        protocol.write_frame(writer, protocol.END)
+        await protocol.read_frame(reader)
+        expected = b"\nSuccess Uploaded 10240 bytes to file u.bin successfully"
+        self.assertEqual((protocol.RESPONSE, expected), await protocol.read_frame(reader))
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+
+        with open(os.path.join(CommandHandler.ROOT_DIR, "server4", "u.bin"), "rb") as file:
+            self.assertEqual(content * 2, file.read())
+        await self.request("quit")
+
+    async def test_framed_pipelined_commands(self):
+        """Tests if several framed commands sent before reading any
+        reply are answered in order, including a binary write_file
+        larger than a text message.
+        """
+
+        reader, writer = await protocol.open_framed_connection("127.0.0.1", self.port)
+        content = bytes(range(256)) * 64
+        for message in [b"register server2 bdgbiwbgw82", b"login server2 bdgbiwbgw82",
+                        b"write_file blob.bin\n" + content, b"stream_file blob.bin",
+                        b"quit"]:
+            protocol.write_frame(writer, protocol.COMMAND, message)
+        await writer.drain()
+
+        replies = [await protocol.read_frame(reader) for _ in range(4)]
+        self.assertEqual((protocol.RESPONSE, b"\nSuccess! Registered server2"), replies[0])
+        self.assertEqual((protocol.RESPONSE, b"Success server2 Logged into the system"), replies[1])
+        self.assertEqual(protocol.RESPONSE, replies[2][0])
+        self.assertEqual((protocol.RESPONSE, b"\nStreaming blob.bin 16384 bytes\n"), replies[3])
+        received = b""
+        opcode, payload = await protocol.read_frame(reader)
+        while opcode == protocol.DATA:
+            received += payload
+            opcode, payload = await protocol.read_frame(reader)
+        self.assertEqual(protocol.END, opcode)
+        self.assertEqual(content, received)
+        self.assertEqual((protocol.RESPONSE, b"\nLogged Out"), await protocol.read_frame(reader))
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+
+    async def test_compressed_transfers(self):
+        """Tests if a compressed file is streamed as its stored blocks to
+        a framed client decompressing zlib, and as raw content otherwise.
+        """
+
+        Compression.configure("zlib", block_size=1024)
+        try:
+            content = b"compressible text " * 500
+            reader, writer = await protocol.open_framed_connection("127.0.0.1", self.port, ("zlib",))
+            for message in [b"register server6 gbwoebgw284", b"login server6 gbwoebgw284",
+                            b"write_file z.txt\n" + content, b"stream_file z.txt"]:
+                protocol.write_frame(writer, protocol.COMMAND, message)
+                opcode, payload = await protocol.read_frame(reader)
+            received, frames = b"", 0
+            opcode, payload = await protocol.read_frame(reader)
+            while opcode == protocol.ZDATA:
+                received += decompress_frame(payload)
+                frames += 1
+                opcode, payload = await protocol.read_frame(reader)
+            self.assertEqual((protocol.END, content, 9), (opcode, received, frames))
+            writer.write_eof()
+            await reader.read()
+            writer.close()
+
+            await self.request("login server6 gbwoebgw284")
+            self.writer.write(b"download z.txt")
+            await self.writer.drain()
+            self.assertEqual(b"\n", await self.reader.readline())
+            self.assertEqual(b"Downloading z.txt 9000 bytes\n", await self.reader.readline())
+            self.assertEqual(content, await self.reader.readexactly(len(content)))
+            await self.request("quit")
+        finally:
+            Compression.configure()
+
+    async def test_dispatcher(self):
+        """Tests if unknown commands and wrong arities get an answer, and
+        if a command registered by a plugin is served and listed.
+        """
+
+        self.assertEqual("\nUnknown command frobnicate, send commands to see the commands",
+                         await self.request("frobnicate a b"))
+        self.assertEqual("Enter correct command", await self.request("register onlyname"))
+        self.assertEqual("Enter correct command: command -> read_file <file_name> [offset] [length]",
+                         await self.request("read_file a.txt x"))
+
+        dispatcher = Dispatcher.shared()
+
+        @dispatcher.command("echo", 1, help_text="echo : Repeats the words, command:echo <words>\n")
+        def echo(commandhandler, args, payload):
+            del commandhandler, payload
+            return " ".join(args)
+
+        try:
+            self.assertEqual("hello  world", await self.request("echo hello  world"))
+            self.assertEqual("Enter correct command: command -> echo", await self.request("echo"))
+            self.assertTrue((await self.request("commands")).endswith(
+                "echo : Repeats the words, command:echo <words>\n"))
+            with self.assertRaises(ValueError):
+                dispatcher.register("echo", echo)
+        finally:
+            del dispatcher.commands["echo"]
+
+    async def test_stats_and_metrics_endpoint(self):
+        """Tests if stats counts the commands served and if the metrics
+        endpoint answers with the same counters in the Prometheus format.
+        """
+
+        metrics = Metrics.shared()
+        before = metrics.commands["register"].count() if "register" in metrics.commands else 0
+        await self.request("register server5 gowbgwoeb38")
+        await self.request("no_such_command")
+        reply = await self.request("stats")
+        self.assertTrue(reply.startswith("\nUptime: "))
+        self.assertIn("\nregister | " + str(before + 1) + " | 0 | ", reply)
+        self.assertIn("\nunknown | ", reply)
+        self.assertIn("\nblock_cache_hit_ratio: ", reply)
+
+        endpoint = await serve_prometheus("127.0.0.1", 0)
+        port = endpoint.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+        endpoint.close()
+        await endpoint.wait_closed()
+        self.assertTrue(response.startswith("HTTP/1.0 200 OK\r\n"))
+        self.assertIn('\nfms_command_seconds_count{command="register"} ' + str(before + 1) + "\n",
+                      response)
+        self.assertIn('\nfms_handler_seconds_count{method="register"} ', response)
+        self.assertIn("\nfms_connections_active 1\n", response)
+
+
+class TestLimits(unittest.IsolatedAsyncioTestCase):
+    """
+    This class defines the tests for the connection limits
+    and timeouts of the server.
+    """
+
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        protocol.Limits.configure()
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    async def closed():
+        """Waits for the server to close all its connections."""
+        for _ in range(100):
+            if not server.ACTIVE_CONNECTIONS:
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    async def test_eof_timeout_and_max_connections(self):
+        """Tests if a client disconnecting without exit and an idle
+        client get their connection closed, and if the connections
+        beyond max_connections are refused.
+        """
+
+        metrics = Metrics.shared()
+        protocol.Limits.configure(max_connections=1, idle_timeout=0.3)
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"commands")
+        await reader.read(4096)
+        writer.close()
+        self.assertTrue(await self.closed())
+
+        timed_out = metrics.timed_out_connections
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.assertEqual(b"", await asyncio.wait_for(reader.read(), 5))
+        writer.close()
+        self.assertTrue(await self.closed())
+        self.assertEqual(timed_out + 1, metrics.timed_out_connections)
+
+        rejected = metrics.rejected_connections
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"commands")
+        await reader.read(4096)
+        other_reader, other_writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.assertEqual(b"", await asyncio.wait_for(other_reader.read(), 5))
+        other_writer.close()
+        self.assertEqual(rejected + 1, metrics.rejected_connections)
+        writer.write(b"exit")
+        self.assertEqual(b"", await reader.read())
+        writer.close()
+
+    async def test_output_backpressure(self):
+        """Tests if a client which stops reading a large reply stalls
+        the server on the output buffer, then is disconnected after
+        the read timeout.
+        """
+
+        handler = CommandHandler()
+        handler.register("limits1", "gweogbw3925")
+        handler.login("limits1", "gweogbw3925")
+        handler.write_file("huge.txt", b"x" * (32 * 1024 * 1024))
+        metrics = Metrics.shared()
+        timed_out = metrics.timed_out_connections
+        protocol.Limits.configure(read_timeout=0.5, output_buffer=64 * 1024)
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"login limits1 gweogbw3925")
+        await reader.read(4096)
+        writer.write(b"stream_file huge.txt")
+        await writer.drain()
+        self.assertTrue(await self.closed())
+        self.assertEqual(timed_out + 1, metrics.timed_out_connections)
+        writer.close()
+
+
+class TestClientLibrary(unittest.IsolatedAsyncioTestCase):
+    """
+    This class defines the tests for the asyncio client library
+    against a server on a loopback connection.
+    """
+
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.directory = tempfile.mkdtemp()
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        shutil.rmtree(self.directory)
+
+    async def test_pipelined_requests(self):
+        """Tests if requests made at once on one connection get their
+        own replies, streamed and downloaded content included.
+        """
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            await connection.register("library1", "gbwoegb2935")
+            self.assertTrue(fmsclient.logged_in(await connection.login("library1", "gbwoegb2935")))
+            content = bytes(range(256)) * 300
+            path = os.path.join(self.directory, "copy.bin")
+            results = await asyncio.gather(
+                connection.write_file("a.bin", content),
+                connection.read_file("a.bin", 0, 4),
+                connection.stream_file("a.bin"),
+                connection.download("a.bin", path),
+                connection.read_file("missing.txt"),
+                *[connection.request("list") for _ in range(20)])
+            self.assertEqual("\nCreated and written data to file a.bin successfully", results[0])
+            self.assertTrue(results[1].startswith("\nReading file from 0 bytes to 4 bytes\n"))
+            self.assertEqual(content, results[2])
+            self.assertEqual(len(content), results[3])
+            with open(path, "rb") as file:
+                self.assertEqual(content, file.read())
+            self.assertEqual("\nNo Such file missing.txt exists!", results[4])
+            self.assertEqual(20, results.count(results[5]))
+            with self.assertRaises(fmsclient.ClientError):
+                await connection.download("missing.txt", path + "2")
+            self.assertFalse(os.path.exists(path + "2.part"))
+            await connection.quit()
+
+    async def test_pool_parallel_transfers(self):
+        """Tests if a pool uploads and downloads files in parallel over
+        several connections in the same folder.
+        """
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            await connection.register("library2", "gwoegbw2395")
+        paths = []
+        for number in range(6):
+            paths.append(os.path.join(self.directory, f"file{number}.bin"))
+            with open(paths[-1], "wb") as file:
+                file.write(os.urandom(100000 + number))
+        async with fmsclient.Pool("127.0.0.1", self.port, "library2", "gwoegbw2395", size=3) as pool:
+            await pool.request("create_folder bulk")
+            await pool.change_folder("bulk")
+            replies = await pool.upload_many(paths)
+            self.assertTrue(all(reply.endswith("successfully") for reply in replies))
+            self.assertEqual(3, len(pool.connections))
+            names = [os.path.basename(path) for path in paths]
+            target = os.path.join(self.directory, "back")
+            os.mkdir(target)
+            self.assertEqual([100000 + number for number in range(6)],
+                             await pool.download_many(names, target))
+        for path in paths:
+            with open(path, "rb") as original, open(os.path.join(target, os.path.basename(path)),
+                                                    "rb") as copied:
+                self.assertEqual(original.read(), copied.read())
+
+    async def test_ranged_transfers(self):
+        """Tests if a file moved in ranges over a pool is reassembled
+        whole, if corrupted ranges are refused, and if interrupted
+        uploads and downloads resume with the missing ranges only.
+        """
+
+        mb = 1024 * 1024
+        content = os.urandom(5 * mb + 123)
+        path = os.path.join(self.directory, "big.bin")
+        with open(path, "wb") as file:
+            file.write(content)
+        metrics = Metrics.shared()
+
+        def count(command):
+            return metrics.commands[command].count() if command in metrics.commands else 0
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            await connection.register("library3", "gbweogb2395")
+            await connection.login("library3", "gbweogb2395")
+            self.assertEqual([], await connection.upload_begin("big.bin", len(content)))
+            await connection.upload_range(path, "big.bin", 0, mb)
+            await connection.upload_range(path, "big.bin", 2 * mb, mb)
+            with self.assertRaises(fmsclient.ClientError):
+                await connection.upload_range(path, "big.bin", mb, mb, "0" * 64)
+            with self.assertRaises(fmsclient.ClientError):
+                await connection.upload_commit("big.bin")
+            self.assertEqual([(0, mb), (2 * mb, mb)],
+                             await connection.upload_begin("big.bin", len(content)))
+            self.assertNotIn(".partial-", await connection.list())
+
+            # A folder named like the upload was created before its commit
+            await connection.upload_begin("taken.bin", mb)
+            await connection.upload_range(path, "taken.bin", 0, mb)
+            await connection.create_folder("taken.bin")
+            with self.assertRaisesRegex(fmsclient.ClientError, "Cannot commit upload of taken.bin"):
+                await connection.upload_commit("taken.bin")
+            await connection.delete("taken.bin")
+            self.assertEqual("\nAssembled " + str(mb) + " bytes to file taken.bin successfully",
+                             await connection.upload_commit("taken.bin"))
+            await connection.quit()
+
+        async with fmsclient.Pool("127.0.0.1", self.port, "library3", "gbweogb2395", size=3) as pool:
+            before = count("upload_range")
+            reply = await pool.upload_parallel(path, range_size=mb)
+            self.assertEqual("\nAssembled " + str(len(content)) + " bytes to file big.bin successfully",
+                             reply)
+            self.assertEqual(4, count("upload_range") - before)
+
+            copy = os.path.join(self.directory, "copy.bin")
+            self.assertEqual(len(content), await pool.download_parallel("big.bin", copy, mb))
+            with open(copy, "rb") as file:
+                self.assertEqual(content, file.read())
+
+            # A download interrupted after its first three ranges
+            connection = await pool.connection()
+            _, _, version = await connection.download_range("big.bin", 0, 0, lambda chunk: None)
+            with open(copy + ".part", "wb") as file:
+                file.write(content[:3 * mb])
+                file.truncate(len(content))
+            with open(copy + ".part.ranges", "w") as journal:
+                journal.write(version + "\n0 %d\n%d %d\n%d %d\n" % (mb, mb, mb, 2 * mb, mb))
+            os.remove(copy)
+            before = count("download_range")
+            await pool.download_parallel("big.bin", copy, mb)
+            self.assertEqual(4, count("download_range") - before)
+            with open(copy, "rb") as file:
+                self.assertEqual(content, file.read())
+            self.assertFalse(os.path.exists(copy + ".part.ranges"))
+
+
+    async def test_tree_commands_stream_progress(self):
+        """Tests if copy, move and delete run on the server and stream
+        their progress through the client library.
+        """
+
+        async with await fmsclient.connect("127.0.0.1", self.port) as connection:
+            await connection.register("library4", "gowebgw2395")
+            await connection.login("library4", "gowebgw2395")
+            await connection.create_folder("src")
+            await connection.batch([(f"write_file src/{number}.txt", str(number) * 1000)
+                                    for number in range(3)])
+            interval = treeops.PROGRESS_INTERVAL
+            treeops.PROGRESS_INTERVAL = 0
+            try:
+                progress = []
+                self.assertEqual("\nRunning copy src dst\n",
+                                 await connection.copy("src", "dst", progress.append))
+            finally:
+                treeops.PROGRESS_INTERVAL = interval
+            lines = b"".join(progress).decode().splitlines()
+            self.assertEqual(["Copied 1 of 3 files", "Copied 2 of 3 files", "Copied 3 of 3 files",
+                              "Done: copied 3 files and 1 folders"], lines)
+            self.assertEqual("0.txt | 1000\n1.txt | 1000\n2.txt | 1000\n"
+                             "Done: 3 files and 0 folders, 3000 bytes\n", await connection.tree("dst"))
+            self.assertEqual("Done: moved dst\n", await connection.move("dst", "moved"))
+            self.assertEqual("\n3000 bytes in 3 files and 0 folders", await connection.request("du moved"))
+            with self.assertRaises(fmsclient.ClientError):
+                await connection.delete("moved")
+            self.assertEqual("Done: deleted 3 files and 1 folders\n",
+                             await connection.delete("moved", recursive=True))
+            self.assertEqual("\n No such folder exists", await connection.request("du moved"))
+            with self.assertRaises(fmsclient.ClientError):
+                await connection.copy("moved", "again")
+            await connection.quit()
+
+
+class TestFileIO(unittest.IsolatedAsyncioTestCase):
+    """
+    This class defines the tests for the thread pool running
+    the filesystem calls.
+    """
+
+    async def test_operation_limit(self):
+        """Tests if no more calls of an operation than its limit
+        run at the same time.
+        """
+
+        fileio = FileIO(threads=8, limits={"read_file": 2})
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        await asyncio.gather(*[fileio.run("read_file", work) for _ in range(8)])
+        fileio.shutdown()
+        self.assertEqual(2, max(peak))
+
+    async def test_iterate(self):
+        """Tests if the items of a blocking iterator are all yielded,
+        both from the pool and inline.
+        """
+
+        for threads in [4, 0]:
+            fileio = FileIO(threads=threads)
+            items = [item async for item in fileio.iterate("stream_file", iter(range(5)))]
+            fileio.shutdown()
+            self.assertEqual(list(range(5)), items)
+
+
+class TestWorkers(unittest.TestCase):
+    """
+    This class defines the tests for running the server
+    as several worker processes.
+    """
+
+    def test_workers_share_users(self):
+        """Tests if users registered through one connection can login
+        through other connections, whichever worker accepts them, and
+        if the server exits cleanly on SIGTERM.
+        """
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        directory = tempfile.mkdtemp()
+        process = subprocess.Popen([sys.executable, os.path.abspath("server.py"), "--host",
+                                    "127.0.0.1", "--port", str(port), "--workers", "2"],
+                                   cwd=directory, stdout=subprocess.DEVNULL)
+        try:
+            replies = asyncio.run(self.register_and_login(port))
+        finally:
+            process.send_signal(signal.SIGTERM)
+            exit_code = process.wait(timeout=10)
+            shutil.rmtree(directory)
+        self.assertEqual(["Success worker" + str(i) + " Logged into the system"
+                          for i in range(4)], replies)
+        self.assertEqual(0, exit_code)
+
+    def test_workers_share_the_hashing_processes(self):
+        """Tests if the cores hashing the passwords are shared out among
+        the workers rather than each worker taking all of them.
+        """
+
+        cores = os.cpu_count() or 1
+        self.assertEqual(cores, server.parse_args(["--host", "127.0.0.1"]).hash_processes)
+        self.assertEqual(1, server.parse_args(["--host", "127.0.0.1", "--workers",
+                                               str(2 * cores)]).hash_processes)
+        self.assertEqual(0, server.parse_args(["--host", "127.0.0.1", "--workers", "2",
+                                               "--hash-processes", "0"]).hash_processes)
+
+    @staticmethod
+    async def register_and_login(port):
+        """Registers four users and logs each in on a new connection."""
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        replies = []
+        for command in ["register", "login"]:
+            for i in range(4):
+                reader, writer = await protocol.open_framed_connection("127.0.0.1", port)
+                message = f"{command} worker{i} gbewogbweg2"
+                protocol.write_frame(writer, protocol.COMMAND, message.encode())
+                replies.append((await protocol.read_frame(reader))[1].decode())
+                writer.close()
+        return replies[4:]
+
+
 def cleanup():
     """Cleans the directories created during all
     unittests
@@ -194,6 +1653,9 @@ def cleanup():
 
     shutil.rmtree(os.path.join("Root/"))
     shutil.rmtree("AccessSession/")
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(INDEX_FILE + suffix):
+            os.remove(INDEX_FILE + suffix)
 
 
 def step_completed(test):
@@ -217,7 +1679,10 @@ def testing():
     This function executes the function of step_completed
     """
     print('*'*60 + "\nTesting:\n")
-    return step_completed(TestClient)
+    results = [step_completed(test) for test in [TestClient, TestUserStore, TestChunkStore, TestCompression, TestBlockCache,
+                                              TestMetadataIndex, TestFolderWatcher, TestServer, TestLimits, TestClientLibrary, TestFileIO,
+                                              TestWorkers]]
+    return all(results)
 
 if __name__ == "__main__":
     if not testing():
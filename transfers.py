@@ -0,0 +1,199 @@
+"""
+This program stages ranged uploads and checks the ranges of ranged
+downloads, which let a client move a large file as many ranges sent
+over several connections at once and resume after a disconnect.
+
+The ranges of an upload of <name> are staged in the hidden folder
+PARTIAL_PREFIX + <name> next to the final file. Its DATA_FILE is
+created with the announced size and every range is written at its
+offset; an empty marker file named <offset>-<length> is created once
+a range was written and matched its checksum, so the ranges still
+missing after a disconnect are known from the markers alone. Committing
+checks the ranges cover the whole file, flushes it to the disk and
+renames it over the final file, which readers see either entirely old
+or entirely new. When files are stored through the chunk store or
+compressed, the staged content is first written through them to
+STORED_FILE, which is renamed instead, so the bytes of a client never
+become a stored file as they are.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+
+PARTIAL_PREFIX = ".partial-"
+DATA_FILE = "data"
+STORED_FILE = "stored"
+CHECKSUM = "sha256"
+MAX_RANGE = 64 * 1024 * 1024
+RANGE_READ_SIZE = 1024 * 1024
+
+
+def checksum():
+    """Returns a new hash object of the CHECKSUM algorithm."""
+    return hashlib.new(CHECKSUM)
+
+
+def range_digest(file, offset, length, chunk_size=RANGE_READ_SIZE):
+    """
+    Returns
+    -------
+    str
+        Hex digest of length bytes of an open file from offset, read
+        through its seek and read methods
+    """
+    digest = checksum()
+    file.seek(offset)
+    remaining = length
+    while remaining:
+        chunk = file.read(min(remaining, chunk_size))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def file_version(path):
+    """
+    Returns
+    -------
+    str
+        Modification time and size of a file, which change whenever
+        its content does, for a client to check the ranges it
+        downloaded at different times belong to the same content
+    """
+    stats = os.stat(path)
+    return "%x-%x" % (stats.st_mtime_ns, stats.st_size)
+
+
+class PartialUpload:
+    """
+
+    Staging folder of a ranged upload.
+
+    Attributes
+    ----------
+    self.path : str
+        Path of the final file
+    self.folder : str
+        Staging folder
+    self.data : str
+        File receiving the ranges
+
+    Returns
+    -------
+    Object
+        PartialUpload Object
+    """
+
+    def __init__(self, path):
+        self.path = path
+        folder, name = os.path.split(path)
+        self.folder = os.path.join(folder, PARTIAL_PREFIX + name)
+        self.data = os.path.join(self.folder, DATA_FILE)
+
+    def size(self):
+        """Returns the size announced for the upload, or None if there is none."""
+        try:
+            return os.stat(self.data).st_size
+        except FileNotFoundError:
+            return None
+
+    def begin(self, size):
+        """
+        Starts an upload of size bytes, or resumes the one in progress
+        if it has the same size; one of another size is dropped.
+
+        Returns
+        -------
+        list
+            (offset, length) of the ranges already received
+        """
+        if self.size() == size:
+            return self.ranges()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder, exist_ok=True)
+        temporary = self.data + ".tmp"
+        with open(temporary, "wb") as file:
+            file.truncate(size)
+        os.replace(temporary, self.data)
+        return []
+
+    def ranges(self):
+        """
+        Returns
+        -------
+        list
+            (offset, length) of the ranges received, sorted by offset
+        """
+        ranges = []
+        for name in os.listdir(self.folder):
+            offset, dash, length = name.partition("-")
+            if dash and offset.isdigit() and length.isdigit():
+                ranges.append((int(offset), int(length)))
+        return sorted(ranges)
+
+    def missing(self):
+        """Returns the number of bytes no received range covers."""
+        size = self.size()
+        covered = end = 0
+        for offset, length in self.ranges():
+            if offset + length > end:
+                covered += offset + length - max(offset, end)
+                end = offset + length
+        return size - covered
+
+    def open_range(self):
+        """Returns a descriptor of the staged file to write ranges with os.pwrite."""
+        return os.open(self.data, os.O_WRONLY)
+
+    def mark(self, offset, length):
+        """Records that a range was received whole and intact."""
+        with open(os.path.join(self.folder, "%d-%d" % (offset, length)), "wb"):
+            pass
+
+    def commit(self, open_stored=None):
+        """
+        Moves the staged file over the final file once every byte
+        was received, and removes the staging folder.
+
+        Parameters
+        ----------
+        open_stored : callable
+            Creates the file at the path it is given and returns the
+            file object storing what is written to it, e.g. through the
+            chunk store; None renames the staged file as it is
+
+        Returns
+        -------
+        int
+            Size of the file
+
+        Raises
+        ------
+        ValueError
+            If ranges are missing, with the number of missing bytes
+        """
+        missing = self.missing()
+        if missing:
+            raise ValueError(missing)
+        size = self.size()
+        if open_stored is None:
+            descriptor = os.open(self.data, os.O_RDONLY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            os.replace(self.data, self.path)
+        else:
+            stored = os.path.join(self.folder, STORED_FILE)
+            # Left behind by a commit which failed half way
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stored)
+            with open(self.data, "rb") as source, open_stored(stored) as target:
+                shutil.copyfileobj(source, target, RANGE_READ_SIZE)
+            os.replace(stored, self.path)
+        shutil.rmtree(self.folder, ignore_errors=True)
+        return size
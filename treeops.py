@@ -0,0 +1,468 @@
+"""
+This program runs the recursive commands tree, copy, move and delete
+on the server. Folders are walked with os.scandir and the work on
+their files is spread over a bounded pool of threads, while the
+operations yield the lines streamed to the client: the entries of a
+tree, or how far a copy or delete got, ended by a summary line.
+"""
+
+import concurrent.futures
+import errno
+import os
+import threading
+import time
+import fileformat
+import metaindex
+from compression import COMPRESSION_FILE
+from transfers import PARTIAL_PREFIX
+
+TREE_THREADS = 8
+PROGRESS_INTERVAL = 0.5
+TREE_CHUNK_SIZE = 64 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+JOB_BATCH = 16
+# Errors of copy_file_range telling the kernel cannot copy between
+# these files, which are then copied through read and write
+NO_COPY_RANGE = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
+
+
+class TreeWorkers:
+    """
+
+    Process-wide pool of threads copying and deleting the files of the
+    recursive commands, separate from the FileIO pool whose threads
+    walk the folders and wait for this one. At most max_pending batches
+    of files are handed to the pool and not finished at a time, so a
+    tree with millions of files is never queued whole.
+
+    Attributes
+    ----------
+    self.threads : int
+        Number of threads in the pool, 0 works on the calling thread
+    self.max_pending : int
+        Batches of jobs submitted and not finished at most
+
+    Returns
+    -------
+    Object
+        TreeWorkers Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, threads=TREE_THREADS):
+        self.threads = threads
+        self.max_pending = 2 * threads
+        self.executor = (concurrent.futures.ThreadPoolExecutor(threads, "tree")
+                         if threads else None)
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        TreeWorkers
+            The pool used by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, threads=TREE_THREADS):
+        """
+        Replaces the shared pool, e.g. with the number of threads given
+        on the server command line.
+        """
+        with cls._shared_lock:
+            if cls._shared is not None and cls._shared.executor is not None:
+                cls._shared.executor.shutdown(wait=False)
+            cls._shared = cls(threads)
+            return cls._shared
+
+    def map(self, function, jobs):
+        """
+        Calls function(*job) on the pool for every job of an iterator,
+        which is only advanced as jobs finish. The jobs are handed to
+        the threads JOB_BATCH at a time, one hand-off per small file
+        would cost about as much as copying it.
+
+        Yields
+        ------
+        object
+            What every call returned, a batch at a time in the order
+            the batches finished
+
+        Raises
+        ------
+        Exception
+            What a call raised, once the calls running alongside it
+            finished; no more jobs are started after it
+        """
+        if self.executor is None:
+            for job in jobs:
+                yield function(*job)
+            return
+        pending = set()
+        try:
+            for batch in _batches(jobs, JOB_BATCH):
+                if len(pending) >= self.max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+                pending.add(self.executor.submit(_call_all, function, batch))
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+
+
+def _batches(jobs, size):
+    """Yields the jobs of an iterator in lists of at most size."""
+    batch = []
+    for job in jobs:
+        batch.append(job)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _call_all(function, batch):
+    return [function(*job) for job in batch]
+
+
+def hidden(name):
+    """Tells whether an entry is kept by the server for itself."""
+    return name == COMPRESSION_FILE or name.startswith(PARTIAL_PREFIX)
+
+
+def walk(folder, skipped=hidden):
+    """
+    Walks a folder with os.scandir, without following symbolic links.
+
+    Parameters
+    ----------
+    skipped : callable
+        Tells from its name whether an entry is left out, by default
+        the files kept by the server for itself; None keeps them all
+
+    Yields
+    ------
+    tuple
+        The path from folder and the os.DirEntry of every entry below
+        it, in name order, a folder right before its own entries
+    """
+    stack = [("", _entries(folder, skipped))]
+    while stack:
+        parent, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        path = parent + "/" + entry.name if parent else entry.name
+        yield path, entry
+        if entry.is_dir(follow_symlinks=False):
+            stack.append((path, _entries(entry.path, skipped)))
+
+
+def _entries(folder, skipped):
+    """Returns an iterator over the entries of a folder, in name order."""
+    try:
+        with os.scandir(folder) as entries:
+            kept = [entry for entry in entries if skipped is None or not skipped(entry.name)]
+    except (FileNotFoundError, NotADirectoryError):
+        kept = []
+    kept.sort(key=lambda entry: entry.name)
+    return iter(kept)
+
+
+def tree(folder):
+    """
+    Lists a folder and everything below it, as find does: one
+    "<path> | <size>" line per file and "<path>/ | folder" per folder.
+
+    Yields
+    ------
+    bytes
+        The lines, TREE_CHUNK_SIZE bytes or so at a time, the last one
+        ended by the summary line
+    """
+    files = folders = size = 0
+    lines, length = [], 0
+    for path, entry in walk(folder):
+        if entry.is_dir(follow_symlinks=False):
+            line = path + "/ | folder\n"
+            folders += 1
+        else:
+            try:
+                entry_size = metaindex.logical_size(entry.path, entry.stat(follow_symlinks=False).st_size)
+            except FileNotFoundError:
+                continue
+            line = path + " | " + str(entry_size) + "\n"
+            files += 1
+            size += entry_size
+        lines.append(line)
+        length += len(line)
+        if length >= TREE_CHUNK_SIZE:
+            yield "".join(lines).encode()
+            lines, length = [], 0
+    lines.append("Done: " + str(files) + " files and " + str(folders) + " folders, "
+                 + str(size) + " bytes\n")
+    yield "".join(lines).encode()
+
+
+class _Counts:
+    """Files and folders an operation went through, and when it last
+    told the client about them."""
+
+    __slots__ = ("files", "folders", "total", "reported")
+
+    def __init__(self, total):
+        self.files = 0
+        self.folders = 0
+        self.total = total
+        self.reported = time.monotonic()
+
+    def due(self):
+        """Tells whether PROGRESS_INTERVAL passed since the last progress line."""
+        now = time.monotonic()
+        if now - self.reported < PROGRESS_INTERVAL:
+            return False
+        self.reported = now
+        return True
+
+    def progress(self, verb):
+        """Returns the line telling how many files were done out of the total."""
+        return (verb + " " + str(self.files) + " of " + str(self.total) + " files\n").encode()
+
+    def summary(self, verb):
+        """Returns the line telling what the operation did."""
+        return verb + " " + str(self.files) + " files and " + str(self.folders) + " folders"
+
+
+def _run(operation, counts, verb, on_done):
+    """
+    Yields the progress lines of an operation, then its summary line,
+    "Done: ..." or "Failed: ..." if it stopped on an error. on_done is
+    called once the operation stopped, whatever the reason.
+    """
+    try:
+        summary = yield from operation
+    except OSError as error:
+        summary = None
+        failure = error
+    finally:
+        on_done()
+    if summary is not None:
+        yield ("Done: " + summary + "\n").encode()
+        return
+    name = os.path.basename(failure.filename) if failure.filename else ""
+    yield ("Failed: " + (failure.strerror or str(failure)) + (" " + name if name else "")
+           + ", after " + counts.summary(verb.lower()) + "\n").encode()
+
+
+def copy_file(source, destination):
+    """
+    Copies the content of a file, as it is stored, to a new file, with
+    copy_file_range so the kernel copies it without reading it into
+    Python, or shares its blocks where the file system can. The copy is
+    marked with the format of the file.
+
+    Returns
+    -------
+    int
+        Bytes copied
+    """
+    source_descriptor = os.open(source, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        destination_descriptor = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            copied = _copy_content(source_descriptor, destination_descriptor)
+            fileformat.copy_format(source_descriptor, destination_descriptor)
+            return copied
+        finally:
+            os.close(destination_descriptor)
+    finally:
+        os.close(source_descriptor)
+
+
+def _copy_content(source, destination):
+    remaining = os.fstat(source).st_size
+    copied = 0
+    copy_range = getattr(os, "copy_file_range", None)
+    while remaining > 0 and copy_range is not None:
+        try:
+            count = copy_range(source, destination, remaining)
+        except OSError as error:
+            if error.errno not in NO_COPY_RANGE:
+                raise
+            break
+        if not count:
+            return copied
+        copied += count
+        remaining -= count
+    # Both offsets moved along with the bytes copied so far
+    while True:
+        chunk = os.read(source, COPY_CHUNK_SIZE)
+        if not chunk:
+            return copied
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(destination, view):]
+        copied += len(chunk)
+
+
+def _copy_jobs(source, destination, counts):
+    """Creates the folders below source in destination as they are
+    walked, and yields the (source, destination) of every file."""
+    for path, entry in walk(source, lambda name: name.startswith(PARTIAL_PREFIX)):
+        target = os.path.join(destination, path)
+        if entry.is_dir(follow_symlinks=False):
+            os.mkdir(target)
+            counts.folders += 1
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path, target
+
+
+def _copy(source, destination, counts):
+    workers = TreeWorkers.shared()
+    if os.path.isdir(source) and not os.path.islink(source):
+        os.mkdir(destination)
+        counts.folders += 1
+        jobs = _copy_jobs(source, destination, counts)
+    else:
+        jobs = iter([(source, destination)])
+    for _ in workers.map(copy_file, jobs):
+        counts.files += 1
+        if counts.due():
+            yield counts.progress("Copied")
+    return counts.summary("copied")
+
+
+def copy(source, destination, total, on_done):
+    """
+    Copies a file, or a folder and everything below it but the staged
+    uploads, to a destination which does not exist yet. The folders
+    are created as they are walked while the pool copies the files.
+
+    Parameters
+    ----------
+    total : int
+        Files expected, for the progress lines
+    on_done : callable
+        Called once the copy stopped, to account for what it wrote
+
+    Yields
+    ------
+    bytes
+        "Copied <files> of <total> files" every PROGRESS_INTERVAL
+        seconds, then the summary line
+    """
+    counts = _Counts(total)
+    yield from _run(_copy(source, destination, counts), counts, "Copied", on_done)
+
+
+def _unlink(path):
+    os.unlink(path)
+
+
+def _delete(path, counts):
+    if not os.path.isdir(path) or os.path.islink(path):
+        os.unlink(path)
+        counts.files += 1
+        return counts.summary("deleted")
+    folders = []
+
+    def jobs():
+        for _, entry in walk(path, None):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            else:
+                yield (entry.path,)
+
+    for _ in TreeWorkers.shared().map(_unlink, jobs()):
+        counts.files += 1
+        if counts.due():
+            yield counts.progress("Deleted")
+    # Deepest first, every folder is empty once its files are gone
+    for folder in reversed(folders):
+        os.rmdir(folder)
+        counts.folders += 1
+    os.rmdir(path)
+    counts.folders += 1
+    return counts.summary("deleted")
+
+
+def delete(path, total, on_done):
+    """
+    Deletes a file, or a folder and everything below it: the pool
+    deletes the files as the folders are walked, then the folders are
+    removed, deepest first.
+
+    Parameters
+    ----------
+    total : int
+        Files expected, for the progress lines
+    on_done : callable
+        Called once the delete stopped, to account for what it removed
+
+    Yields
+    ------
+    bytes
+        "Deleted <files> of <total> files" every PROGRESS_INTERVAL
+        seconds, then the summary line
+    """
+    counts = _Counts(total)
+    yield from _run(_delete(path, counts), counts, "Deleted", on_done)
+
+
+def _move(source, destination, counts, renamed):
+    try:
+        os.replace(source, destination)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+    else:
+        renamed.append(True)
+        return "moved " + os.path.basename(source)
+    # On another file system, copied then deleted
+    yield from _copy(source, destination, counts)
+    copied = counts.files
+    counts.files = counts.folders = 0
+    yield from _delete(source, counts)
+    counts.files = copied
+    return counts.summary("moved")
+
+
+def move(source, destination, total, on_done):
+    """
+    Moves a file or a folder to a destination which does not exist
+    yet, with one os.replace, or by copying it then deleting it when
+    the destination is on another file system.
+
+    Parameters
+    ----------
+    total : int
+        Files expected, for the progress lines of a copy
+    on_done : callable
+        Called once the move stopped, with True if it was a rename
+
+    Yields
+    ------
+    bytes
+        The progress lines of a copy and delete, then the summary line
+    """
+    counts = _Counts(total)
+    renamed = []
+    yield from _run(_move(source, destination, counts, renamed), counts, "Moved",
+                    lambda: on_done(bool(renamed)))
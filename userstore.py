@@ -0,0 +1,265 @@
+"""
+This program keeps the registered users and the logged in
+sessions in memory, shared by every client connection of the server.
+"""
+
+import csv
+import os
+import threading
+from journal import Journal
+from passwords import PasswordHasher
+
+COMPACT_ROWS = 1000
+
+
+class UserStore:
+    """
+
+    Process-wide store of registered users and logged in sessions.
+    The CSV files are write-ahead journals of the changes: the store
+    reads them once and afterwards only reads the rows appended since
+    its last look, so every lookup is a dictionary access. A change is
+    appended under an exclusive file lock, which keeps several server
+    processes sharing the same files consistent, and is on the disk
+    when the call returns, concurrent changes sharing one fsync. The
+    logged in users file is compacted into a snapshot of the sessions
+    still open once it holds COMPACT_ROWS rows and twice as many rows
+    as open sessions, so logins and logouts cost the same however many
+    users there are.
+
+    Passwords are kept hashed by the shared PasswordHasher. A password
+    kept in plain text by an older server, or hashed with another cost
+    than the configured one, is hashed again at the next login of its
+    user and the new row supersedes the old one; the registered users
+    file is compacted the same way as the sessions once most of its
+    rows are superseded.
+
+    Attributes
+    ----------
+    self.directory : str
+        Folder holding the CSV files
+    self.registered_users : dict
+        Maps the username of every registered user to the stored hash
+        of the password
+    self.logged_in_users : set
+        Usernames of the logged in users
+    self.registrations, self.sessions : Journal
+        Journals of the registered users and of the login and logout
+        events
+
+    Returns
+    -------
+    Object
+        UserStore Object
+    """
+
+    ACCESS_SESSION_DIR = "AccessSession"
+    REGISTERED_USERS_CSV_FILE = "registered_users.csv"
+    LOGGED_IN_USERS_CSV_FILE = "logged_in_users.csv"
+    CSV_HEADING = "username,password\n"
+    SESSION_HEADING = "username,event\n"
+    LOGIN_EVENT = "login"
+    LOGOUT_EVENT = "logout"
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, directory=ACCESS_SESSION_DIR, sync=True):
+        """
+        Parameters
+        ----------
+        directory : str
+            Folder holding the CSV files, by default AccessSession
+        sync : bool
+            Whether changes are flushed to the disk before returning
+        """
+        self.directory = directory
+        self.registered_users_file = os.path.join(directory, UserStore.REGISTERED_USERS_CSV_FILE)
+        self.logged_in_users_file = os.path.join(directory, UserStore.LOGGED_IN_USERS_CSV_FILE)
+        self.registered_users = {}
+        self.logged_in_users = set()
+        self.registrations = Journal(self.registered_users_file, UserStore.CSV_HEADING,
+                                     self._apply_registration, self._reset_registrations, sync)
+        self.sessions = Journal(self.logged_in_users_file, UserStore.SESSION_HEADING,
+                                self._apply_session_event, self._reset_sessions, sync)
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        UserStore
+            The store shared by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, directory=ACCESS_SESSION_DIR, sync=True):
+        """
+        Replaces the shared store, e.g. with the settings given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(directory, sync)
+            return cls._shared
+
+    def load(self):
+        """
+        Brings the store up to date with the CSV files. The first call
+        reads the whole files, later calls only read what other
+        processes appended since, which is usually nothing.
+        """
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self._convert_legacy_sessions()
+                    self.loaded = True
+        self.registrations.follow()
+        self.sessions.follow()
+
+    def is_registered(self, user_id):
+        """
+        Returns
+        -------
+        bool
+            True if the username is registered
+        """
+        self.load()
+        return user_id in self.registered_users
+
+    def check_password(self, user_id, password):
+        """
+        Returns
+        -------
+        bool
+            True if the password matches the one registered for the user
+        """
+        self.load()
+        stored = self.registered_users.get(user_id)
+        if stored is None:
+            return False
+        hasher = PasswordHasher.shared()
+        if not hasher.verify(user_id, password, stored):
+            return False
+        if hasher.needs_rehash(stored):
+            self._rehash(user_id, password, stored)
+        return True
+
+    def add_user(self, user_id, password):
+        """
+        Registers a new user and appends it to the registered users
+        file, with the password hashed.
+
+        Returns
+        -------
+        bool
+            False if the username is already taken
+        """
+        self.load()
+        if user_id in self.registered_users:
+            return False
+        hasher = PasswordHasher.shared()
+        # Hashed before taking the lock, which would hold up the other
+        # registrations for as long
+        stored = hasher.hash(password)
+        with self.registrations.locked():
+            if user_id in self.registered_users:
+                return False
+            token = self.registrations.write([user_id, stored])
+            self.registered_users[user_id] = stored
+        self.registrations.commit(token)
+        hasher.remember(user_id, password, stored)
+        return True
+
+    def _rehash(self, user_id, password, stored):
+        """Replaces a password stored in plain text or with another cost
+        by a new hash, unless it changed meanwhile."""
+        hasher = PasswordHasher.shared()
+        rehashed = hasher.hash(password)
+        with self.registrations.locked():
+            if self.registered_users.get(user_id) != stored:
+                return
+            token = self.registrations.write([user_id, rehashed])
+            self.registered_users[user_id] = rehashed
+            if self.registrations.rows >= max(COMPACT_ROWS, 2 * len(self.registered_users)):
+                self.registrations.compact([[registered, password_hash] for registered, password_hash
+                                            in sorted(self.registered_users.items())])
+        self.registrations.commit(token)
+        hasher.remember(user_id, password, rehashed)
+
+    def is_logged_in(self, user_id):
+        """
+        Returns
+        -------
+        bool
+            True if the user has an active session
+        """
+        self.load()
+        return user_id in self.logged_in_users
+
+    def start_session(self, user_id):
+        """
+        Marks the user as logged in and appends a login event.
+        """
+        self._append_event(user_id, UserStore.LOGIN_EVENT)
+
+    def end_session(self, user_id):
+        """
+        Marks the user as logged out and appends a logout event.
+        """
+        self._append_event(user_id, UserStore.LOGOUT_EVENT)
+
+    def _append_event(self, user_id, event):
+        self.load()
+        with self.sessions.locked():
+            if (user_id in self.logged_in_users) == (event == UserStore.LOGIN_EVENT):
+                return
+            token = self.sessions.write([user_id, event])
+            self._apply_session_event(user_id, event)
+            if self.sessions.rows >= max(COMPACT_ROWS, 2 * len(self.logged_in_users)):
+                self.sessions.compact([[logged_in, UserStore.LOGIN_EVENT]
+                                       for logged_in in sorted(self.logged_in_users)])
+        self.sessions.commit(token)
+
+    def counters(self):
+        """
+        Returns
+        -------
+        dict
+            The changes committed and the fsync calls they took
+        """
+        return {"user_store_commits": self.registrations.commits + self.sessions.commits,
+                "user_store_fsyncs": self.registrations.fsyncs + self.sessions.fsyncs}
+
+    def _apply_registration(self, user_id, password):
+        self.registered_users[user_id] = password
+
+    def _apply_session_event(self, user_id, event):
+        if event == UserStore.LOGIN_EVENT:
+            self.logged_in_users.add(user_id)
+        else:
+            self.logged_in_users.discard(user_id)
+
+    def _reset_registrations(self):
+        self.registered_users = {}
+
+    def _reset_sessions(self):
+        self.logged_in_users = set()
+
+    def _convert_legacy_sessions(self):
+        """
+        Rewrites a logged in users file in the old username,password
+        format, listing one logged in user per row, as login events.
+        """
+        with self.sessions.locked():
+            with open(self.logged_in_users_file, newline="") as file:
+                if file.readline().replace("\r\n", "\n") == UserStore.SESSION_HEADING:
+                    return
+                user_ids = sorted({row[0] for row in csv.reader(file) if row})
+            self.sessions.compact([[user_id, UserStore.LOGIN_EVENT] for user_id in user_ids])
+            self.logged_in_users = set(user_ids)
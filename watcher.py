@@ -0,0 +1,405 @@
+"""
+This program watches folders for files being created, modified or
+deleted, for the watch command. Changes come from inotify on Linux, or
+else from comparing the modification times of the entries of every
+watched folder at a regular interval.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+from treeops import hidden
+
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+
+DEBOUNCE = 0.2
+MAX_DELAY = 1.0
+POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _kind(mask):
+    """Returns the kind of change an inotify event mask tells of."""
+    if mask & (IN_CREATE | IN_MOVED_TO):
+        return CREATED
+    if mask & (IN_DELETE | IN_MOVED_FROM):
+        return DELETED
+    return MODIFIED
+
+
+def coalesce(previous, kind):
+    """
+    Returns
+    -------
+    str
+        The one change standing for two changes of the same file in a
+        row, or None if they cancel out, e.g. a file created and deleted
+    """
+    if previous is None or previous == kind:
+        return kind
+    if previous == CREATED:
+        return None if kind == DELETED else CREATED
+    if kind == DELETED:
+        return DELETED
+    return MODIFIED
+
+
+class Inotify:
+    """
+
+    The inotify calls of the C library, through ctypes.
+
+    Attributes
+    ----------
+    self.descriptor : int
+        inotify instance the events are read from
+
+    Returns
+    -------
+    Object
+        Inotify Object
+
+    Raises
+    ------
+    OSError
+        If inotify is not available
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library("c")
+        if name is None:
+            raise OSError("No C library to call inotify")
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.descriptor = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.descriptor < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add(self, path):
+        """Returns the watch descriptor of a new watch of the folder."""
+        watch = self.libc.inotify_add_watch(self.descriptor, os.fsencode(path), WATCH_MASK)
+        if watch < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return watch
+
+    def remove(self, watch):
+        """Removes a watch."""
+        self.libc.inotify_rm_watch(self.descriptor, watch)
+
+    def read(self):
+        """
+        Waits for events.
+
+        Returns
+        -------
+        list
+            (watch descriptor, mask, name) of every event read
+        """
+        data = os.read(self.descriptor, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((watch, mask, os.fsdecode(name)))
+        return events
+
+
+class Subscription:
+    """
+
+    One subscriber to the changes of a folder. Changes arrive on the
+    watcher thread and are handed to the event loop of the subscriber,
+    which collects them until no change came for debounce seconds, or
+    max_delay seconds after the first one, and then calls the callback
+    once with one change per file.
+
+    Attributes
+    ----------
+    self.folder : str
+        Folder watched
+    self.callback : callable
+        Called on the event loop with the list of (name, kind) changes
+    self.loop : AbstractEventLoop
+        Event loop of the subscriber
+    self.pending : dict
+        Maps the name of every file changed since the last call to its
+        coalesced kind of change
+
+    Returns
+    -------
+    Object
+        Subscription Object
+    """
+
+    def __init__(self, folder, callback, loop, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+        self.folder = folder
+        self.callback = callback
+        self.loop = loop
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = {}
+        self.first = None
+        self.timer = None
+        self.closed = False
+
+    def post(self, name, kind):
+        """Hands a change over to the event loop, from any thread."""
+        if self.closed:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._add, name, kind)
+        except RuntimeError:
+            # The loop closed before the subscriber could unsubscribe
+            self.closed = True
+
+    def _add(self, name, kind):
+        if self.closed:
+            return
+        kind = coalesce(self.pending.pop(name, None), kind)
+        if kind is not None:
+            self.pending[name] = kind
+        now = self.loop.time()
+        if self.first is None:
+            self.first = now
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = min(self.debounce, self.first + self.max_delay - now)
+        self.timer = self.loop.call_later(max(0, delay), self._flush)
+
+    def _flush(self):
+        changes = list(self.pending.items())
+        self.pending.clear()
+        self.first = self.timer = None
+        if changes and not self.closed:
+            self.callback(changes)
+
+    def close(self):
+        """Stops the subscription, on the event loop."""
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class FolderWatcher:
+    """
+
+    Process-wide watcher of the folders subscribed to by the clients,
+    shared by all the connections so a folder is watched once however
+    many clients watch it. A daemon thread waits for the changes, with
+    one inotify watch per folder, or with the polling fallback lists
+    every folder each poll_interval seconds and compares the
+    modification time and size of its entries with the previous look.
+    Changes to the files the server keeps for itself are left out.
+
+    Attributes
+    ----------
+    self.inotify : Inotify
+        inotify instance, None when polling
+    self.poll_interval : float
+        Seconds between two looks at a folder when polling
+    self.debounce, self.max_delay : float
+        Settings of the new subscriptions
+    self.folders : dict
+        Maps every watched folder to the set of its subscriptions
+
+    Returns
+    -------
+    Object
+        FolderWatcher Object
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, use_inotify=True, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE,
+                 max_delay=MAX_DELAY):
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.folders = {}
+        self.watches = {}
+        self.snapshots = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns
+        -------
+        FolderWatcher
+            The watcher used by all the connections of this process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, use_inotify=True, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE,
+                  max_delay=MAX_DELAY):
+        """
+        Replaces the shared watcher, e.g. with the settings given on the
+        server command line.
+        """
+        with cls._shared_lock:
+            cls._shared = cls(use_inotify, poll_interval, debounce, max_delay)
+            return cls._shared
+
+    def subscribe(self, folder, callback, loop):
+        """
+        Starts watching a folder for a subscriber.
+
+        Parameters
+        ----------
+        folder : str
+            Folder to watch
+        callback : callable
+            Called on loop with the list of (name, kind) changes
+        loop : AbstractEventLoop
+            Event loop of the subscriber
+
+        Returns
+        -------
+        Subscription
+            To pass to unsubscribe
+
+        Raises
+        ------
+        OSError
+            If the folder cannot be watched
+        """
+        folder = os.path.normpath(folder)
+        subscription = Subscription(folder, callback, loop, self.debounce, self.max_delay)
+        with self._lock:
+            if folder not in self.folders:
+                if self.inotify is not None:
+                    self.watches[self.inotify.add(folder)] = folder
+                else:
+                    self.snapshots[folder] = _snapshot(folder)
+                self.folders[folder] = set()
+            self.folders[folder].add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="folder-watcher",
+                                                daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stops a subscription, dropping the watch of its folder if it was the last one."""
+        subscription.close()
+        with self._lock:
+            subscriptions = self.folders.get(subscription.folder)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if subscriptions:
+                return
+            del self.folders[subscription.folder]
+            self.snapshots.pop(subscription.folder, None)
+            for watch, folder in list(self.watches.items()):
+                if folder == subscription.folder:
+                    del self.watches[watch]
+                    self.inotify.remove(watch)
+
+    def _forget(self, watch):
+        """Drops a watch the kernel removed, e.g. as its folder was
+        deleted; its subscribers get no more changes, and subscribing
+        to the folder again watches it anew."""
+        with self._lock:
+            folder = self.watches.pop(watch, None)
+            if folder is not None:
+                self.folders.pop(folder, None)
+
+    def _post(self, folder, name, kind):
+        if hidden(name):
+            return
+        with self._lock:
+            subscriptions = list(self.folders.get(folder, ()))
+        for subscription in subscriptions:
+            subscription.post(name, kind)
+
+    def _run(self):
+        if self.inotify is not None:
+            while True:
+                for watch, mask, name in self.inotify.read():
+                    if mask & IN_IGNORED:
+                        self._forget(watch)
+                    elif name:
+                        with self._lock:
+                            folder = self.watches.get(watch)
+                        if folder is not None:
+                            self._post(folder, name, _kind(mask))
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                folders = list(self.snapshots)
+            for folder in folders:
+                self._poll(folder)
+
+    def _poll(self, folder):
+        """Compares a folder with its previous look and posts the differences."""
+        current = _snapshot(folder)
+        with self._lock:
+            if folder not in self.snapshots:
+                return
+            previous, self.snapshots[folder] = self.snapshots[folder], current
+        for name, stamp in current.items():
+            before = previous.get(name)
+            if before is None:
+                self._post(folder, name, CREATED)
+            elif before != stamp:
+                self._post(folder, name, MODIFIED)
+        for name in previous:
+            if name not in current:
+                self._post(folder, name, DELETED)
+
+
+def _snapshot(folder):
+    """
+    Returns
+    -------
+    dict
+        Maps the name of every entry of the folder to its modification
+        time and size
+    """
+    snapshot = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    stats = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.name] = (stats.st_mtime_ns, stats.st_size)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return snapshot